@@ -0,0 +1 @@
+# Throughput benchmarks, run from the repository root with `python -m benchmarks.<name>`
@@ -0,0 +1,95 @@
+"""
+Decompression throughput of preprocess.decompress for 1, 2, 4 and N workers.
+
+Writes a synthetic pushshift-like corpus as a bz2 stream and a multi-frame
+zstd archive, and reports MB/s of decompressed output and the speedup over a
+single worker. Then checks that zstd archives with a truncated or garbage
+tail fall back to the single threaded reader and still give every complete
+frame, exits with status 1 otherwise.
+
+    python -m benchmarks.bench_decompress --records 200000
+"""
+
+import argparse
+import bz2
+import json
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+
+import zstandard as zstd
+
+from benchmarks.bench_stream import make_record
+from preprocess import decompress
+
+FRAME_BYTES = 4 * 1024 * 1024
+
+
+def write_archives(dpath: str, records: int, seed: int = 0) -> tuple:
+    rng = random.Random(seed)
+    raw = ''.join(json.dumps(make_record(rng)) + '\n' for _ in range(records)).encode('utf-8')
+    bz2_path = os.path.join(dpath, 'RS_bench.bz2')
+    with open(bz2_path, 'wb') as fw:
+        fw.write(bz2.compress(raw))
+    zst_path = os.path.join(dpath, 'RS_bench.zst')
+    cctx = zstd.ZstdCompressor(level=3)
+    with open(zst_path, 'wb') as fw:
+        for i in range(0, len(raw), FRAME_BYTES):
+            fw.write(cctx.compress(raw[i:i + FRAME_BYTES]))
+    return len(raw), (bz2_path, zst_path)
+
+
+# what can follow the last complete frame of a damaged archive
+TAILS = {
+    'half magic': b'\x28\xb5',
+    'bare magic': b'\x28\xb5\x2f\xfd',
+    'short skippable frame': b'\x50\x2a\x4d\x18\x01',
+}
+
+
+def check_tails(dpath: str, zst_path: str, size: int) -> bool:
+    """Return whether every damaged copy of ``zst_path`` decompresses to its ``size`` bytes."""
+    with open(zst_path, 'rb') as fp:
+        data = fp.read()
+    tails = dict(TAILS, **{'truncated frame': data[:30]})
+    ok = True
+    for name, tail in tails.items():
+        path = os.path.join(dpath, 'RS_tail.zst')
+        with open(path, 'wb') as fw:
+            fw.write(data + tail)
+        try:
+            got = sum(len(chunk) for chunk in decompress.iter_chunks(path, processes=2))
+        except Exception as e:
+            got = f'{type(e).__name__}: {e}'
+        print(f"{name:22s} {'ok' if got == size else f'MISMATCH {got}'}")
+        ok = ok and got == size
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--records', type=int, default=100000)
+    args = parser.parse_args()
+
+    workers = sorted({1, 2, 4, multiprocessing.cpu_count()})
+    with tempfile.TemporaryDirectory() as dpath:
+        size, paths = write_archives(dpath, args.records)
+        for path in paths:
+            base = None
+            for n in workers:
+                start = time.perf_counter()
+                for _ in decompress.iter_chunks(path, processes=n):
+                    pass
+                elapsed = time.perf_counter() - start
+                base = base or elapsed
+                print(f"{os.path.basename(path):14s} workers={n:<3d} "
+                      f"{size / elapsed / 1e6:8.1f} MB/s  speedup {base / elapsed:5.2f}x")
+        ok = check_tails(dpath, paths[1], size)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""
+MinHash/LSH near-duplicate detection on copypasta-like texts.
+
+Synthetic texts are unique random word sequences mixed with copies of a
+few "copypastas", each copy with a couple of words changed. Reports
+
+* signature throughput of ``preprocess.dedup.MinHasher`` against a per text,
+  per permutation Python loop,
+* how many copies the on-disk ``BandIndex`` removes and how many unique
+  texts it removes by mistake,
+* the examples the Beam pipeline of create_data.py drops with
+  ``--dedup_threshold``, on comments answering with the same texts.
+
+Checks that the NumPy signatures match the Python loop and that no unique
+text is removed, exits with status 1 if a check fails.
+
+    python -m benchmarks.bench_dedup --texts 20000 --threshold 0.7
+"""
+
+import argparse
+import glob
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+from benchmarks.bench_stream import WORDS
+from preprocess import dedup
+from reddit import create_data
+
+
+def make_texts(rng: random.Random, count: int, copypastas: int = 20, share: float = 0.3,
+               edits: int = 2) -> tuple:
+    """Return texts and the index of the copypasta of every text, ``None`` for unique ones."""
+    pastas = [' '.join(rng.choice(WORDS) for _ in range(rng.randint(20, 60)))
+              for _ in range(copypastas)]
+    texts, origins = [], []
+    for _ in range(count):
+        if rng.random() < share:
+            origin = rng.randrange(copypastas)
+            words = pastas[origin].split()
+            for _ in range(edits):
+                words[rng.randrange(len(words))] = rng.choice(WORDS)
+            texts.append(' '.join(words))
+            origins.append(origin)
+        else:
+            texts.append(' '.join(rng.choice(WORDS) for _ in range(rng.randint(10, 60))))
+            origins.append(None)
+    return texts, origins
+
+
+def python_signature(text: str, hasher: dedup.MinHasher) -> list:
+    hashes = dedup.shingle_hashes(text, hasher.shingle_size)
+    return [min(((a * x + b) % (1 << 64)) % dedup.MERSENNE_PRIME & 0xFFFFFFFF for x in hashes)
+            for a, b in zip(hasher.a.tolist(), hasher.b.tolist())]
+
+
+def run_beam(texts: list, output_dir: str, threshold: float, extra: list = ()) -> list:
+    """Responses of the examples created from threads answering a question with ``texts``."""
+    rows = []
+    for i, text in enumerate(texts):
+        thread = f'thread{i % 100}'
+        rows.append({'id': f'q{i}', 'link_id': 't3_' + thread, 'parent_id': 't3_' + thread,
+                     'body': 'what do you think about this one', 'author': 'asker',
+                     'subreddit': 'AskReddit'})
+        rows.append({'id': f'r{i}', 'link_id': 't3_' + thread, 'parent_id': f't1_q{i}',
+                     'body': text, 'author': 'poster', 'subreddit': 'AskReddit'})
+    create_data.run(['--reddit_table', 'unused:unused.unused', '--output_dir', output_dir,
+                     '--dataset_format', 'JSON', '--num_shards_train', '1', '--num_shards_test', '1',
+                     '--max_length', '1000', '--dedup_threshold', str(threshold)] + list(extra),
+                    comments=rows)
+    responses = []
+    for path in glob.glob(os.path.join(output_dir, '*.json')):
+        with open(path) as fp:
+            responses.extend(json.loads(line)['response'] for line in fp)
+    return responses
+
+
+def count_kept(texts: list, origins: list, kept) -> tuple:
+    """Return the copies kept, the copypastas they come from and the unique texts removed."""
+    copies = [origin for text, origin in zip(texts, origins) if text in kept and origin is not None]
+    unique_removed = sum(1 for text, origin in zip(texts, origins) if text not in kept and origin is None)
+    return len(copies), len(set(copies)), unique_removed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--texts', type=int, default=20000)
+    parser.add_argument('--threshold', type=float, default=0.7)
+    parser.add_argument('--num-perm', type=int, default=dedup.NUM_PERM)
+    parser.add_argument('--beam-texts', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    texts, origins = make_texts(rng, args.texts)
+    hasher = dedup.MinHasher(args.threshold, args.num_perm, seed=args.seed)
+    print(f"{hasher.bands} bands of {hasher.rows} rows, "
+          f"threshold {(1 / hasher.bands) ** (1 / hasher.rows):.2f}")
+
+    sample = texts[:500]
+    start = time.perf_counter()
+    reference = [python_signature(text, hasher) for text in sample]
+    python_time = time.perf_counter() - start
+    start = time.perf_counter()
+    keys = []
+    for batch in range(0, len(texts), 1024):
+        keys.extend(hasher.band_keys(texts[batch:batch + 1024]))
+    numpy_time = time.perf_counter() - start
+    failed = hasher.signatures(sample).tolist() != reference
+    if failed:
+        print("NumPy signatures differ from the Python loop")
+    print(f"python loop {len(sample) / python_time:9.0f} texts/s")
+    print(f"numpy       {len(texts) / numpy_time:9.0f} texts/s")
+
+    with tempfile.TemporaryDirectory() as root:
+        index = dedup.BandIndex(os.path.join(root, 'dedup.sqlite'))
+        start = time.perf_counter()
+        kept = set()
+        for batch in range(0, len(texts), 1024):
+            kept.update(index.filter('bench', texts[batch:batch + 1024], keys[batch:batch + 1024]))
+        index_time = time.perf_counter() - start
+        # a second pass over the same texts as a new source keeps nothing
+        again = index.filter('again', texts, keys)
+        index.close()
+        copies = sum(origin is not None for origin in origins)
+        copies_kept, pastas_kept, unique_removed = count_kept(texts, origins, kept)
+        print(f"band index  {len(texts) / index_time:9.0f} texts/s, kept {len(kept)} of {len(texts)}: "
+              f"{copies_kept} of {copies} copies of {pastas_kept} copypastas, "
+              f"{unique_removed} unique texts removed")
+        if again:
+            print(f"{len(again)} texts kept twice")
+            failed = True
+
+        texts, origins = texts[:args.beam_texts], origins[:args.beam_texts]
+        responses = run_beam(texts, os.path.join(root, 'beam'), args.threshold)
+        copies = sum(origin is not None for origin in origins)
+        copies_kept, pastas_kept, beam_removed = count_kept(texts, origins, set(responses))
+        print(f"beam        kept {len(responses)} of {len(texts)} examples: "
+              f"{copies_kept} of {copies} copies of {pastas_kept} copypastas, "
+              f"{beam_removed} unique texts removed")
+        # unique texts share no band with anything, short of hash collisions
+        failed = failed or unique_removed > 0 or beam_removed > 0
+    print('ok' if not failed else 'MISMATCH')
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
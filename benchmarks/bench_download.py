@@ -0,0 +1,60 @@
+"""
+Compare single connection and segmented downloads of build.py.
+
+Serves a random file from the local range server, every connection capped at
+``--rate`` MB/s, optionally dropping or slowing down some responses, and
+checks the downloaded bytes. Downloads verify the sha256 of the file while
+it is written, a wrong hash must remove the file.
+
+    python -m benchmarks.bench_download --size 64 --rate 8 --drop-every 5 --slow-every 7
+"""
+
+import argparse
+import hashlib
+import os
+import tempfile
+import time
+
+import build
+from benchmarks.http_fixture import RangeHandler, serve
+from preprocess import segmented
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--size', type=int, default=64, help='MB to download.')
+    parser.add_argument('--rate', type=float, default=8, help='MB/s per connection.')
+    parser.add_argument('--segments', type=int, default=segmented.SEGMENTS)
+    parser.add_argument('--drop-every', type=int, default=None)
+    parser.add_argument('--slow-every', type=int, default=None)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        served = os.path.join(root, 'served')
+        os.makedirs(served)
+        data = os.urandom(args.size * 1024 * 1024)
+        with open(os.path.join(served, 'RS_bench.zst'), 'wb') as fw:
+            fw.write(data)
+        hashcode = hashlib.sha256(data).hexdigest()
+        with serve(served, bytes_per_second=args.rate * 1024 * 1024, handler=RangeHandler,
+                   drop_every=args.drop_every, slow_every=args.slow_every) as url:
+            for name, segments in (('single', 1), ('segmented', args.segments)):
+                fd = build.DownloadableFile(url + 'RS_bench.zst', 'RS_bench.zst', hashcode)
+                start = time.perf_counter()
+                out = fd.download_file(os.path.join(root, name), segments)
+                elapsed = time.perf_counter() - start
+                with open(out, 'rb') as fp:
+                    ok = fp.read() == data
+                print(f"{name:10s} {args.size / elapsed:8.1f} MB/s  {'ok' if ok else 'CORRUPTED'}")
+
+                fd = build.DownloadableFile(url + 'RS_bench.zst', 'RS_bench.zst', '0' * 64)
+                try:
+                    fd.download_file(os.path.join(root, name + '-wrong-hash'), segments)
+                    print(f"{name:10s} wrong hash NOT CAUGHT")
+                except AssertionError:
+                    left = os.listdir(os.path.join(root, name + '-wrong-hash'))
+                    print(f"{name:10s} wrong hash caught, {'nothing' if not left else left} left on disk")
+
+
+if __name__ == "__main__":
+    main()
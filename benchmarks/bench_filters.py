@@ -0,0 +1,92 @@
+"""
+Microbenchmark of the build.py text filters on Reddit-like texts.
+
+Compares the previous ``preprocess_text`` (recompiled url regex, findall,
+repeated strips) with ``preprocess.filters.FilterChain``. Language detection
+is left out by default since it dominates both; ``--language`` keeps it.
+
+    python -m benchmarks.bench_filters --repeat 20
+"""
+
+import argparse
+import random
+import re
+import time
+
+from preprocess import filters, langid
+
+SAMPLES = [
+    "What's the best advice you've ever received from a stranger?",
+    "[deleted]",
+    "[removed]",
+    "",
+    "lol",
+    "TIL that honey never spoils. Archaeologists have found pots of honey in ancient Egyptian tombs that are over 3,000 years old and still perfectly edible.",
+    "Check out my new build https://imgur.com/a/Xyz123 let me know what you think",
+    "I've been playing for about two years now and I still can't get past the second boss. "
+    "Any tips? I've tried leveling up, changing my build, and watching guides on youtube but nothing seems to work.",
+    "Este es un texto en español que no debería pasar el filtro de idioma.",
+    "Ceci est un message en français publié sur un subreddit anglophone.",
+    "これは日本語のテキストです",
+    "aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa" * 60,
+    "Looking for a good book to read this summer, preferably sci-fi or fantasy. Recommendations welcome!",
+    "Edit: thanks for the gold kind stranger! see www.example.org for details",
+    "My landlord refuses to return my deposit. What are my options here in the US?",
+    "   multiple     spaces\n\nand\tnewlines   in this body of text that goes on for a while   ",
+    "Update: the issue was fixed in version 2.3/2.4 of the firmware",
+]
+
+
+def legacy_find_url(string):
+    regex = r"(?i)\b((?:https?://|www\d{0,3}[.]|[a-z0-9.\-]+[.][a-z]{2,4}/)(?:[^\s()<>]+|\(([^\s()<>]+|(\([^\s()<>]+\)))*\))+(?:\(([^\s()<>]+|(\([^\s()<>]+\)))*\)|[^\s`!()\[\]{};:'\".,<>?«»“”‘’]))"
+    url = re.findall(regex, string)
+    return [x[0] for x in url]
+
+
+def legacy_preprocess_text(text, detect):
+    """``build.preprocess_text`` before the filter chain."""
+    text = re.sub(r'\s+', ' ', text)
+    cond = len(legacy_find_url(text)) > 0 or text.strip() == '' \
+        or len(text.strip()) <= 5 or text.strip().lower() == '[deleted]' \
+        or text.strip().lower() == '[removed]' or ord(text[0]) > 128 \
+        or detect(text) != 'en'
+    if cond:
+        return False
+    if ' ' not in text and len(text) > 2040:
+        return False
+    return text
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--repeat', type=int, default=2000)
+    parser.add_argument('--language', action='store_true',
+                        help='run language detection in both paths.')
+    args = parser.parse_args()
+
+    texts = SAMPLES * args.repeat
+    random.Random(0).shuffle(texts)
+    if args.language:
+        language = langid.LangdetectIdentifier()
+        detect = language.detect
+        chain = filters.FilterChain(language=language)
+    else:
+        detect = lambda text: 'en'
+        chain = filters.FilterChain()
+
+    start = time.perf_counter()
+    legacy = [legacy_preprocess_text(t, detect) for t in texts]
+    legacy_time = time.perf_counter() - start
+    start = time.perf_counter()
+    chained = [chain(t) for t in texts]
+    chain_time = time.perf_counter() - start
+
+    print(f"legacy  {len(texts) / legacy_time:12.0f} texts/s")
+    print(f"chain   {len(texts) / chain_time:12.0f} texts/s  ({legacy_time / chain_time:.1f}x)")
+    print(f"same results: {legacy == chained}")
+    for name, count in chain.rejections.most_common():
+        print(f"  rejected by {name:20s} {count}")
+
+
+if __name__ == "__main__":
+    main()
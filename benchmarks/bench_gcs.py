@@ -0,0 +1,77 @@
+"""
+Time StorageService uploads against a local bucket with simulated latency.
+
+Compares a single resumable upload with a composite upload of parallel
+slices, and upload_all of a directory tree, then downloads everything back
+with download_all and checks the bytes.
+
+    python -m benchmarks.bench_gcs --size 64 --latency 0.05
+"""
+
+import argparse
+import filecmp
+import os
+import tempfile
+import time
+
+from gcp.local_storage import LocalBucket, LocalStorage_Service
+
+
+class SlowBucket(LocalBucket):
+    """A local bucket where every upload chunk and compose request waits ``latency`` seconds."""
+
+    def __init__(self, root: str, latency: float):
+        super().__init__(root)
+        self.latency = latency
+
+    def request(self):
+        super().request()
+        time.sleep(self.latency)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--size', type=int, default=64, help='MB of the large file.')
+    parser.add_argument('--files', type=int, default=24, help='files of the directory tree.')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds per request.')
+    parser.add_argument('--chunk-size', type=int, default=1, help='MB per resumable upload request.')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        large = os.path.join(root, 'large.txt')
+        with open(large, 'wb') as fw:
+            fw.write(os.urandom(args.size * 1024 * 1024))
+        tree = os.path.join(root, 'tree')
+        for i in range(args.files):
+            path = os.path.join(tree, f'{2005 + i // 12}', f'RS_{2005 + i // 12}-{i % 12 + 1:02d}.txt')
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as fw:
+                fw.write(os.urandom(256 * 1024))
+
+        chunk_size = args.chunk_size * 1024 * 1024
+        for name, slices, workers in (('sequential', 1, 1), ('parallel', 8, 8)):
+            gcp = LocalStorage_Service(os.path.join(root, f'bucket-{name}'), chunk_size=chunk_size,
+                                       composite_threshold=chunk_size, slices=slices, workers=workers)
+            gcp.bucket = SlowBucket(gcp.root, args.latency)
+            start = time.perf_counter()
+            gcp.upload_from_filename(large, 'large.txt')
+            upload = time.perf_counter() - start
+            start = time.perf_counter()
+            gcp.upload_all(tree, 'tree')
+            upload_all = time.perf_counter() - start
+            back = os.path.join(root, f'back-{name}')
+            start = time.perf_counter()
+            gcp.download_all('tree', back)
+            download_all = time.perf_counter() - start
+
+            same = filecmp.cmp(large, os.path.join(gcp.root, 'large.txt'), shallow=False)
+            for dirpath, _, filenames in os.walk(tree):
+                for file in filenames:
+                    relative = os.path.relpath(os.path.join(dirpath, file), tree)
+                    same &= filecmp.cmp(os.path.join(tree, relative), os.path.join(back, relative), shallow=False)
+            print(f"{name:10s} upload {args.size / upload:7.1f} MB/s  upload_all {upload_all:6.2f}s  "
+                  f"download_all {download_all:6.2f}s  {'ok' if same else 'MISMATCH'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""
+Compare incremental monthly builds of the local runner with full rebuilds.
+
+Synthetic threads are spread over ``--months`` JSON lines files, each
+thread mostly in the month it starts in, with some comments arriving a
+month later and a megathread running through every month. Replies never
+come before their parent. Every month is added with ``--incremental`` and
+checked against a full run over all the months so far: the shards listed
+by the manifest must hold exactly the examples of the full run. Exits with
+status 1 otherwise.
+
+    python -m benchmarks.bench_incremental --months 4 --comments 20000
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter
+
+from benchmarks.bench_local_runner import read_split
+from benchmarks.bench_skew import raw_comments
+from benchmarks.bench_stream import WORDS
+from reddit import local_runner
+
+
+def monthly_rows(rng: random.Random, months: int, comments: int, threads: int,
+                 late: float = 0.05) -> list:
+    """Rows of every month, a fraction ``late`` of each thread's comments a month late."""
+    rows = raw_comments(rng, comments, threads)
+    by_id = {row['id']: row for row in rows}
+    starts = {}
+    month_of = {}
+
+    def month(row):
+        # replies never come before their parent, like in the monthly dumps
+        chain, seen = [row], {row['id']}
+        while chain[-1]['id'] not in month_of and chain[-1]['parent_id'][3:] in by_id:
+            parent = by_id[chain[-1]['parent_id'][3:]]
+            if parent['id'] in seen:
+                # comments pointing at each other
+                break
+            chain.append(parent)
+            seen.add(parent['id'])
+        for row in reversed(chain):
+            if row['id'] in month_of:
+                continue
+            thread = row['link_id']
+            if thread == 't3_mega':
+                first = rng.randrange(months)
+            else:
+                first = starts.setdefault(thread, rng.randrange(months))
+                if rng.random() < late:
+                    first += 1
+            parent = month_of.get(row['parent_id'][3:], 0)
+            month_of[row['id']] = min(months - 1, max(first, parent))
+        return month_of[chain[0]['id']]
+
+    parts = [[] for _ in range(months)]
+    for row in rows:
+        row['body'] = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 20)))
+        parts[month(row)].append(row)
+    return parts
+
+
+def read_manifest(output_dir: str, split: str, dataset_format: str) -> Counter:
+    with open(os.path.join(output_dir, local_runner.MANIFEST)) as fp:
+        manifest = json.load(fp)
+    examples = Counter()
+    for build in manifest['builds']:
+        examples.update(read_split(os.path.join(output_dir, build['name']), split, dataset_format))
+    return examples
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--months', type=int, default=4)
+    parser.add_argument('--comments', type=int, default=20000)
+    parser.add_argument('--threads', type=int, default=4000)
+    parser.add_argument('--format', default='JSON', choices=['JSON', 'TF', 'PARQUET'])
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    parts = monthly_rows(random.Random(args.seed), args.months, args.comments, args.threads)
+    common = ['--dataset_format', args.format, '--num_shards_train', '4', '--num_shards_test', '1',
+              '--seed', str(args.seed)]
+    if args.processes:
+        common += ['--processes', str(args.processes)]
+
+    failed = False
+    with tempfile.TemporaryDirectory() as root:
+        paths = []
+        for month, rows in enumerate(parts):
+            paths.append(os.path.join(root, f'RC_month-{month:02d}.json'))
+            with open(paths[-1], 'w') as fw:
+                fw.writelines(json.dumps(row) + '\n' for row in rows)
+
+        incremental = os.path.join(root, 'incremental')
+        print(f"{'month':>5s} {'comments':>9s} {'full':>8s} {'incremental':>12s} "
+              f"{'threads':>8s} {'new examples':>13s}")
+        for month, path in enumerate(paths):
+            full = os.path.join(root, f'full-{month:02d}')
+            start = time.perf_counter()
+            local_runner.run(['--input'] + paths[:month + 1] + ['--output_dir', full] + common)
+            full_time = time.perf_counter() - start
+            start = time.perf_counter()
+            stats = local_runner.run(['--input', path, '--output_dir', incremental, '--incremental']
+                                     + common)
+            incremental_time = time.perf_counter() - start
+            print(f"{month:5d} {stats['comments']:9d} {full_time:7.2f}s {incremental_time:11.2f}s "
+                  f"{stats['threads']:8d} {stats['examples']:13d}")
+            for split in ('train', 'valid'):
+                if read_manifest(incremental, split, args.format) != read_split(full, split, args.format):
+                    print(f"month {month}: incremental {split} examples differ from a full build")
+                    failed = True
+
+        # adding a month twice must not add examples again
+        stats = local_runner.run(['--input', paths[-1], '--output_dir', incremental, '--incremental']
+                                 + common)
+        if stats['examples']:
+            print(f"adding the last month again created {stats['examples']} examples")
+            failed = True
+    print('ok' if not failed else 'MISMATCH')
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
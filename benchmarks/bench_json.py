@@ -0,0 +1,69 @@
+"""
+Throughput of the projected record decoder of build.py against full decoding.
+
+Decodes pushshift-shaped submission lines from ``benchmarks.corpus``, with
+every field of a record, link posts with previews and over_18 submissions,
+as bytes like the build.py readers hand them over:
+
+* ``json.loads`` of the whole line, the previous ``parse_record``,
+* ``preprocess.records.RecordDecoder`` decoding whole lines and projected,
+  with the standard library and with orjson when it is installed.
+
+Checks that every decoder returns the titles and bodies of the previous
+path and rejects the same records, exits with status 1 otherwise.
+
+    python -m benchmarks.bench_json --records 20000
+"""
+
+import argparse
+import json
+import sys
+import time
+
+from benchmarks.corpus import Corpus
+from preprocess import records
+
+
+def previous(line: bytes):
+    data = json.loads(line)
+    if data['over_18']:
+        return None
+    return data['title'], data['selftext']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--records', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    lines = [json.dumps(record).encode('utf-8') for record in Corpus(args.seed).submissions(args.records)]
+    print(f"{len(lines)} lines, {sum(map(len, lines)) / len(lines):.0f} bytes per line")
+    decoders = {'json.loads': previous}
+    for backend in sorted(records.BACKENDS):
+        for project in (False, True):
+            decoder = records.RecordDecoder(('title', 'selftext'), 'over_18', backend, project)
+            decoders[f"{backend}{' projected' if project else ''}"] = decoder.decode
+
+    best = dict.fromkeys(decoders, float('inf'))
+    results = {}
+    for _ in range(args.repeat):
+        # interleaved, so a noisy machine slows every decoder alike
+        for name, decode in decoders.items():
+            start = time.perf_counter()
+            results[name] = [decode(line) for line in lines]
+            best[name] = min(best[name], time.perf_counter() - start)
+    failed = False
+    for name, elapsed in best.items():
+        print(f"{name:18s} {len(lines) / elapsed:9.0f} records/s {best['json.loads'] / elapsed:5.1f}x")
+        if results[name] != results['json.loads']:
+            print(f"  {name} decodes differently from json.loads")
+            failed = True
+    print(f"{sum(result is None for result in results['json.loads'])} over_18 records rejected")
+    print('ok' if not failed else 'MISMATCH')
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
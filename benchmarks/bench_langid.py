@@ -0,0 +1,151 @@
+"""
+Speed of the language identification backends and their agreement with
+langdetect.
+
+Agreement is measured on a held-out sample of real submissions: a seeded
+reservoir sample of the titles and bodies of the pushshift archives given
+with ``--archive`` which reach the language check of build.py, that is
+unmarked and passing every other filter rule. The model is built from the
+langdetect profiles only, no submission is used to build or tune it.
+``--input`` takes texts one per line instead. Without either, the few
+texts below only time the backends, their agreement is no estimate.
+
+    python -m benchmarks.bench_langid --archive RS_2019-01.zst --sample 20000
+"""
+
+import argparse
+import random
+import time
+
+from preprocess import filters, langid, records, stream
+from unmark import unmark
+
+EN = """Anyone else having trouble logging in?
+TIL honey never spoils
+Best budget GPU for 1440p gaming?
+My cat keeps knocking things off the table, how do I stop this
+Just finished my first marathon!
+Why is the sky blue?
+Help identifying this plant please
+Looking for recommendations on a good mechanical keyboard
+What's your favorite movie from the 90s
+Can someone explain how compound interest works
+The new season was a huge disappointment honestly
+I built a shed in my backyard this weekend
+Is it normal for my car to make this noise when braking
+Thoughts on the latest patch notes?
+Need advice about moving to a new city for work
+Finally got my driver's license after three attempts
+Does anyone know a good recipe for banana bread
+Landlord won't fix the heating, what are my rights
+Fantastic sunset over the lake tonight
+Question about taxes for freelancers
+Weekly discussion thread
+Stuck on level 42, any tips
+Selling my old bike, how much should I ask
+Pictures from my trip to Iceland
+Rate my setup
+Microsoft announces new Surface lineup
+Scientists discover water on distant exoplanet
+Free games this week on the Epic store
+Unpopular opinion: pineapple belongs on pizza
+First time homebuyer checklist""".split('\n')
+OTHER = """Este es un texto en español que no debería pasar el filtro.
+¿Alguien sabe dónde puedo comprar una bicicleta barata?
+Ceci est un message en français publié sur un forum.
+Quelqu'un connaît un bon restaurant à Paris ?
+Das ist ein deutscher Satz über das Wetter.
+Weiß jemand, wie man das Problem lösen kann?
+Questo è un testo italiano sul tempo.
+Qualcuno sa come risolvere questo problema?
+Dit is een Nederlandse zin over het weer.
+Ja, det är en svensk mening om vädret.
+Alguém sabe onde comprar um carro usado barato?
+Czy ktoś wie, jak rozwiązać ten problem?
+Это русский текст о погоде
+これは日本語のテキストです
+这是一个中文句子
+Bu bir Türkçe cümledir ve hava hakkında konuşur.
+Onko kenelläkään kokemusta tästä puhelimesta?
+Hej, er der nogen der kan hjælpe mig med min computer?""".split('\n')
+
+
+def corpus_sample(paths: list, size: int, seed: int = 0) -> list:
+    """Reservoir sample of ``size`` texts of the archives, as the language check of build.py sees them."""
+    rng = random.Random(seed)
+    chain = filters.FilterChain()
+    decoder = records.RecordDecoder(('title', 'selftext'), reject='over_18')
+    sample = []
+    seen = 0
+    for path in paths:
+        with stream.open_compressed(path) as fp:
+            for lines in stream.iter_batches(fp):
+                texts = []
+                for line in lines:
+                    try:
+                        record = decoder.decode(line)
+                        if record is not None:
+                            texts.extend(unmark(text.strip()) for text in record)
+                    except (ValueError, KeyError, TypeError, AttributeError, IndexError, RecursionError):
+                        continue
+                for text in chain.filter_batch(texts):
+                    if not text:
+                        continue
+                    seen += 1
+                    if len(sample) < size:
+                        sample.append(text)
+                    else:
+                        position = rng.randrange(seen)
+                        if position < size:
+                            sample[position] = text
+    print(f"{len(sample)} texts sampled of {seen} reaching the language check")
+    return sample
+
+
+def records_per_sec(identifier, texts, batch_size):
+    start = time.perf_counter()
+    for i in range(0, len(texts), batch_size):
+        identifier.detect_batch(texts[i:i + batch_size])
+    return len(texts) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--archive', nargs='*', default=[],
+                        help='pushshift submission archives to sample the texts from.')
+    parser.add_argument('--sample', type=int, default=20000,
+                        help='number of texts sampled from --archive.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--input', type=str, default=None,
+                        help='file with one text per line to use as sample.')
+    args = parser.parse_args()
+
+    if args.archive:
+        sample = corpus_sample(args.archive, args.sample, args.seed)
+    elif args.input:
+        with open(args.input, encoding='utf-8') as fp:
+            sample = [line.strip() for line in fp if line.strip()]
+    else:
+        print("timing only, pass --archive for the agreement on real submissions")
+        sample = EN + OTHER
+    reference = langid.LangdetectIdentifier()
+    expected = reference.detect_batch(sample)
+
+    backends = [
+        ('langdetect', reference),
+        ('ngram', langid.NgramIdentifier(precheck=False)),
+        ('ngram+precheck', langid.NgramIdentifier()),
+    ]
+    texts = sample * args.repeat
+    for name, identifier in backends:
+        got = identifier.detect_batch(sample)
+        exact = sum(g == e for g, e in zip(got, expected)) / len(sample)
+        english = sum((g == 'en') == (e == 'en') for g, e in zip(got, expected)) / len(sample)
+        rate = records_per_sec(identifier, texts, args.batch_size)
+        print(f"{name:15s} {rate:10.0f} records/s  agreement {exact:6.1%}  en/not-en {english:6.1%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""
+Compare the local runner of create_data.py with the Beam DirectRunner.
+
+Writes synthetic comments as a zstd compressed JSON lines archive and
+creates the dataset with both engines. The local runner is run a second
+time with a small memory budget and a single spill group, to spill many
+partitions and sort the spill files in runs on disk. Checks that the shard
+files have the same names, that every split holds the same examples and
+that the TFRecord checksums are valid. Exits with status 1 otherwise.
+
+    python -m benchmarks.bench_local_runner --comments 20000 --format JSON
+"""
+
+import argparse
+import glob
+import gzip
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter
+
+import pyarrow.parquet as pq
+import zstandard as zstd
+from apache_beam.io.tfrecordio import _TFRecordUtil
+
+from benchmarks.bench_skew import raw_comments
+from benchmarks.bench_stream import WORDS
+from benchmarks.bench_tfrecord import example_class, read_tfrecords, to_dict
+from reddit import create_data, local_runner
+
+
+def check_tfrecords(path: str):
+    """Read the records of a gzip compressed TFRecord file with Beam, which checks the CRCs."""
+    with gzip.open(path, 'rb') as fp:
+        while _TFRecordUtil.read_record(fp) is not None:
+            pass
+
+
+def read_split(output_dir: str, split: str, dataset_format: str) -> Counter:
+    examples = Counter()
+    if dataset_format == 'JSON':
+        for path in glob.glob(os.path.join(output_dir, f'{split}-*.json')):
+            with open(path) as fp:
+                examples.update(fp.read().splitlines())
+    elif dataset_format == 'TF':
+        Example = example_class()
+        for path in glob.glob(os.path.join(output_dir, f'{split}-*.tfrecord.gz')):
+            check_tfrecords(path)
+            examples.update(json.dumps(to_dict(Example.FromString(record)), sort_keys=True)
+                            for record in read_tfrecords(path))
+    else:
+        for path in glob.glob(os.path.join(output_dir, f'{split}-*.parquet')):
+            examples.update(json.dumps(row, sort_keys=True) for row in pq.read_table(path).to_pylist())
+    return examples
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--comments', type=int, default=20000)
+    parser.add_argument('--threads', type=int, default=2000)
+    parser.add_argument('--format', default='JSON', choices=['JSON', 'TF', 'PARQUET'])
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    rows = raw_comments(rng, args.comments, args.threads)
+    for row in rows:
+        row['body'] = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 20)))
+    common = ['--dataset_format', args.format, '--num_shards_train', '8', '--num_shards_test', '2',
+              '--seed', str(args.seed)]
+    processes = ['--processes', str(args.processes)] if args.processes else []
+
+    with tempfile.TemporaryDirectory() as root:
+        archive = os.path.join(root, 'RC_comments.zst')
+        with open(archive, 'wb') as fw:
+            data = ''.join(json.dumps(row) + '\n' for row in rows).encode('utf-8')
+            fw.write(zstd.ZstdCompressor().compress(data))
+
+        runs = {}
+        start = time.perf_counter()
+        create_data.run(['--reddit_table', 'unused:unused.unused',
+                         '--output_dir', os.path.join(root, 'direct')] + common, comments=rows)
+        runs['DirectRunner'] = time.perf_counter() - start
+        start = time.perf_counter()
+        stats = local_runner.run(['--input', archive, '--output_dir', os.path.join(root, 'local')]
+                                 + common + processes)
+        runs['local runner'] = time.perf_counter() - start
+        spill_groups = local_runner.MAX_SPILL_GROUPS
+        local_runner.MAX_SPILL_GROUPS = 1
+        try:
+            local_runner.run(['--input', archive, '--output_dir', os.path.join(root, 'spilled'),
+                              '--memory_budget', '1'] + common + processes)
+        finally:
+            local_runner.MAX_SPILL_GROUPS = spill_groups
+
+        for name, elapsed in runs.items():
+            print(f"{name:13s} {elapsed:7.2f}s  {stats['comments'] / elapsed:9.0f} comments/s")
+        failed = False
+        names = {d: sorted(os.listdir(os.path.join(root, d))) for d in ('direct', 'local', 'spilled')}
+        if not names['direct'] == names['local'] == names['spilled']:
+            print(f"shard files differ: {names}")
+            failed = True
+        for split in ('train', 'valid'):
+            direct = read_split(os.path.join(root, 'direct'), split, args.format)
+            for other in ('local', 'spilled'):
+                if read_split(os.path.join(root, other), split, args.format) != direct:
+                    print(f"{other} {split} examples differ from the DirectRunner ones")
+                    failed = True
+        print(f"{stats['examples']} examples, {len(names['local'])} shard files  "
+              f"{'ok' if not failed else 'MISMATCH'}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
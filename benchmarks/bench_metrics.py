@@ -0,0 +1,111 @@
+"""
+Check the pipeline metrics and run report of create_data.py on the DirectRunner.
+
+Runs the pipeline on synthetic threads, with deleted, short and overlong
+comments, once whole and once splitting the megathread with
+``--hot_thread_size``, both with ``--profile`` and ``--run_report``. Checks
+the report against the written examples and the comments: skip reasons,
+thread sizes, examples per thread and context depths. Exits with status 1
+if a check fails.
+
+    python -m benchmarks.bench_metrics --comments 5000
+"""
+
+import argparse
+import glob
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter
+
+from benchmarks.bench_skew import raw_comments
+from benchmarks.bench_stream import WORDS
+from reddit import create_data
+
+
+def make_rows(rng: random.Random, comments: int, threads: int) -> list:
+    rows = raw_comments(rng, comments, threads)
+    for row in rows:
+        kind = rng.random()
+        if kind < 0.05:
+            row['body'] = rng.choice(['[deleted]', '[removed]'])
+        elif kind < 0.1:
+            row['body'] = 'ok'
+        elif kind < 0.15:
+            row['body'] = ' '.join(rng.choice(WORDS) for _ in range(60))
+        else:
+            row['body'] = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 15)))
+    return rows
+
+
+def check(report: dict, rows: list, output_dir: str, split: bool) -> list:
+    """Return the checks of ``report`` which fail."""
+    counters, distributions = report['counters'], report['distributions']
+    errors = []
+    examples = []
+    for path in glob.glob(os.path.join(output_dir, '*.json')):
+        if not path.endswith('report.json'):
+            with open(path) as fp:
+                examples.extend(json.loads(line) for line in fp)
+    reasons = Counter(create_data._skip_reason(create_data.normalise_comment(row, 127), 9) for row in rows)
+
+    def expect(name, actual, expected):
+        if actual != expected:
+            errors.append(f"{name}: {actual} in the report, {expected} expected")
+
+    expect('examples', counters.get('examples'), len(examples))
+    expect('comments', counters.get('comments'), len(rows))
+    for reason in ('trimmed', 'deleted', 'too_short'):
+        expect(f'skipped_{reason}', counters.get(f'skipped_{reason}', 0), reasons[reason])
+    expect('examples_per_thread sum', distributions['examples_per_thread']['sum'], len(examples))
+    expect('context_depth count', distributions['context_depth']['count'], len(examples))
+    depths = [1 + sum(1 for key in example if key.startswith('context/')) for example in examples]
+    expect('context_depth sum', distributions['context_depth']['sum'], sum(depths))
+    threads = Counter(row['link_id'] for row in rows)
+    if not split:
+        expect('thread_size count', distributions['thread_size']['count'], len(threads))
+        expect('thread_size max', distributions['thread_size']['max'], max(threads.values()))
+        expect('thread_size sum', distributions['thread_size']['sum'], len(rows))
+    if not counters.get('slow_threads'):
+        errors.append('no slow thread with --slow_thread_ms 1')
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--comments', type=int, default=5000)
+    parser.add_argument('--threads', type=int, default=500)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rows = make_rows(random.Random(args.seed), args.comments, args.threads)
+    failed = False
+    with tempfile.TemporaryDirectory() as root:
+        for name, extra in (('whole', []), ('split', ['--hot_thread_size', '500'])):
+            output_dir = os.path.join(root, name)
+            report_path = os.path.join(output_dir, 'report.json')
+            start = time.perf_counter()
+            create_data.run(['--reddit_table', 'unused:unused.unused', '--output_dir', output_dir,
+                             '--dataset_format', 'JSON', '--num_shards_train', '1', '--num_shards_test', '1',
+                             '--profile', '--slow_thread_ms', '1', '--run_report', report_path] + extra,
+                            comments=rows)
+            elapsed = time.perf_counter() - start
+            with open(report_path) as fp:
+                report = json.load(fp)
+            usecs = report['distributions']['create_examples_usecs']
+            print(f"{name:6s} {elapsed:6.2f}s  {report['counters']['examples']} examples, "
+                  f"{usecs['count']} threads in {usecs['sum'] / 1e6:.2f}s, slowest {usecs['max'] / 1e3:.0f} ms, "
+                  f"{report['counters']['slow_threads']} slow")
+            errors = check(report, rows, output_dir, name == 'split')
+            for error in errors:
+                print(f"  {error}")
+            failed = failed or bool(errors)
+    print('ok' if not failed else 'MISMATCH')
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+Compare the Parquet and JSON datasets of create_data.py.
+
+Writes both formats with the DirectRunner from the same synthetic comments,
+then reports their size and the time to load them: every JSON line parsed,
+against the Parquet shards read whole and with only the response column.
+Exits with status 1 if the Parquet rows don't hold the JSON examples.
+
+    python -m benchmarks.bench_parquet --comments 50000
+"""
+
+import argparse
+import glob
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from benchmarks.bench_skew import raw_comments, run_pipeline
+from benchmarks.bench_stream import WORDS
+
+
+def to_example(row: dict) -> dict:
+    """The JSON example of a Parquet row."""
+    example = {key: value for key, value in row.items() if key != 'extra_contexts'}
+    for i, context in enumerate(row['extra_contexts']):
+        example[f'context/{i}'] = context
+    return example
+
+
+def load_json(output_dir: str) -> list:
+    examples = []
+    for path in glob.glob(os.path.join(output_dir, '*.json')):
+        with open(path) as fp:
+            examples.extend(json.loads(line) for line in fp)
+    return examples
+
+
+def load_parquet(output_dir: str, columns: list = None) -> pa.Table:
+    return pa.concat_tables(pq.read_table(path, columns=columns, memory_map=True)
+                            for path in glob.glob(os.path.join(output_dir, '*.parquet')))
+
+
+def size(output_dir: str) -> int:
+    return sum(os.path.getsize(path) for path in glob.glob(os.path.join(output_dir, '*-of-*')))
+
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--comments', type=int, default=50000)
+    parser.add_argument('--threads', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    rows = raw_comments(rng, args.comments, args.threads)
+    for row in rows:
+        row['body'] = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(2, 20)))
+        row['author'] = f'user{rng.randrange(2000)}'
+        row['subreddit'] = rng.choice(['AskReddit', 'MachineLearning', 'news', 'pics'])
+
+    with tempfile.TemporaryDirectory() as root:
+        json_dir, parquet_dir = os.path.join(root, 'json'), os.path.join(root, 'parquet')
+        run_pipeline(rows, json_dir, ['--dataset_format', 'JSON'])
+        run_pipeline(rows, parquet_dir, ['--dataset_format', 'PARQUET'])
+        examples, json_time = timed(load_json, json_dir)
+        table, parquet_time = timed(load_parquet, parquet_dir)
+        responses, projected_time = timed(load_parquet, parquet_dir, ['response'])
+        print(f"{len(examples)} examples")
+        print(f"JSON     {size(json_dir) / 1e6:7.2f} MB  load {json_time * 1000:7.1f} ms")
+        print(f"Parquet  {size(parquet_dir) / 1e6:7.2f} MB  load {parquet_time * 1000:7.1f} ms  "
+              f"response column {projected_time * 1000:7.1f} ms")
+
+    expected = Counter(json.dumps(example, sort_keys=True) for example in examples)
+    got = Counter(json.dumps(to_example(row), sort_keys=True) for row in table.to_pylist())
+    same = got == expected and responses.num_rows == len(examples)
+    print('rows match the JSON examples' if same else 'rows MISMATCH the JSON examples')
+    sys.exit(0 if same else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+Compare the pipelined scheduler of build.py with one archive at a time.
+
+Serves synthetic monthly archives from a throttled local HTTP server and
+uploads to a local directory bucket, so it runs offline.
+
+    python -m benchmarks.bench_pipeline --files 6 --records 20000 --rate 4
+"""
+
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+
+import zstandard as zstd
+
+import build
+from benchmarks.bench_stream import make_record
+from benchmarks.http_fixture import serve
+from gcp.local_storage import LocalStorage_Service
+from preprocess.manifest import ProcessingManifest
+
+
+def write_archives(dpath: str, files: int, records: int, seed: int = 0) -> list:
+    rng = random.Random(seed)
+    names = []
+    for i in range(files):
+        raw = ''.join(json.dumps(make_record(rng)) + '\n' for _ in range(records)).encode('utf-8')
+        name = f'RS_2011-{i + 1:02d}.zst'
+        with open(os.path.join(dpath, name), 'wb') as fw:
+            fw.write(zstd.ZstdCompressor(level=3).compress(raw))
+        names.append(name)
+    return names
+
+
+def setup(url: str, names: list, dpath: str, bucket: str, extra: list):
+    build.args = build.parser.parse_args(['--dpath', dpath, '--gcs-path', 'processed', '--cleanup'] + extra)
+    build.gcp = LocalStorage_Service(bucket)
+    os.makedirs(dpath, exist_ok=True)
+    build.manifest = ProcessingManifest(os.path.join(dpath, 'manifest.json'))
+    build.datasets_link.clear()
+    for name in names:
+        build.datasets_link[name]['link'] = url + name
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--files', type=int, default=6)
+    parser.add_argument('--records', type=int, default=20000)
+    parser.add_argument('--rate', type=float, default=4,
+                        help='MB/s per download connection.')
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+    workers = ['--workers', str(args.workers)] if args.workers else []
+
+    with tempfile.TemporaryDirectory() as root:
+        served = os.path.join(root, 'served')
+        os.makedirs(served)
+        names = write_archives(served, args.files, args.records)
+        total = sum(os.path.getsize(os.path.join(served, name)) for name in names)
+        print(f"{args.files} archives, {total / 1e6:.1f} MB served at {args.rate} MB/s per connection")
+
+        with serve(served, bytes_per_second=args.rate * 1024 * 1024) as url:
+            setup(url, names, os.path.join(root, 'sequential'), os.path.join(root, 'bucket-a'), workers)
+            start = time.perf_counter()
+            for name in names:
+                build.upload_stage(build.preprocess_stage(build.download_stage(name)))
+            sequential = time.perf_counter() - start
+            print(f"sequential {sequential:8.2f}s")
+
+            setup(url, names, os.path.join(root, 'pipeline'), os.path.join(root, 'bucket-b'),
+                  workers + ['--disk-budget', str(4 * total / 1024 ** 3)])
+            start = time.perf_counter()
+            stats = build.distributed_download(build.datasets_link)
+            pipelined = time.perf_counter() - start
+            print(f"pipeline   {pipelined:8.2f}s  ({sequential / pipelined:.1f}x), {stats}")
+
+        # the .stats.json sidecars hold timings, they differ between runs
+        a = [blob for blob in build.gcp.list_files('processed') if not blob.endswith('.stats.json')]
+        assert len(a) == args.files, a
+        for blob in a:
+            with open(os.path.join(root, 'bucket-a', blob), 'rb') as fa, \
+                    open(os.path.join(root, 'bucket-b', blob), 'rb') as fb:
+                assert fa.read() == fb.read(), blob
+
+
+if __name__ == "__main__":
+    main()
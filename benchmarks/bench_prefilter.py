@@ -0,0 +1,74 @@
+"""
+Measure the bytes of comments grouped by thread in create_data.py.
+
+Runs the pipeline with the DirectRunner and --shuffle_metrics over synthetic
+comments, a share of them deleted, removed, too long or too short, and reads
+the comment, skeleton and shuffle byte counters from the pipeline metrics.
+They are compared with the size of the same comments pickled whole, as
+they were grouped before the prefilter and CommentCoder.
+
+    python -m benchmarks.bench_prefilter --comments 20000
+"""
+
+import argparse
+import random
+import tempfile
+
+from apache_beam.coders.coders import FastPrimitivesCoder
+from apache_beam.metrics.metric import MetricsFilter
+
+from benchmarks.bench_skew import raw_comments
+from benchmarks.bench_stream import WORDS
+from reddit import create_data
+
+
+def counter(result, name: str) -> int:
+    counters = result.metrics().query(MetricsFilter().with_name(name))['counters']
+    return sum(c.committed for c in counters)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--comments', type=int, default=20000)
+    parser.add_argument('--threads', type=int, default=1000)
+    parser.add_argument('--max-length', type=int, default=127)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    rows = raw_comments(rng, args.comments, args.threads)
+    for row in rows:
+        kind = rng.random()
+        if kind < 0.15:
+            row['body'] = rng.choice(['[deleted]', '[removed]'])
+        elif kind < 0.25:
+            row['body'] = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(40, 80)))
+        elif kind < 0.3:
+            row['body'] = rng.choice(['ok', 'lol', 'yes'])
+        else:
+            row['body'] = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 20)))
+        row['author'] = f'user_{rng.randrange(5000)}'
+        row['subreddit'] = rng.choice(['AskReddit', 'MachineLearning', 'worldnews'])
+
+    coder = FastPrimitivesCoder()
+    pickled = 0
+    for row in rows:
+        comment = create_data.normalise_comment(row, args.max_length)
+        pickled += len(coder.encode((comment.thread_id, comment)))
+
+    with tempfile.TemporaryDirectory() as root:
+        result = create_data.run([
+            '--reddit_table', 'unused:unused.unused', '--output_dir', root, '--dataset_format', 'JSON',
+            '--num_shards_train', '1', '--num_shards_test', '1', '--max_length', str(args.max_length),
+            '--shuffle_metrics',
+        ], comments=rows)
+    comments = counter(result, 'comments')
+    skeletons = counter(result, 'skeleton_comments')
+    shuffled = counter(result, 'thread_shuffle_bytes')
+    print(f"comments          {comments}, {skeletons} skeletons ({skeletons / comments:.0%})")
+    print(f"pickled comments  {pickled / 1e6:8.2f} MB")
+    print(f"thread shuffle    {shuffled / 1e6:8.2f} MB  ({pickled / shuffled:.1f}x smaller)")
+
+
+if __name__ == "__main__":
+    main()
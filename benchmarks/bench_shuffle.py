@@ -0,0 +1,99 @@
+"""
+Compare the bucketed shuffle of create_data.py with a uuid4 keyed one.
+
+Runs both shuffles over synthetic examples with the DirectRunner and reports
+the wall time, the bytes of the encoded key/value pairs which are shuffled,
+and the number of groups, which must be at most ``--buckets``. Then checks that two runs of create_data.py with
+the same seed write the same train and valid sets and that no thread is in
+both. Exits with status 1 otherwise.
+
+    python -m benchmarks.bench_shuffle --examples 20000
+"""
+
+import argparse
+import glob
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import uuid
+
+import apache_beam as beam
+from apache_beam.coders.coders import FastPrimitivesCoder
+
+from benchmarks.bench_skew import raw_comments, run_pipeline
+from benchmarks.bench_tfrecord import make_examples
+from reddit import create_data
+
+
+def uuid_shuffle(pcollection):
+    """The previous shuffle, a uuid4 key and a group per example."""
+    pcollection |= "add random key" >> beam.Map(lambda value: (uuid.uuid4(), value))
+    pcollection |= "group by key" >> beam.GroupByKey()
+    pcollection |= "get shuffled values" >> beam.FlatMap(lambda t: t[1])
+    return pcollection
+
+
+def run_shuffle(shuffle, examples: list) -> float:
+    start = time.perf_counter()
+    with beam.Pipeline() as p:
+        shuffled = shuffle(p | beam.Create(examples))
+        shuffled | beam.combiners.Count.Globally()
+    return time.perf_counter() - start
+
+
+def read_split(output_dir: str, split: str) -> list:
+    lines = []
+    for path in glob.glob(os.path.join(output_dir, f'{split}-*.json')):
+        with open(path) as fp:
+            lines.extend(fp.read().splitlines())
+    return sorted(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--examples', type=int, default=20000)
+    parser.add_argument('--buckets', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    examples = make_examples(random.Random(args.seed), args.examples)
+    for i, example in enumerate(examples):
+        example['thread_id'] = f't{i % 5000}'
+    coder = FastPrimitivesCoder()
+    uuid_bytes = sum(len(coder.encode((uuid.uuid4(), example))) for example in examples)
+    keyed = [create_data._bucket_example(example, args.seed, args.buckets) for example in examples]
+    bucket_bytes = sum(len(coder.encode(pair)) for pair in keyed)
+    groups = len({key for key, _ in keyed})
+    uuid_time = run_shuffle(uuid_shuffle, examples)
+    bucket_time = run_shuffle(
+        lambda pcollection: create_data._shuffle(pcollection, args.seed, args.buckets), examples)
+    print(f"uuid4    {uuid_time:6.2f}s  {uuid_bytes / 1e6:7.2f} MB shuffled  {len(examples)} groups")
+    print(f"buckets  {bucket_time:6.2f}s  {bucket_bytes / 1e6:7.2f} MB shuffled  {groups} groups")
+    assert groups <= args.buckets, f"{groups} groups for {args.buckets} buckets"
+
+    # a bucket larger than the buffer is still shuffled, the same way for the same seed
+    bucket = (0, examples[:300])
+    once = list(create_data._shuffled_bucket(bucket, args.seed, buffer_size=50))
+    again = list(create_data._shuffled_bucket(bucket, args.seed, buffer_size=50))
+    assert sorted(map(id, once)) == sorted(map(id, bucket[1])), "examples lost by the bucket shuffle"
+    assert once == again and once != bucket[1], "the bucket shuffle isn't seeded"
+
+    rows = raw_comments(random.Random(args.seed), 5000, 500)
+    with tempfile.TemporaryDirectory() as root:
+        extra = ['--seed', str(args.seed), '--num_shards_train', '3']
+        run_pipeline(rows, os.path.join(root, 'a'), extra)
+        run_pipeline(rows, os.path.join(root, 'b'), extra)
+        same = all(read_split(os.path.join(root, 'a'), split) == read_split(os.path.join(root, 'b'), split)
+                   for split in ('train', 'valid'))
+        train = {json.loads(line)['thread_id'] for line in read_split(os.path.join(root, 'a'), 'train')}
+        valid = {json.loads(line)['thread_id'] for line in read_split(os.path.join(root, 'a'), 'valid')}
+    print(f"reruns give the same splits: {same}, threads in both splits: {len(train & valid)}, "
+          f"{len(train)} train and {len(valid)} valid threads")
+    sys.exit(0 if same and not train & valid else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""
+Check that splitting hot threads gives the examples of the unsplit pipeline.
+
+Builds a skewed input, one megathread and many small threads, splits the
+megathread in process and compares the examples of its shards with the
+examples of the whole thread. Then runs create_data.py with the
+DirectRunner, with and without --hot_thread_size, and compares the written
+datasets. Exits with status 1 on any difference.
+
+    python -m benchmarks.bench_skew --comments 20000 --hot-thread-size 500
+"""
+
+import argparse
+import glob
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+
+from benchmarks.bench_threads import synthetic_thread
+from reddit import create_data
+
+
+def split_examples(thread, max_size, parent_depth, min_length):
+    """The examples of a thread split into shards, and the shard sizes."""
+    nodes = [create_data.ThreadNode(comment.id, comment.parent_id) for comment in thread]
+    by_id = {comment.id: comment for comment in thread}
+    shards = defaultdict(list)
+    for (_, comment_id), (shard, owned) in create_data.assign_shards(('thread', nodes), max_size, parent_depth):
+        shards[shard].append((by_id[comment_id], owned))
+    examples = []
+    for shard in shards.values():
+        examples.extend(create_data.create_shard_examples(shard, parent_depth, min_length, 'JSON'))
+    return examples, [len(shard) for shard in shards.values()]
+
+
+def raw_comments(rng: random.Random, comments: int, threads: int) -> list:
+    """BigQuery like rows, a megathread of ``comments`` and ``threads`` small threads."""
+    rows = []
+
+    def add(thread_id, comment):
+        parent = comment.parent_id
+        rows.append({
+            'id': comment.id, 'link_id': 't3_' + thread_id,
+            'parent_id': ('t3_' + thread_id) if parent == 'thread' else 't1_' + parent,
+            'body': comment.body, 'author': comment.author, 'subreddit': 'AskReddit',
+        })
+
+    for comment in synthetic_thread('random', comments, seed=rng.randrange(1 << 30)):
+        add('mega', comment)
+    for i in range(threads):
+        for comment in synthetic_thread('random', rng.randint(2, 30), seed=rng.randrange(1 << 30)):
+            add(f'small{i}', comment._replace(id=f'{i}-{comment.id}',
+                                              parent_id=comment.parent_id if comment.parent_id == 'thread'
+                                              else f'{i}-{comment.parent_id}'))
+    rng.shuffle(rows)
+    return rows
+
+
+def run_pipeline(rows: list, output_dir: str, extra: list) -> Counter:
+    create_data.run([
+        '--reddit_table', 'unused:unused.unused', '--output_dir', output_dir,
+        '--dataset_format', 'JSON', '--num_shards_train', '1', '--num_shards_test', '1',
+    ] + extra, comments=rows)
+    lines = Counter()
+    for path in glob.glob(os.path.join(output_dir, '*.json')):
+        with open(path) as fp:
+            lines.update(json.dumps(json.loads(line), sort_keys=True) for line in fp)
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--comments', type=int, default=20000)
+    parser.add_argument('--threads', type=int, default=200)
+    parser.add_argument('--hot-thread-size', type=int, default=500)
+    parser.add_argument('--parent-depth', type=int, default=10)
+    parser.add_argument('--min-length', type=int, default=9)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    failed = False
+
+    for kind in ('wide', 'deep', 'random'):
+        thread = synthetic_thread(kind, args.comments, args.seed)
+        expected = create_data.create_examples(thread, args.parent_depth, args.min_length, 'JSON')
+        expected = Counter(json.dumps(example, sort_keys=True) for example in expected)
+        got, sizes = split_examples(thread, args.hot_thread_size, args.parent_depth, args.min_length)
+        got = Counter(json.dumps(example, sort_keys=True) for example in got)
+        same = got == expected
+        failed |= not same
+        print(f"{kind:6s} {len(sizes)} shards of at most {max(sizes)} comments, "
+              f"{sum(expected.values())} examples  {'ok' if same else 'MISMATCH'}")
+
+    rows = raw_comments(random.Random(args.seed), args.comments, args.threads)
+    with tempfile.TemporaryDirectory() as root:
+        start = time.perf_counter()
+        unsplit = run_pipeline(rows, os.path.join(root, 'unsplit'), [])
+        unsplit_time = time.perf_counter() - start
+        start = time.perf_counter()
+        split = run_pipeline(rows, os.path.join(root, 'split'),
+                             ['--hot_thread_size', str(args.hot_thread_size)])
+        split_time = time.perf_counter() - start
+    same = split == unsplit
+    failed |= not same
+    print(f"DirectRunner {len(rows)} comments, {sum(unsplit.values())} examples  "
+          f"unsplit {unsplit_time:.1f}s  split {split_time:.1f}s  {'ok' if same else 'MISMATCH'}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
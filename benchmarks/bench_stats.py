@@ -0,0 +1,137 @@
+"""
+Check the stage timings and rejection reasons of the build.py sidecars.
+
+Runs synthetic archives, with truncated and incomplete records mixed in,
+through the build.py stages against a local bucket, once writing plain
+outputs and once streaming zst outputs. Prints the stages of the first
+archive and checks that every ``.stats.json`` sidecar was uploaded next to
+its output, that kept and rejected records add up to the records read, that
+the parse errors are counted by type and that as many records are kept as
+``preprocess_data`` keeps one at a time. Exits with status 1 if a check fails.
+
+    python -m benchmarks.bench_stats --files 2 --records 20000
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter
+
+import zstandard as zstd
+
+import build
+from benchmarks.bench_pipeline import setup
+from benchmarks.bench_stream import make_record
+from benchmarks.http_fixture import serve
+from preprocess import metrics
+
+MODES = [('plain', []), ('zst', ['--compression', 'zst'])]
+
+
+def make_lines(rng: random.Random, records: int) -> list:
+    lines = []
+    for _ in range(records):
+        line = json.dumps(make_record(rng))
+        kind = rng.random()
+        if kind < 0.01:
+            line = line[:len(line) // 2]
+        elif kind < 0.02:
+            line = json.dumps({'id': 'x', 'over_18': False, 'selftext': 'no title here'})
+        lines.append(line)
+    return lines
+
+
+def expected_errors(lines: list) -> Counter:
+    errors = Counter()
+    for line in lines:
+        try:
+            build.parse_record(line)
+        except build.RECORD_ERRORS as e:
+            errors[f'parse_error:{type(e).__name__}'] += 1
+    return errors
+
+
+def check(report: dict, lines: list) -> list:
+    """Return the checks of ``report`` which fail."""
+    errors = []
+
+    def expect(name, actual, expected):
+        if actual != expected:
+            errors.append(f"{report['archive']} {name}: {actual} in the sidecar, {expected} expected")
+
+    rejections = report['rejections']
+    expect('records', report['lines'], len(lines))
+    expect('kept and rejected', report['written'] + sum(rejections.values()), len(lines))
+    expect('parse records in', report['stages']['parse']['records_in'], len(lines))
+    for reason, count in expected_errors(lines).items():
+        expect(reason, rejections.get(reason, 0), count)
+    expect('kept', report['written'], sum(1 for line in lines if build.preprocess_data(line)))
+    for kind in ('read', 'decompressed'):
+        if not report['bytes'].get(kind):
+            errors.append(f"{report['archive']}: no bytes {kind}")
+    return errors
+
+
+def print_report(report: dict):
+    print(f"  {'stage':9s} {'calls':>6s} {'in':>8s} {'out':>8s} {'wall':>7s} {'cpu':>7s} {'rec/s':>9s}")
+    for name, stage in report['stages'].items():
+        rate = stage['records_in'] / stage['wall'] if stage['wall'] else 0
+        print(f"  {name:9s} {stage['calls']:6d} {stage['records_in']:8d} {stage['records_out']:8d} "
+              f"{stage['wall']:6.2f}s {stage['cpu']:6.2f}s {rate:9.0f}")
+    for reason, count in sorted(report['rejections'].items(), key=lambda item: -item[1]):
+        print(f"  {reason:32s} {count:8d}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--files', type=int, default=2)
+    parser.add_argument('--records', type=int, default=20000)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    workers = ['--workers', str(args.workers)] if args.workers else []
+
+    rng = random.Random(args.seed)
+    failed = False
+    with tempfile.TemporaryDirectory() as root:
+        served = os.path.join(root, 'served')
+        os.makedirs(served)
+        archives = {}
+        for i in range(args.files):
+            name = f'RS_2011-{i + 1:02d}.zst'
+            archives[name] = make_lines(rng, args.records)
+            with open(os.path.join(served, name), 'wb') as fw:
+                fw.write(zstd.ZstdCompressor(level=3).compress(('\n'.join(archives[name]) + '\n').encode('utf-8')))
+        with serve(served) as url:
+            for mode, extra in MODES:
+                bucket = os.path.join(root, f'bucket-{mode}')
+                setup(url, list(archives), os.path.join(root, f'local-{mode}'), bucket, workers + extra)
+                start = time.perf_counter()
+                for name in archives:
+                    build.upload_stage(build.preprocess_stage(build.download_stage(name)))
+                elapsed = time.perf_counter() - start
+                print(f"{mode:6s} {elapsed:6.2f}s")
+                for i, name in enumerate(archives):
+                    sidecar = os.path.join(bucket, 'processed', metrics.sidecar_path(build.target_name(name)))
+                    if not os.path.isfile(sidecar):
+                        print(f"  no sidecar {sidecar}")
+                        failed = True
+                        continue
+                    with open(sidecar) as fp:
+                        report = json.load(fp)
+                    if i == 0:
+                        print_report(report)
+                    errors = check(report, archives[name])
+                    for error in errors:
+                        print(f"  {error}")
+                    failed = failed or bool(errors)
+    print('ok' if not failed else 'MISMATCH')
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+Compare the streaming engine with the previous dask reader of build.py.
+
+Writes a synthetic pushshift-like corpus as .zst, .bz2 and .xz and reports
+records/sec of both paths on each archive.
+
+    python -m benchmarks.bench_stream --records 50000
+"""
+
+import argparse
+import bz2
+import io
+import json
+import lzma
+import multiprocessing
+import os
+import random
+import tempfile
+import time
+
+import zstandard as zstd
+
+import build
+from preprocess import stream
+
+WORDS = ("the a to of and i you it that is was for on my this with have just "
+         "what like be not but so if they can do about me your one people get "
+         "would reddit time think know really thread post game anyone good").split()
+
+
+def make_record(rng: random.Random) -> dict:
+    title = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 15)))
+    selftext = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(0, 120)))
+    if rng.random() < 0.1:
+        selftext = '[deleted]'
+    if rng.random() < 0.05:
+        selftext += ' https://www.example.com/page'
+    return {
+        'id': '%x' % rng.getrandbits(32),
+        'over_18': rng.random() < 0.05,
+        'title': title.capitalize(),
+        'selftext': selftext,
+        'subreddit': 'AskReddit',
+        'score': rng.randint(0, 5000),
+    }
+
+
+def write_corpus(dpath: str, records: int, seed: int = 0) -> list:
+    rng = random.Random(seed)
+    raw = ''.join(json.dumps(make_record(rng)) + '\n' for _ in range(records)).encode('utf-8')
+    paths = []
+    for ext, compress in (('.zst', zstd.ZstdCompressor(level=3).compress),
+                          ('.bz2', bz2.compress),
+                          ('.xz', lzma.compress)):
+        path = os.path.join(dpath, 'RS_bench' + ext)
+        with open(path, 'wb') as fw:
+            fw.write(compress(raw))
+        paths.append(path)
+    return paths
+
+
+def dask_reader(path: str, out_path: str):
+    """
+    The reader build.py used before the streaming engine.
+
+    swifter is left out, its ``apply`` of a side-effecting lambda ends up as
+    a plain pandas ``apply`` anyway.
+    """
+    import pandas as pd
+    from dask import dataframe as dd
+
+    with open(out_path, 'w') as fw:
+        with stream.open_compressed(path) as fp:
+            text_stream = io.TextIOWrapper(fp, encoding='utf-8')
+            while True:
+                tmp = text_stream.readlines(50000000)
+                if not tmp:
+                    break
+                df = pd.DataFrame()
+                df['text'] = tmp
+                ddf = dd.from_pandas(df, npartitions=2*multiprocessing.cpu_count())
+                df['text'] = ddf.map_partitions(lambda df: (df.apply(lambda x: build.preprocess_data(x['text']), axis=1))).compute(scheduler='processes')
+                df['text'].apply(lambda x: fw.write(x + '\n') if x else None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--records', type=int, default=20000)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--skip-dask', action='store_true',
+                        help='only time the streaming engine.')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as dpath:
+        for path in write_corpus(dpath, args.records):
+            out_path = path + '.txt'
+            start = time.perf_counter()
+            stream.process_file(path, out_path, build.preprocess_batch, processes=args.workers)
+            elapsed = time.perf_counter() - start
+            print(f"{os.path.basename(path):14s} stream {args.records / elapsed:10.0f} records/s")
+            if args.skip_dask:
+                continue
+            start = time.perf_counter()
+            dask_reader(path, out_path)
+            elapsed = time.perf_counter() - start
+            print(f"{os.path.basename(path):14s} dask   {args.records / elapsed:10.0f} records/s")
+
+
+if __name__ == "__main__":
+    main()
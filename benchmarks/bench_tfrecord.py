@@ -0,0 +1,135 @@
+"""
+Compare the JSON and TFRecord outputs of create_data.py.
+
+Times the serialization of synthetic examples as JSON lines and as
+``tf.train.Example`` protos, then writes both datasets with the
+DirectRunner, reports their size on disk and reads the compressed TFRecord
+shards back. The protos are parsed with message classes built from the
+``tf.train.Example`` definition, so TensorFlow isn't needed. Exits with
+status 1 if the shards don't hold the examples of the JSON dataset.
+
+    python -m benchmarks.bench_tfrecord --examples 100000
+"""
+
+import argparse
+import glob
+import gzip
+import json
+import os
+import random
+import struct
+import sys
+import tempfile
+import time
+from collections import Counter
+
+from google.protobuf import descriptor_pb2, descriptor_pool, message_factory
+
+from benchmarks.bench_skew import raw_comments, run_pipeline
+from benchmarks.bench_stream import WORDS
+from reddit import create_data
+
+def example_class():
+    """``tf.train.Example`` and the messages it uses, built from their descriptors."""
+    proto = descriptor_pb2.FileDescriptorProto(name='example.proto', package='tensorflow', syntax='proto3')
+    bytes_list = proto.message_type.add(name='BytesList')
+    bytes_list.field.add(name='value', number=1, type=12, label=3)
+    for name, kind in (('FloatList', 2), ('Int64List', 3)):
+        message = proto.message_type.add(name=name)
+        message.field.add(name='value', number=1, type=kind, label=3)
+    feature = proto.message_type.add(name='Feature')
+    feature.oneof_decl.add(name='kind')
+    for name, number, type_name in (('bytes_list', 1, 'BytesList'), ('float_list', 2, 'FloatList'),
+                                    ('int64_list', 3, 'Int64List')):
+        feature.field.add(name=name, number=number, type=11, label=1,
+                          type_name=f'.tensorflow.{type_name}', oneof_index=0)
+    features = proto.message_type.add(name='Features')
+    entry = features.nested_type.add(name='FeatureEntry')
+    entry.options.map_entry = True
+    entry.field.add(name='key', number=1, type=9, label=1)
+    entry.field.add(name='value', number=2, type=11, label=1, type_name='.tensorflow.Feature')
+    features.field.add(name='feature', number=1, type=11, label=3, type_name='.tensorflow.Features.FeatureEntry')
+    example = proto.message_type.add(name='Example')
+    example.field.add(name='features', number=1, type=11, label=1, type_name='.tensorflow.Features')
+    pool = descriptor_pool.DescriptorPool()
+    pool.Add(proto)
+    return message_factory.GetMessageClass(pool.FindMessageTypeByName('tensorflow.Example'))
+
+
+def read_tfrecords(path: str):
+    """Yield the records of a gzip compressed TFRecord file."""
+    with gzip.open(path, 'rb') as fp:
+        while True:
+            header = fp.read(12)
+            if not header:
+                return
+            length, = struct.unpack('<Q', header[:8])
+            data = fp.read(length)
+            fp.read(4)
+            yield data
+
+
+def to_dict(example) -> dict:
+    return {key: feature.bytes_list.value[0].decode('utf-8')
+            for key, feature in example.features.feature.items()}
+
+
+def make_examples(rng: random.Random, count: int) -> list:
+    examples = []
+    for _ in range(count):
+        example = {
+            'subreddit': 'AskReddit', 'thread_id': 'abc123',
+            'context_author': 'someone', 'response_author': 'someone_else',
+            'context': ' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 25))),
+            'response': ' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 25))) + ' é',
+        }
+        for i in range(rng.randint(0, 9)):
+            example[f'context/{i}'] = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 25)))
+        examples.append(example)
+    return examples
+
+
+def dataset_size(output_dir: str) -> int:
+    return sum(os.path.getsize(path) for path in glob.glob(os.path.join(output_dir, '*-of-*')))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--examples', type=int, default=100000)
+    parser.add_argument('--comments', type=int, default=20000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    Example = example_class()
+
+    examples = make_examples(random.Random(args.seed), args.examples)
+    start = time.perf_counter()
+    as_json = [json.dumps(example) for example in examples]
+    json_time = time.perf_counter() - start
+    serialize = create_data.SerializeExampleFn()
+    serialize.setup()
+    start = time.perf_counter()
+    as_proto = [record for example in examples for record in serialize.process(example)]
+    proto_time = time.perf_counter() - start
+    print(f"JSON     {len(examples) / json_time:10.0f} records/s  {sum(map(len, as_json)) / len(examples):6.0f} B/record")
+    print(f"TFRecord {len(examples) / proto_time:10.0f} records/s  {sum(map(len, as_proto)) / len(examples):6.0f} B/record")
+    failed = any(to_dict(Example.FromString(record)) != example for record, example in zip(as_proto, examples))
+
+    rows = raw_comments(random.Random(args.seed), args.comments, 200)
+    with tempfile.TemporaryDirectory() as root:
+        json_dir = os.path.join(root, 'json')
+        tf_dir = os.path.join(root, 'tf')
+        expected = run_pipeline(rows, json_dir, ['--dataset_format', 'JSON'])
+        run_pipeline(rows, tf_dir, ['--dataset_format', 'TF'])
+        got = Counter()
+        for path in glob.glob(os.path.join(tf_dir, '*.tfrecord.gz')):
+            got.update(json.dumps(to_dict(Example.FromString(record)), sort_keys=True)
+                       for record in read_tfrecords(path))
+        print(f"datasets JSON {dataset_size(json_dir) / 1e6:.2f} MB, TFRecord (gzip) {dataset_size(tf_dir) / 1e6:.2f} MB, "
+              f"{sum(got.values())} examples read back")
+    failed |= got != expected
+    print('round trip ok' if not failed else 'round trip MISMATCH')
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
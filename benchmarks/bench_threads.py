@@ -0,0 +1,115 @@
+"""
+Compare ThreadIndex example creation with the list based linear paths.
+
+Checks that create_examples produces exactly the examples of the previous
+implementation on the test threads and on synthetic wide, deep and random
+threads, then times both. Exits with status 1 on any difference.
+
+    python -m benchmarks.bench_threads --comments 50000
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+from reddit import create_data
+
+TESTDATA = os.path.join(os.path.dirname(create_data.__file__), 'testdata')
+
+
+def reference_examples(thread, parent_depth, min_length):
+    """The examples of the previous create_examples, built from linear_paths."""
+    id_to_comment = {comment.id: comment for comment in list(thread)}
+    for linear_path in create_data.linear_paths(id_to_comment, parent_depth):
+        response = id_to_comment[linear_path[-1]]
+        context = id_to_comment[linear_path[-2]]
+        if (create_data._should_skip(response, min_length)
+                or create_data._should_skip(context, min_length)):
+            continue
+        example = {
+            'subreddit': response.subreddit,
+            'thread_id': response.thread_id,
+            'context_author': context.author,
+            'response_author': response.author,
+            'context': context.body,
+            'response': response.body,
+        }
+        for i in range(parent_depth - 1):
+            try:
+                context_i = linear_path[-3 - i]
+            except IndexError:
+                break
+            example['context/{}'.format(i)] = id_to_comment[context_i].body
+        yield example
+
+
+def comment(rng, comment_id, parent_id):
+    body = rng.choice(['[deleted]', 'ok', 'a reply long enough to keep', 'another kept reply here'])
+    return create_data.Comment(id=comment_id, thread_id='thread', parent_id=parent_id, body=body,
+                               body_is_trimmed=rng.random() < 0.05, author='a', subreddit='s')
+
+
+def synthetic_thread(kind: str, size: int, seed: int = 0) -> list:
+    """A thread of ``size`` comments: ``wide``, ``deep`` or ``random`` shaped, with some cycles."""
+    rng = random.Random(seed)
+    comments = []
+    for i in range(size):
+        if i == 0 or (kind == 'wide' and rng.random() < 0.7):
+            parent = 'thread'
+        elif kind == 'deep':
+            parent = f'c{i - 1}' if rng.random() < 0.95 else f'c{rng.randrange(i)}'
+        else:
+            parent = f'c{rng.randrange(i)}'
+        comments.append(comment(rng, f'c{i}', parent))
+    # comments pointing at each other never reach a root
+    comments.append(comment(rng, 'x0', 'x1'))
+    comments.append(comment(rng, 'x1', 'x0'))
+    rng.shuffle(comments)
+    return comments
+
+
+def test_threads() -> list:
+    threads = []
+    for name in ('thread.json', 'simple_thread.json'):
+        with open(os.path.join(TESTDATA, name)) as fp:
+            threads.append([create_data.normalise_comment(c, 127) for c in json.load(fp)])
+    return threads
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--comments', type=int, default=50000)
+    parser.add_argument('--parent-depth', type=int, default=10)
+    parser.add_argument('--min-length', type=int, default=9)
+    args = parser.parse_args()
+
+    failed = False
+    for thread in test_threads():
+        for depth in (1, 2, 3, 10):
+            for min_length in (1, 5, 9):
+                got = list(create_data.create_examples(thread, depth, min_length, 'JSON'))
+                if got != list(reference_examples(thread, depth, min_length)):
+                    print(f"MISMATCH on {thread[0].thread_id} parent_depth={depth} min_length={min_length}")
+                    failed = True
+    print(f"test threads  {'ok' if not failed else 'MISMATCH'}")
+
+    for kind in ('wide', 'deep', 'random'):
+        thread = synthetic_thread(kind, args.comments)
+        start = time.perf_counter()
+        expected = list(reference_examples(thread, args.parent_depth, args.min_length))
+        reference = time.perf_counter() - start
+        start = time.perf_counter()
+        got = list(create_data.create_examples(thread, args.parent_depth, args.min_length, 'JSON'))
+        indexed = time.perf_counter() - start
+        same = got == expected
+        failed |= not same
+        print(f"{kind:6s} {len(thread)} comments, {len(got)} examples  linear_paths {reference:6.2f}s  "
+              f"ThreadIndex {indexed:6.2f}s  ({reference / indexed:.1f}x)  {'ok' if same else 'MISMATCH'}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+"""
+Throughput of BPE token counting, per record against batched and cached.
+
+Learns a small byte level BPE vocabulary from synthetic Reddit-like
+comments, with Zipf distributed words and many repeated short replies,
+and counts the tokens of the comments
+
+* one record at a time, without any cache,
+* in batches, merging every distinct word of a batch once,
+* in batches with the LRU caches of ``preprocess.tokens.BpeTokenizer``.
+
+Then creates a dataset with ``--max_tokens`` and ``--context_tokens`` with
+the Beam DirectRunner and the local runner. Checks that all counts agree,
+that both engines write the same examples and that they respect the
+limits, exits with status 1 otherwise.
+
+    python -m benchmarks.bench_tokens --texts 20000 --merges 1000
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter
+
+from benchmarks.bench_local_runner import read_split
+from benchmarks.bench_skew import raw_comments
+from preprocess import tokens
+from reddit import create_data, local_runner
+
+SYLLABLES = ("ka ri to na me lo su pe an ing er the re on st ch th qu ex al "
+             "ou ea ie mo ly ed es ion tr pl gr ow").split()
+REPLIES = ["lol", "This.", "Thanks!", "Same here", "underrated comment", "F", "^ this",
+           "Username checks out", "I agree", "Source?"]
+
+
+def make_texts(rng: random.Random, count: int, lexicon: int = 20000) -> list:
+    words = [''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(1, 4))) for _ in range(lexicon)]
+    weights = [1 / (rank + 1) for rank in range(lexicon)]
+    texts = []
+    for _ in range(count):
+        if rng.random() < 0.3:
+            texts.append(rng.choice(REPLIES))
+            continue
+        body = rng.choices(words, weights, k=rng.randint(5, 80))
+        texts.append(' '.join(body).capitalize() + rng.choice(['.', '!', '?', ', right?']))
+    return texts
+
+
+def learn_merges(texts: list, num_merges: int) -> list:
+    """Byte level BPE merges of the pre-tokenized words of ``texts``."""
+    vocab = Counter()
+    for text in texts:
+        for word in tokens.PRE_TOKENIZER.findall(text):
+            vocab[tuple(tokens.BYTE_CHARACTERS[b] for b in word.encode('utf-8'))] += 1
+    merges = []
+    for _ in range(num_merges):
+        pairs = Counter()
+        for word, count in vocab.items():
+            for pair in zip(word, word[1:]):
+                pairs[pair] += count
+        if not pairs:
+            break
+        best = max(pairs, key=pairs.get)
+        merges.append(best)
+        merged = Counter()
+        for word, count in vocab.items():
+            parts, i = [], 0
+            while i < len(word):
+                if i < len(word) - 1 and (word[i], word[i + 1]) == best:
+                    parts.append(word[i] + word[i + 1])
+                    i += 2
+                else:
+                    parts.append(word[i])
+                    i += 1
+            merged[tuple(parts)] += count
+        vocab = merged
+    return merges
+
+
+def check_limits(output_dir: str, tokenizer, max_tokens: int, context_tokens: int) -> bool:
+    for split in ('train', 'valid'):
+        for line in read_split(output_dir, split, 'JSON'):
+            example = json.loads(line)
+            contexts = [example['context']] + [example[f'context/{i}'] for i in range(10)
+                                               if f'context/{i}' in example]
+            counts = tokenizer.count_batch(contexts + [example['response']])
+            if max(counts[0], counts[-1]) > max_tokens or sum(counts[:-1]) > context_tokens:
+                return False
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--texts', type=int, default=20000)
+    parser.add_argument('--merges', type=int, default=1000)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--comments', type=int, default=3000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    texts = make_texts(rng, args.texts)
+    start = time.perf_counter()
+    merges = learn_merges(texts[:1000], args.merges)
+    print(f"learned {len(merges)} merges in {time.perf_counter() - start:.1f}s")
+
+    runs = {}
+    start = time.perf_counter()
+    uncached = tokens.BpeTokenizer(merges, cache_size=0)
+    per_record = [uncached.short_text_tokens(text) for text in texts]
+    runs['per record'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    batched = []
+    for batch in range(0, len(texts), args.batch_size):
+        batched.extend(uncached.count_batch(texts[batch:batch + args.batch_size]))
+    runs['batched'] = time.perf_counter() - start
+
+    tokenizer = tokens.BpeTokenizer(merges)
+    start = time.perf_counter()
+    cached = []
+    for batch in range(0, len(texts), args.batch_size):
+        cached.extend(tokenizer.count_batch(texts[batch:batch + args.batch_size]))
+    runs['batched+cache'] = time.perf_counter() - start
+
+    for name, elapsed in runs.items():
+        print(f"{name:14s} {elapsed:7.2f}s {len(texts) / elapsed:9.0f} texts/s "
+              f"{runs['per record'] / elapsed:5.1f}x")
+    failed = not per_record == batched == cached
+    if failed:
+        print("token counts differ")
+    print(f"{sum(cached) / len(cached):.1f} tokens per text, "
+          f"{sum(len(t) for t in texts) / sum(cached):.2f} characters per token")
+
+    rows = raw_comments(rng, args.comments, args.comments // 10)
+    for row in rows:
+        row['body'] = rng.choice(texts)
+    with tempfile.TemporaryDirectory() as root:
+        vocab = os.path.join(root, 'merges.txt')
+        with open(vocab, 'w') as fw:
+            fw.write('#version: 0.2\n')
+            fw.writelines(f'{first} {second}\n' for first, second in merges)
+        archive = os.path.join(root, 'RC_comments.json')
+        with open(archive, 'w') as fw:
+            fw.writelines(json.dumps(row) + '\n' for row in rows)
+        common = ['--dataset_format', 'JSON', '--num_shards_train', '2', '--num_shards_test', '1',
+                  '--max_length', '1000', '--bpe_vocab', vocab, '--max_tokens', '48',
+                  '--context_tokens', '96']
+        create_data.run(['--reddit_table', 'unused:unused.unused',
+                         '--output_dir', os.path.join(root, 'direct')] + common, comments=rows)
+        stats = local_runner.run(['--input', archive, '--output_dir', os.path.join(root, 'local')] + common)
+        for split in ('train', 'valid'):
+            if read_split(os.path.join(root, 'direct'), split, 'JSON') != \
+                    read_split(os.path.join(root, 'local'), split, 'JSON'):
+                print(f"{split} examples of the DirectRunner and the local runner differ")
+                failed = True
+        if not check_limits(os.path.join(root, 'local'), tokenizer, 48, 96):
+            print("examples over the token limits")
+            failed = True
+        print(f"{stats['examples']} examples within 48 response and 96 context tokens")
+    print('ok' if not failed else 'MISMATCH')
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""
+Check the unmark fast path against the full Markdown engine and time both.
+
+Generates reddit-like markdown, plain titles and randomly fuzzed markdown,
+and compares ``unmark.unmark`` with the output of a plain Markdown render.
+Exits with status 1 if any text renders differently.
+
+    python -m benchmarks.bench_unmark --texts 20000
+"""
+
+import argparse
+import random
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from markdown import Markdown
+
+import unmark
+from benchmarks.bench_stream import WORDS
+
+TOKENS = [
+    '*', '**', '***', '_', '__', '`', '``', '\\', '\\*', '\\_', '\\[', '[', ']', '(', ')',
+    '[link](https://www.reddit.com/r/a_b)', '![img](x.png)', '<', '>', '> ', '#', '## ',
+    '- ', '* ', '+ ', '1. ', '\n', '\n\n', '  \n', '\n> ', '\n- ', '\n1. ', '\n# ', '\n    ',
+    '\t', '\r\n', '&amp;', '&', '^', '^(up)', '|', ' | ', '~~', '---', '\n---\n', '\n===\n',
+    ' ', '  ', 'snake_case', '!', '.', '\x02', 'é', ' ',
+]
+
+
+def words(rng: random.Random, low: int = 1, high: int = 8) -> str:
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(low, high)))
+
+
+def reddit_markdown(rng: random.Random) -> str:
+    """A text built from the markdown reddit users commonly write."""
+    blocks = []
+    for _ in range(rng.randint(1, 5)):
+        kind = rng.random()
+        if kind < 0.15:
+            blocks.append('> ' + words(rng))
+        elif kind < 0.25:
+            marker = rng.choice(['- ', '* ', '1. '])
+            blocks.append('\n'.join(marker + words(rng) for _ in range(rng.randint(1, 4))))
+        elif kind < 0.3:
+            blocks.append('#' * rng.randint(1, 3) + ' ' + words(rng))
+        else:
+            spans = []
+            for _ in range(rng.randint(1, 6)):
+                style = rng.random()
+                text = words(rng, 1, 4)
+                if style < 0.1:
+                    spans.append(f'**{text}**')
+                elif style < 0.2:
+                    spans.append(f'*{text}*')
+                elif style < 0.27:
+                    spans.append(f'[{text}](https://example.com/{rng.choice(WORDS)})')
+                elif style < 0.32:
+                    spans.append(f'`{text}`')
+                elif style < 0.35:
+                    spans.append(text + '  \n' + words(rng, 1, 4))
+                elif style < 0.38:
+                    spans.append('^' + text)
+                else:
+                    spans.append(text)
+            blocks.append(' '.join(spans))
+    return rng.choice(['\n\n', '\n']).join(blocks)
+
+
+def fuzzed_markdown(rng: random.Random) -> str:
+    """Random soup of markdown tokens and words."""
+    return ''.join(rng.choice(TOKENS) if rng.random() < 0.5 else rng.choice(WORDS)
+                   for _ in range(rng.randint(1, 30)))
+
+
+def make_texts(count: int, seed: int = 0) -> list:
+    rng = random.Random(seed)
+    texts = []
+    for _ in range(count):
+        kind = rng.random()
+        if kind < 0.4:
+            texts.append(words(rng, 3, 15).capitalize())
+        elif kind < 0.8:
+            texts.append(reddit_markdown(rng))
+        else:
+            texts.append(fuzzed_markdown(rng))
+    return texts
+
+
+def reference(texts: list) -> list:
+    """The output of the previous ``unmark``, a full Markdown render per text."""
+    md = Markdown(output_format="plain")
+    md.stripTopLevelTags = False
+    results = []
+    for text in texts:
+        results.append(md.convert(text))
+        md.reset()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--texts', type=int, default=20000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    texts = make_texts(args.texts, args.seed)
+    start = time.perf_counter()
+    expected = reference(texts)
+    full = time.perf_counter() - start
+    start = time.perf_counter()
+    got = unmark.unmark_batch(texts)
+    fast = time.perf_counter() - start
+
+    # the same texts again from several threads at once
+    with ThreadPoolExecutor(4) as executor:
+        threaded = [text for batch in executor.map(unmark.unmark_batch, [texts[i::4] for i in range(4)])
+                    for text in batch]
+    threaded_expected = [text for i in range(4) for text in expected[i::4]]
+
+    plain = sum(1 for text in texts if not unmark.has_markdown(text))
+    engine = 0
+    for text in texts:
+        try:
+            if unmark.has_markdown(text):
+                unmark._fast_unmark(text)
+        except unmark._Unsupported:
+            engine += 1
+    mismatches = [(t, e, g) for t, e, g in zip(texts, expected, got) if e != g]
+    mismatches += [('<threaded>', e, g) for e, g in zip(threaded_expected, threaded) if e != g]
+    for text, e, g in mismatches[:10]:
+        print(f"MISMATCH {text!r}\n  markdown {e!r}\n  unmark   {g!r}")
+
+    print(f"texts         {len(texts)}")
+    print(f"plain         {plain / len(texts):8.1%}")
+    print(f"full engine   {engine / len(texts):8.1%}")
+    print(f"parity        {1 - len(mismatches) / len(texts):8.2%}")
+    print(f"markdown      {len(texts) / full:10.0f} texts/s")
+    print(f"unmark        {len(texts) / fast:10.0f} texts/s  ({full / fast:.1f}x)")
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""
+Compare plain uploads of build.py with compressed streaming uploads.
+
+Runs the archives through the build.py stages once per output mode against a
+local bucket, and reports the bytes uploaded, the most bytes found on local
+disk while running and the time taken. The streamed outputs must decompress
+to the plain ones, a stream failing halfway must leave no object and an
+object recorded as failed must not be trusted.
+
+    python -m benchmarks.bench_upload --files 3 --records 20000
+"""
+
+import argparse
+import gzip
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import zstandard as zstd
+
+import build
+from benchmarks.bench_pipeline import setup, write_archives
+from benchmarks.http_fixture import serve
+
+MODES = [('plain', []), ('zst', ['--compression', 'zst']), ('gz', ['--compression', 'gz'])]
+
+
+def disk_usage(path: str) -> int:
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for file in filenames:
+            try:
+                total += os.path.getsize(os.path.join(dirpath, file))
+            except OSError:
+                pass
+    return total
+
+
+def decompress(path: str) -> bytes:
+    with open(path, 'rb') as fp:
+        data = fp.read()
+    if path.endswith('.zst'):
+        return zstd.ZstdDecompressor().stream_reader(data).read()
+    if path.endswith('.gz'):
+        return gzip.decompress(data)
+    return data
+
+
+def check_failed_upload(names: list) -> bool:
+    target = os.path.join(build.args.gcs_path, 'aborted.zst')
+    try:
+        with build.gcp.upload_stream(target) as raw:
+            raw.write(os.urandom(3 * build.gcp.chunk_size // 2))
+            raise RuntimeError('stream failed halfway')
+    except RuntimeError:
+        pass
+    left = build.gcp.size(target) is not None
+    print(f"aborted stream  {'left an object' if left else 'left no object'}")
+    # an object of the wrong size stays listed when deleting it failed
+    name = names[0]
+    listed = os.path.join(build.args.gcs_path, build.target_name(name))
+    build.manifest.update(name, status='preprocessed', failed_target=listed)
+    build.manifest.reconcile({name: listed}, {listed})
+    trusted = build.manifest.reached(name, 'done')
+    print(f"failed upload   {'trusted' if trusted else 'not trusted'}")
+    return not left and not trusted
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--files', type=int, default=3)
+    parser.add_argument('--records', type=int, default=20000)
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+    workers = ['--workers', str(args.workers)] if args.workers else []
+
+    with tempfile.TemporaryDirectory() as root:
+        served = os.path.join(root, 'served')
+        os.makedirs(served)
+        names = write_archives(served, args.files, args.records)
+        outputs = {}
+        with serve(served) as url:
+            for mode, extra in MODES:
+                dpath = os.path.join(root, f'local-{mode}')
+                bucket = os.path.join(root, f'bucket-{mode}')
+                # archives are kept by the plain run, removed by the streaming ones
+                setup(url, names, dpath, bucket, workers + extra)
+                build.args.cleanup = False
+                peak = [0]
+                stopped = threading.Event()
+
+                def sample():
+                    while not stopped.wait(0.01):
+                        peak[0] = max(peak[0], disk_usage(dpath))
+
+                sampler = threading.Thread(target=sample, daemon=True)
+                sampler.start()
+                start = time.perf_counter()
+                for name in names:
+                    build.upload_stage(build.preprocess_stage(build.download_stage(name)))
+                elapsed = time.perf_counter() - start
+                stopped.set()
+                sampler.join()
+                # the .stats.json sidecars aren't outputs
+                blobs = [blob for blob in build.gcp.list_files('processed') if not blob.endswith('.stats.json')]
+                uploaded = sum(os.path.getsize(os.path.join(bucket, blob)) for blob in blobs)
+                outputs[mode] = {blob.split('.')[0]: decompress(os.path.join(bucket, blob)) for blob in blobs}
+                left = disk_usage(dpath) - os.path.getsize(build.manifest.path)
+                print(f"{mode:6s} uploaded {uploaded / 1e6:7.2f} MB  peak local {peak[0] / 1e6:7.2f} MB  "
+                      f"left {left / 1e6:6.2f} MB  {elapsed:6.2f}s  "
+                      f"({sum(map(len, outputs['plain'].values())) / uploaded:.1f}x compression)")
+            ok = check_failed_upload(names)
+
+        for mode, _ in MODES[1:]:
+            assert outputs[mode] == outputs['plain'], f"{mode} outputs differ from the plain ones"
+        print("streamed outputs match the plain ones")
+        print('ok' if ok else 'MISMATCH')
+        sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,337 @@
+"""
+Seeded synthetic pushshift corpus for the benchmarks.
+
+``Corpus`` generates submissions and comment threads shaped like the
+pushshift dumps: every field of a record, self and link posts, thread sizes
+drawn from a heavy tailed distribution with megathreads and very deep reply
+chains mixed in, and bodies with a given share of markdown, URLs,
+non-English text and deleted comments. The same seed and options always give
+the same records, so benchmark runs compare like with like.
+
+``write_corpus`` writes the submissions and comments as .zst, .bz2 or .xz
+archives and the comments as a JSON lines table, the input of the local
+runner and of create_data.py.
+
+    python -m benchmarks.corpus --output /tmp/corpus --submissions 20000 --comments 50000
+"""
+
+import argparse
+import bz2
+import json
+import lzma
+import os
+import random
+import string
+
+import zstandard as zstd
+
+# the options of a Corpus and their defaults
+OPTIONS = {
+    # shape of the Pareto distribution of thread sizes, smaller is more skewed
+    'thread_alpha': 1.2,
+    'max_thread_size': 2000,
+    'megathread_rate': 0.002,
+    'megathread_size': 5000,
+    'deep_chain_rate': 0.01,
+    'deep_chain_length': 500,
+    'markdown_rate': 0.3,
+    'url_rate': 0.05,
+    'non_english_rate': 0.05,
+    'deleted_rate': 0.08,
+    'over_18_rate': 0.05,
+    'self_post_rate': 0.6,
+}
+FORMATS = ('zst', 'bz2', 'xz')
+# 2011-01-01, the month every record is created in
+MONTH_START = 1293840000
+MONTH = 31 * 24 * 3600
+
+ENGLISH = """
+the i to a and it you of that is in this for my on was but have just not be
+so with they are like if what do all me at can about your one would get or
+people as no out an up there from think know more really will time he when
+had we because don't it's good them by how only some which even been who
+i'm also see than much other make did go thing then could their any want
+way right too still here should well also never game year work first need
+yeah sure lol post thread reddit comment actually pretty same new love use
+back being through why something going those these said since us got very
+""".split()
+FOREIGN = {
+    'es': """el la de que y en los se del las por un para con no una su al es lo
+             como más pero sus le ya o este sí porque esta entre cuando muy sin
+             sobre también me hasta hay donde quien desde todo nos""".split(),
+    'de': """der die und in den von zu das mit sich des auf für ist im dem nicht
+             ein eine als auch es an werden aus er hat dass sie nach wird bei
+             einer um am sind noch wie einem über einen so zum""".split(),
+    'fr': """le de un être et à il avoir ne je son que se qui ce dans en du elle
+             au pour pas que vous par sur faire plus dire me on mon lui nous
+             comme mais pouvoir avec tout y aller voir""".split(),
+    'ru': """и в не на я быть он с что а по это она этот к но они мы как из у
+             который то за свой что весь год от так о для ты же все тот
+             мочь вы человек такой его сказать""".split(),
+}
+SUBREDDITS = ['AskReddit', 'funny', 'gaming', 'pics', 'worldnews', 'todayilearned', 'movies',
+              'science', 'AskScience', 'MachineLearning', 'learnprogramming', 'soccer', 'politics']
+DOMAINS = ['i.imgur.com', 'youtube.com', 'en.wikipedia.org', 'nytimes.com', 'github.com',
+           'theguardian.com', 'v.redd.it']
+
+
+def _base36(number: int) -> str:
+    digits = []
+    while True:
+        number, digit = divmod(number, 36)
+        digits.append((string.digits + string.ascii_lowercase)[digit])
+        if not number:
+            return ''.join(reversed(digits))
+
+
+class Corpus:
+    """
+    Generator of pushshift-like submissions and comments.
+
+    :param seed: seed of every random choice.
+    :param options: overrides of :data:`OPTIONS`, rates are the share of
+        records or texts in ``[0, 1]``.
+    """
+
+    def __init__(self, seed: int = 0, **options):
+        unknown = set(options) - set(OPTIONS)
+        if unknown:
+            raise ValueError(f"unknown corpus options {sorted(unknown)}")
+        self.seed = seed
+        self.options = dict(OPTIONS, **options)
+        self.rng = random.Random(seed)
+        self._ids = 0
+        self._english_weights = [1 / (rank + 1) for rank in range(len(ENGLISH))]
+        self._authors = [f'{self.rng.choice(ENGLISH)}_{self.rng.choice(ENGLISH)}{self.rng.randint(1, 999)}'
+                         for _ in range(5000)]
+
+    def _next_id(self) -> str:
+        self._ids += 1
+        return _base36(36 ** 5 + self._ids)
+
+    def _words(self, low: int, high: int) -> str:
+        rng = self.rng
+        count = rng.randint(low, high)
+        if rng.random() < self.options['non_english_rate']:
+            return ' '.join(rng.choices(FOREIGN[rng.choice(sorted(FOREIGN))], k=count))
+        return ' '.join(rng.choices(ENGLISH, self._english_weights, k=count))
+
+    def _url(self) -> str:
+        rng = self.rng
+        return rng.choice([
+            f'https://www.{rng.choice(DOMAINS)}/{self._next_id()}',
+            f'http://{rng.choice(DOMAINS)}/watch?v={self._next_id()}',
+            f'www.{rng.choice(DOMAINS)}/{rng.choice(ENGLISH)}',
+            f'https://www.reddit.com/r/{rng.choice(SUBREDDITS)}/comments/{self._next_id()}/',
+        ])
+
+    def _markdown(self, text: str) -> str:
+        rng = self.rng
+        words = text.split(' ')
+        for _ in range(rng.randint(1, 3)):
+            i = rng.randrange(len(words))
+            words[i] = rng.choice([
+                '**{}**', '*{}*', '_{}_', '~~{}~~', '`{}`', '^{}', '[{}](https://www.reddit.com/r/{})',
+                '{} &amp;', '\\*{}\\*',
+            ]).format(words[i], rng.choice(SUBREDDITS))
+        text = ' '.join(words)
+        block = rng.random()
+        if block < 0.2:
+            text = '> ' + text + '\n\n' + self._words(3, 15)
+        elif block < 0.35:
+            text = text + '\n\n' + '\n'.join(f'{rng.choice("-*")} {self._words(2, 8)}'
+                                              for _ in range(rng.randint(2, 5)))
+        elif block < 0.45:
+            text = text + '\n\n' + '\n'.join(f'{i + 1}. {self._words(2, 8)}' for i in range(rng.randint(2, 5)))
+        elif block < 0.5:
+            text = f'# {self._words(2, 5)}\n\n' + text
+        elif block < 0.55:
+            text = text + '\n\n    ' + rng.choice(['x = 1', 'print(x)', 'return y', 'i++'])
+        return text
+
+    def text(self, low: int = 1, high: int = 60) -> str:
+        """A body of ``low`` to ``high`` words, with markdown and URLs at their rates."""
+        text = self._words(low, high)
+        if self.rng.random() < self.options['markdown_rate']:
+            text = self._markdown(text)
+        if self.rng.random() < self.options['url_rate']:
+            text = text + ' ' + self._url()
+        return text
+
+    def _deleted(self) -> bool:
+        return self.rng.random() < self.options['deleted_rate']
+
+    def submission(self, created_utc: int = None, num_comments: int = 0) -> dict:
+        """One submission with every field of a pushshift RS record."""
+        rng = self.rng
+        submission_id = self._next_id()
+        subreddit = rng.choice(SUBREDDITS)
+        created_utc = created_utc or MONTH_START + rng.randrange(MONTH)
+        deleted = self._deleted()
+        is_self = rng.random() < self.options['self_post_rate']
+        if is_self:
+            url = f'https://www.reddit.com/r/{subreddit}/comments/{submission_id}/'
+            selftext = rng.choice(['[deleted]', '[removed]']) if deleted else (
+                self.text(0, 200) if rng.random() < 0.7 else '')
+            domain = f'self.{subreddit}'
+            preview = None
+        else:
+            domain = rng.choice(DOMAINS)
+            url = f'https://{domain}/{self._next_id()}'
+            selftext = '[deleted]' if deleted else ''
+            source = {'url': url, 'width': 1080, 'height': 720}
+            preview = {'enabled': True, 'images': [{
+                'id': self._next_id(), 'source': source, 'variants': {},
+                'resolutions': [dict(source, width=width, height=width * 2 // 3)
+                                for width in (108, 216, 320, 640, 960)]}]}
+        title = self.text(2, 25)
+        record = {
+            'all_awardings': [], 'allow_live_comments': False, 'archived': False,
+            'author': '[deleted]' if deleted else rng.choice(self._authors),
+            'author_flair_css_class': None, 'author_flair_richtext': [], 'author_flair_text': None,
+            'author_flair_type': 'text', 'author_fullname': 't2_' + self._next_id(), 'awarders': [],
+            'can_gild': True, 'contest_mode': False, 'created_utc': created_utc, 'domain': domain,
+            'edited': False, 'gilded': 0, 'gildings': {}, 'hidden': False, 'id': submission_id,
+            'is_crosspostable': True, 'is_self': is_self, 'is_video': domain == 'v.redd.it',
+            'link_flair_richtext': [], 'link_flair_text': None, 'locked': False, 'media': None,
+            'media_embed': {}, 'num_comments': num_comments, 'num_crossposts': 0,
+            'over_18': rng.random() < self.options['over_18_rate'],
+            'permalink': f'/r/{subreddit}/comments/{submission_id}/{"_".join(title.split()[:5])}/',
+            'pinned': False, 'retrieved_on': created_utc + rng.randrange(3600, 30 * 86400),
+            'score': int(rng.paretovariate(1.1)), 'secure_media': None, 'secure_media_embed': {},
+            'selftext': selftext, 'send_replies': True, 'spoiler': False, 'stickied': False,
+            'subreddit': subreddit, 'subreddit_id': 't5_' + _base36(SUBREDDITS.index(subreddit) + 1000),
+            'subreddit_subscribers': rng.randrange(1000, 30000000), 'subreddit_type': 'public',
+            'thumbnail': 'self' if is_self else 'default', 'title': title,
+            'total_awards_received': 0, 'url': url, 'whitelist_status': 'all_ads', 'wls': 6,
+        }
+        if preview is not None:
+            record['preview'] = preview
+        return record
+
+    def submissions(self, count: int):
+        """Yield ``count`` submissions."""
+        for _ in range(count):
+            yield self.submission()
+
+    def comment(self, link_id: str, parent_id: str, subreddit: str, created_utc: int) -> dict:
+        """One comment with every field of a pushshift RC record."""
+        rng = self.rng
+        deleted = self._deleted()
+        comment_id = self._next_id()
+        return {
+            'author': '[deleted]' if deleted else rng.choice(self._authors),
+            'author_flair_css_class': None, 'author_flair_text': None,
+            'body': rng.choice(['[deleted]', '[removed]']) if deleted else self.text(),
+            'controversiality': int(rng.random() < 0.02), 'created_utc': created_utc,
+            'distinguished': None, 'edited': False, 'gilded': 0, 'id': comment_id,
+            'link_id': 't3_' + link_id, 'parent_id': parent_id,
+            'retrieved_on': created_utc + rng.randrange(3600, 30 * 86400),
+            'score': int(rng.paretovariate(1.3)) - rng.randrange(3), 'stickied': False,
+            'subreddit': subreddit, 'subreddit_id': 't5_' + _base36(SUBREDDITS.index(subreddit) + 1000),
+        }
+
+    def thread_size(self) -> tuple:
+        """Return the number of comments of the next thread and whether it is a deep chain."""
+        rng = self.rng
+        if rng.random() < self.options['megathread_rate']:
+            return self.options['megathread_size'], False
+        if rng.random() < self.options['deep_chain_rate']:
+            return self.options['deep_chain_length'], True
+        return min(int(rng.paretovariate(self.options['thread_alpha'])), self.options['max_thread_size']), False
+
+    def thread(self, size: int, chain: bool = False) -> list:
+        """
+        The comments of one thread, oldest first.
+
+        Replies go to the submission, to a recent comment or to any earlier
+        comment. In a chain every comment replies to the one before.
+        """
+        rng = self.rng
+        link_id = self._next_id()
+        subreddit = rng.choice(SUBREDDITS)
+        created_utc = MONTH_START + rng.randrange(MONTH)
+        comments = []
+        for i in range(size):
+            if i == 0 or (not chain and rng.random() < 0.3):
+                parent = None
+            elif chain or rng.random() < 0.5:
+                parent = comments[max(i - rng.randint(1, 3), 0) if not chain else i - 1]
+            else:
+                parent = comments[rng.randrange(i)]
+            created = (parent['created_utc'] if parent else created_utc) + int(rng.expovariate(1 / 600)) + 1
+            comments.append(self.comment(link_id, 't1_' + parent['id'] if parent else 't3_' + link_id,
+                                         subreddit, created))
+        return comments
+
+    def comments(self, count: int) -> list:
+        """At least ``count`` comments of whole threads, sorted by creation time."""
+        rows = []
+        while len(rows) < count:
+            size, chain = self.thread_size()
+            rows.extend(self.thread(max(size, 1), chain))
+        rows.sort(key=lambda row: row['created_utc'])
+        return rows
+
+
+def open_archive(path: str):
+    """A binary writer compressing to ``path`` by its extension, .zst, .bz2, .xz or none."""
+    if path.endswith('.zst'):
+        return zstd.ZstdCompressor(level=3).stream_writer(open(path, 'wb'), closefd=True)
+    if path.endswith('.bz2'):
+        return bz2.open(path, 'wb')
+    if path.endswith('.xz'):
+        # reading hardly depends on the preset, writing with the default one is slow
+        return lzma.open(path, 'wb', preset=1)
+    return open(path, 'wb')
+
+
+def write_lines(path: str, records) -> int:
+    """Write ``records`` as JSON lines to ``path``, compressed by its extension, return the count."""
+    count = 0
+    with open_archive(path) as fw:
+        for record in records:
+            fw.write(json.dumps(record).encode('utf-8') + b'\n')
+            count += 1
+    return count
+
+
+def write_corpus(output: str, submissions: int, comments: int, formats: tuple = FORMATS,
+                 seed: int = 0, **options) -> dict:
+    """
+    Write ``RS_synthetic`` and ``RC_synthetic`` archives in every format and
+    the ``RC_synthetic.json`` table of comments to ``output``.
+
+    Returns the paths written by name, the plain ``RS_synthetic.json`` too.
+    """
+    os.makedirs(output, exist_ok=True)
+    corpus = Corpus(seed, **options)
+    rows = {'RS_synthetic': list(corpus.submissions(submissions)), 'RC_synthetic': corpus.comments(comments)}
+    paths = {}
+    for name, records in rows.items():
+        for ext in ('json',) + tuple(formats):
+            path = os.path.join(output, f'{name}.{ext}')
+            write_lines(path, records)
+            paths[os.path.basename(path)] = path
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--output', required=True)
+    parser.add_argument('--submissions', type=int, default=20000)
+    parser.add_argument('--comments', type=int, default=50000)
+    parser.add_argument('--formats', nargs='*', default=list(FORMATS), choices=FORMATS)
+    parser.add_argument('--seed', type=int, default=0)
+    for name, default in OPTIONS.items():
+        parser.add_argument('--' + name.replace('_', '-'), type=type(default), default=default)
+    args = parser.parse_args()
+    options = {name: getattr(args, name) for name in OPTIONS}
+    paths = write_corpus(args.output, args.submissions, args.comments, tuple(args.formats), args.seed, **options)
+    for path in paths.values():
+        print(f"{path} {os.path.getsize(path) / 1e6:.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
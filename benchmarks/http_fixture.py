@@ -0,0 +1,119 @@
+"""
+Local HTTP server standing in for files.pushshift.io in the benchmarks.
+
+    with serve(directory, bytes_per_second=8 * 1024 * 1024) as url:
+        ...
+
+``RangeHandler`` answers byte range requests and can inject faults: every
+``drop_every``-th response is cut off halfway and every ``slow_every``-th one
+is served ``slow_factor`` times slower.
+"""
+
+import contextlib
+import functools
+import itertools
+import os
+import re
+import socket
+import sys
+import threading
+import time
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+
+class ThrottledHandler(SimpleHTTPRequestHandler):
+    """Serve files of a directory, each connection capped at ``bytes_per_second``."""
+
+    bytes_per_second = None
+    chunk_size = 64 * 1024
+
+    def copyfile(self, source, outputfile):
+        if not self.bytes_per_second:
+            return super().copyfile(source, outputfile)
+        for chunk in iter(lambda: source.read(self.chunk_size), b''):
+            outputfile.write(chunk)
+            time.sleep(len(chunk) / self.bytes_per_second)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class RangeHandler(ThrottledHandler):
+    """``ThrottledHandler`` accepting ``Range: bytes=start-end`` requests."""
+
+    drop_every = None
+    slow_every = None
+    slow_factor = 10
+    requests = None
+
+    def send_head(self):
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return None
+        size = os.path.getsize(path)
+        m = re.fullmatch(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        start, end = 0, size - 1
+        if m:
+            start = int(m.group(1))
+            end = min(int(m.group(2) or size - 1), size - 1)
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        else:
+            self.send_response(200)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        fp = open(path, 'rb')
+        fp.seek(start)
+        self.remaining = end - start + 1
+        return fp
+
+    def copyfile(self, source, outputfile):
+        number = next(self.requests)
+        drop = bool(self.drop_every) and number % self.drop_every == 0
+        rate = self.bytes_per_second
+        if self.slow_every and number % self.slow_every == 0:
+            rate = (rate or 64 * 1024 * 1024) / self.slow_factor
+        limit = self.remaining // 2 if drop else self.remaining
+        while limit > 0:
+            chunk = source.read(min(self.chunk_size, limit))
+            if not chunk:
+                break
+            outputfile.write(chunk)
+            limit -= len(chunk)
+            if rate:
+                time.sleep(len(chunk) / rate)
+        if drop:
+            # cut the connection short of the advertised Content-Length
+            self.close_connection = True
+            self.connection.shutdown(socket.SHUT_RDWR)
+
+
+class QuietServer(ThreadingHTTPServer):
+    """Server ignoring clients which hang up early."""
+
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+@contextlib.contextmanager
+def serve(directory: str, bytes_per_second: float = None, handler=ThrottledHandler, port: int = 0,
+          **faults):
+    """
+    Serve ``directory`` on ``port``, a free one by default, and yield its base url.
+
+    ``faults`` set the fault injection attributes of ``RangeHandler``.
+    """
+    attributes = dict(faults, bytes_per_second=bytes_per_second, requests=itertools.count(1))
+    handler = type(handler.__name__, (handler,), attributes)
+    server = QuietServer(('127.0.0.1', port), functools.partial(handler, directory=directory))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f'http://127.0.0.1:{server.server_address[1]}/'
+    finally:
+        server.shutdown()
+        server.server_close()
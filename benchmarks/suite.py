@@ -0,0 +1,244 @@
+"""
+Records per second and peak RSS of every hot path, against a stored baseline.
+
+Writes a synthetic corpus with ``benchmarks.corpus`` and runs every hot path
+on it in a fresh interpreter, so the peak RSS of a path, the largest of the
+process and of its worker processes, doesn't include the others:
+
+* ``unmark``: titles and bodies of the submissions,
+* ``preprocess_data``: one submission line at a time,
+* ``preprocess_batch``: submission lines in batches of 1000,
+* ``read_zst``, ``read_bz2``, ``read_xz``: ``build.preprocess_handler`` on the
+  submission archives with one worker,
+* ``linear_paths`` and ``create_examples``: every thread of the comments,
+* ``local_runner``: a dataset from the table of comments, one process.
+
+Every path runs ``--repeat`` times, the fastest run counts. The results are
+compared with ``benchmarks/baseline.json``: the suite exits with status 1
+if a path is more than ``--threshold`` slower or bigger than its baseline.
+Baselines depend on the machine, record a new one with ``--update-baseline``.
+
+    python -m benchmarks.suite
+    python -m benchmarks.suite --paths unmark read_zst --threshold 0.2
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+from benchmarks import corpus
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+CORPUS = {'submissions': 10000, 'comments': 30000, 'seed': 0}
+PATHS = {}
+
+
+def hot_path(fn):
+    """Register ``fn(corpus_dir)``, which returns the number of records and the callable to time."""
+    PATHS[fn.__name__[len('bench_'):]] = fn
+    return fn
+
+
+def _read_lines(path: str) -> list:
+    with open(path) as fp:
+        return fp.read().splitlines()
+
+
+def _threads(corpus_dir: str) -> list:
+    from reddit import create_data
+    threads = defaultdict(list)
+    for line in _read_lines(os.path.join(corpus_dir, 'RC_synthetic.json')):
+        comment = create_data.normalise_comment(json.loads(line), 127)
+        threads[comment.thread_id].append(comment)
+    return list(threads.values())
+
+
+@hot_path
+def bench_unmark(corpus_dir: str):
+    from unmark import unmark
+    texts = []
+    for line in _read_lines(os.path.join(corpus_dir, 'RS_synthetic.json')):
+        record = json.loads(line)
+        texts.extend(text for text in (record['title'], record['selftext']) if text)
+    return len(texts), lambda: [unmark(text) for text in texts]
+
+
+@hot_path
+def bench_preprocess_data(corpus_dir: str):
+    import build
+    lines = _read_lines(os.path.join(corpus_dir, 'RS_synthetic.json'))
+    return len(lines), lambda: [build.preprocess_data(line) for line in lines]
+
+
+@hot_path
+def bench_preprocess_batch(corpus_dir: str):
+    import build
+    lines = _read_lines(os.path.join(corpus_dir, 'RS_synthetic.json'))
+    return len(lines), lambda: [build.preprocess_batch(lines[start:start + 1000])
+                                for start in range(0, len(lines), 1000)]
+
+
+def _read_archive(ext: str):
+    def bench(corpus_dir: str):
+        import build
+        path = os.path.join(corpus_dir, f'RS_synthetic.{ext}')
+
+        def run():
+            with open(os.devnull, 'w') as fw:
+                build.preprocess_handler(path, 1, fw)
+        return len(_read_lines(os.path.join(corpus_dir, 'RS_synthetic.json'))), run
+    bench.__name__ = f'bench_read_{ext}'
+    return hot_path(bench)
+
+
+for _ext in corpus.FORMATS:
+    _read_archive(_ext)
+
+
+@hot_path
+def bench_linear_paths(corpus_dir: str):
+    from reddit import create_data
+    threads = [{comment.id: comment for comment in thread} for thread in _threads(corpus_dir)]
+    return sum(map(len, threads)), lambda: [list(create_data.linear_paths(thread, 10)) for thread in threads]
+
+
+@hot_path
+def bench_create_examples(corpus_dir: str):
+    from reddit import create_data
+    threads = _threads(corpus_dir)
+    return sum(map(len, threads)), lambda: [list(create_data.create_examples(thread, 10, 9, 'JSON'))
+                                            for thread in threads]
+
+
+@hot_path
+def bench_local_runner(corpus_dir: str):
+    from reddit import local_runner
+    table = os.path.join(corpus_dir, 'RC_synthetic.json')
+
+    def run():
+        with tempfile.TemporaryDirectory() as output_dir:
+            local_runner.run(['--input', table, '--output_dir', output_dir, '--processes', '1',
+                              '--dataset_format', 'JSON', '--num_shards_train', '2',
+                              '--num_shards_test', '1'])
+    return len(_read_lines(table)), run
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in KB on Linux, the largest waited for child stands for the workers
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024
+
+
+def run_path(name: str, corpus_dir: str, repeat: int) -> dict:
+    """Time the hot path ``name`` in this process."""
+    records, fn = PATHS[name](corpus_dir)
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return {'records': records, 'seconds': round(best, 4), 'records_per_sec': round(records / best, 1),
+            'peak_rss_mb': round(peak_rss_mb(), 1)}
+
+
+def measure(name: str, corpus_dir: str, repeat: int) -> dict:
+    """Run the hot path ``name`` in a fresh interpreter."""
+    output = subprocess.run([sys.executable, '-m', 'benchmarks.suite', '--run', name, '--corpus', corpus_dir,
+                             '--repeat', str(repeat)], check=True, stdout=subprocess.PIPE,
+                            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    return json.loads(output.stdout.decode('utf-8').strip().splitlines()[-1])
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """Return the regressions of ``results`` past ``threshold`` against ``baseline``."""
+    regressions = []
+    for name, result in results.items():
+        base = baseline['paths'].get(name)
+        if base is None:
+            continue
+        if result['records_per_sec'] < base['records_per_sec'] * (1 - threshold):
+            regressions.append(f"{name}: {result['records_per_sec']:.0f} records/s, "
+                               f"baseline {base['records_per_sec']:.0f}")
+        if result['peak_rss_mb'] > base['peak_rss_mb'] * (1 + threshold):
+            regressions.append(f"{name}: peak RSS {result['peak_rss_mb']:.0f} MB, "
+                               f"baseline {base['peak_rss_mb']:.0f} MB")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--paths', nargs='*', default=list(PATHS), choices=sorted(PATHS))
+    parser.add_argument('--corpus', default=None,
+                        help='directory of a corpus written by benchmarks.corpus with the default '
+                             'options, a new one is written to a temporary directory by default.')
+    parser.add_argument('--submissions', type=int, default=CORPUS['submissions'])
+    parser.add_argument('--comments', type=int, default=CORPUS['comments'])
+    parser.add_argument('--seed', type=int, default=CORPUS['seed'])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='largest share a path may be slower or bigger than its baseline.')
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--update-baseline', action='store_true')
+    parser.add_argument('--run', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        print(json.dumps(run_path(args.run, args.corpus, args.repeat)))
+        return
+
+    settings = {'submissions': args.submissions, 'comments': args.comments, 'seed': args.seed}
+    with tempfile.TemporaryDirectory() as root:
+        corpus_dir = args.corpus
+        if corpus_dir is None:
+            corpus_dir = os.path.join(root, 'corpus')
+            start = time.perf_counter()
+            corpus.write_corpus(corpus_dir, **settings)
+            print(f"corpus of {args.submissions} submissions and {args.comments} comments "
+                  f"written in {time.perf_counter() - start:.1f}s")
+        results = {}
+        for name in args.paths:
+            results[name] = measure(name, corpus_dir, args.repeat)
+            result = results[name]
+            print(f"{name:17s} {result['records']:8d} records {result['seconds']:7.2f}s "
+                  f"{result['records_per_sec']:10.0f} records/s {result['peak_rss_mb']:7.0f} MB peak RSS")
+
+    if args.update_baseline:
+        baseline = {'corpus': settings, 'machine': {'python': platform.python_version(),
+                                                    'processor': platform.machine(), 'cpus': os.cpu_count()},
+                    'paths': results}
+        if os.path.isfile(args.baseline):
+            with open(args.baseline) as fp:
+                previous = json.load(fp)
+            if previous['corpus'] == settings:
+                # paths left out of this run keep their baseline
+                baseline['paths'] = dict(previous['paths'], **results)
+        with open(args.baseline, 'w') as fw:
+            json.dump(baseline, fw, indent=1, sort_keys=True)
+        print(f"baseline written to {args.baseline}")
+        return
+
+    if not os.path.isfile(args.baseline):
+        print(f"no baseline in {args.baseline}, record one with --update-baseline")
+        sys.exit(1)
+    with open(args.baseline) as fp:
+        baseline = json.load(fp)
+    if baseline['corpus'] != settings:
+        print(f"the baseline was measured on another corpus {baseline['corpus']}")
+        sys.exit(1)
+    regressions = compare(results, baseline, args.threshold)
+    for regression in regressions:
+        print(f"  {regression}")
+    print('ok' if not regressions else 'REGRESSION')
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -11,23 +11,16 @@ import hashlib
 import tqdm
 import time
 import logging
+import multiprocessing
 import shutil
 import argparse
-import bz2
-import json
-import lzma
-import zstandard as zstd
-import io
-from langdetect import detect
 from unmark import unmark
-import re
 import traceback
 from gcp.gcs_service import GCP_Service
-import multiprocessing
+from gcp.local_storage import LocalStorage_Service
+from preprocess import compress, decompress, dedup, filters, langid, metrics, pipeline, records, segmented, stream, tokens
+from preprocess.manifest import ProcessingManifest
 import random
-import pandas as pd
-from dask import dataframe as  dd
-import swifter
 
 logger = logging.getLogger("main")
 FORMAT = '%(asctime)-15s %(name)s %(levelname)s %(message)s'
@@ -50,8 +43,50 @@ parser.add_argument('--reddit-link', type=str,
                     help= 'destination path of gcp to store preprocessed data.')
 parser.add_argument('--hash-link', type=str, default=hash_link,
                     help= 'destination path of gcp to store preprocessed data.')
-
-args = parser.parse_args()
+parser.add_argument('--workers', type=int, default=None,
+                    help= 'number of preprocessing processes, defaults to all cores.')
+parser.add_argument('--langid', type=str, default='ngram', choices=sorted(langid.BACKENDS),
+                    help= 'language identification backend.')
+parser.add_argument('--json-backend', type=str, default=records.BACKEND, choices=sorted(records.BACKENDS),
+                    help= 'JSON decoder of the submissions, orjson when installed.')
+parser.add_argument('--segments', type=int, default=segmented.SEGMENTS,
+                    help= 'number of connections per download when the server accepts byte ranges.')
+parser.add_argument('--parallel-downloads', type=int, default=2,
+                    help= 'number of archives downloaded at once.')
+parser.add_argument('--parallel-preprocess', type=int, default=1,
+                    help= 'number of archives preprocessed at once.')
+parser.add_argument('--parallel-uploads', type=int, default=2,
+                    help= 'number of preprocessed files uploaded at once.')
+parser.add_argument('--disk-budget', type=float, default=None,
+                    help= 'GB of archives and preprocessed files in flight at once, unlimited by default.')
+parser.add_argument('--cleanup', action='store_true',
+                    help= 'delete local archives once preprocessed and outputs once uploaded.')
+parser.add_argument('--compression', type=str, default=None, choices=sorted(compress.CODECS),
+                    help= 'compress outputs with this codec, with --gcs-path they are streamed '
+                          'straight to the bucket and archives are deleted once uploaded.')
+parser.add_argument('--compression-level', type=int, default=None,
+                    help= 'compression level, 10 for zst and 6 for gz by default.')
+parser.add_argument('--upload-chunk-size', type=int, default=32,
+                    help= 'MB sent per request of resumable uploads.')
+parser.add_argument('--upload-slices', type=int, default=8,
+                    help= 'outputs larger than 256 MB are uploaded as this many parallel slices.')
+parser.add_argument('--manifest', type=str, default=None,
+                    help= 'json file recording the processed archives, defaults to <dpath>/manifest.json.')
+parser.add_argument('--local-bucket', type=str, default=None,
+                    help= 'use this local directory instead of the gcp bucket.')
+parser.add_argument('--bpe-vocab', type=str, default=None,
+                    help= 'BPE vocabulary of --max-tokens, a GPT-2 merges.txt or a tokenizer.json.')
+parser.add_argument('--max-tokens', type=int, default=None,
+                    help= 'remove submissions with more BPE tokens than this, they are kept by default.')
+parser.add_argument('--dedup-threshold', type=float, default=None,
+                    help= 'remove submissions with a MinHash Jaccard similarity of at least this much '
+                          'to a submission kept before, no deduplication by default.')
+parser.add_argument('--dedup-num-perm', type=int, default=dedup.NUM_PERM,
+                    help= 'number of MinHash permutations used by --dedup-threshold.')
+parser.add_argument('--dedup-index', type=str, default=None,
+                    help= 'sqlite file of the LSH bands of kept submissions, defaults to <dpath>/dedup.sqlite.')
+parser.add_argument('--progress-interval', type=float, default=None,
+                    help= 'log the records per second of every preprocessing stage this often, in seconds.')
 
 """
 data preprocesss
@@ -59,7 +94,7 @@ data preprocesss
 * Remove comments/posts from Bots checked
 * Remove comments/posts from non-English checked
 * remove comments/posts marked as delete or removed checked
-* remove comments/posts longer than 128 BPE tokens. will do this during loading data in model using tokenizer
+* remove comments/posts longer than 128 BPE tokens. checked with --max-tokens 128 --bpe-vocab <merges.txt>
 * remove longer than 2040 characters and doesnot contain spaces. checked
 * remove Shorter than 5 character. checked
 * remove comments/posts with contains a URL. checked
@@ -69,123 +104,170 @@ data preprocesss
 
 """
 
-def preprocess_handler(dpath: str):
+def preprocess_handler(dpath: str, workers: int = None, output=None):
+    # output is an optional text file object written instead of the .txt file,
+    # the stage timings and rejection reasons of the archive go to file_stats
     logger.info(f"pre-processing {dpath}")
-    if dpath.lower().endswith('.bz2'):
-        read_bz2_dataset(dpath)
-    elif dpath.lower().endswith('.xz'):
-        read_lzma_dataset(dpath)
-    elif dpath.lower().endswith('.zst'):
-        read_zstandered_data(dpath)
+    out_file = ''.join(dpath.split('.')[:-1]) +'.txt'
+    if dpath.lower().endswith(tuple(data_ext)):
+        # decompression and the parsing workers share the cores
+        decompressing, workers = decompress.split_workers(dpath, workers or multiprocessing.cpu_count())
+        batches = decompress.iter_batches(dpath, decompressing)
+        batch_fn, dedup_fn = preprocess_batch, None
+        if band_index is not None:
+            # bands an interrupted run left for this archive would mark all its texts duplicates
+            source = os.path.basename(dpath)
+            band_index.forget(source)
+            batch_fn = dedup_batch
+            dedup_fn = lambda texts, keys: band_index.filter(source, texts, keys)
+        start = time.perf_counter()
+        stats = stream.process_file(dpath, out_file if output is None else output, batch_fn,
+                                    processes=workers, batches=batches, dedup=dedup_fn,
+                                    progress_interval=progress_interval, initializer=load_text_filter)
+        stats['seconds'] = round(time.perf_counter() - start, 3)
+        duplicates[os.path.basename(dpath)] = stats['duplicates']
+        file_stats[os.path.basename(dpath)] = stats
     else:
         logger.info("File not supported ... ")
 
-    out_file = ''.join(dpath.split('.')[:-1]) +'.txt'
     logger.info(f"Done preprocessing {dpath} to {out_file}")
     return out_file
 
-def find_url(string): 
-  
-    # findall() has been used  
-    # with valid conditions for urls in string 
-    regex = r"(?i)\b((?:https?://|www\d{0,3}[.]|[a-z0-9.\-]+[.][a-z]{2,4}/)(?:[^\s()<>]+|\(([^\s()<>]+|(\([^\s()<>]+\)))*\))+(?:\(([^\s()<>]+|(\([^\s()<>]+\)))*\)|[^\s`!()\[\]{};:'\".,<>?«»“”‘’]))"
-    url = re.findall(regex,string)       
-    return [x[0] for x in url]
+# set by --langid, every worker builds the filter chain once when it starts
+langid_backend = 'ngram'
+text_filter = None
+# only the fields used below are decoded, over_18 submissions are rejected first
+record_decoder = records.RecordDecoder(('title', 'selftext'), reject='over_18')
+# set by --dedup-threshold, the workers inherit the hasher
+minhasher = None
+# set by --max-tokens, every worker loads the vocabulary once
+max_tokens = None
+bpe_vocab = None
+tokenizer = None
+band_index = None
+duplicates = {}
+# set by --progress-interval
+progress_interval = None
+file_stats = {}
+
+def load_text_filter():
+    # the filter chain with the language model of --langid, built once per process
+    global text_filter
+    if text_filter is None:
+        text_filter = filters.FilterChain(language=langid.get_identifier(langid_backend))
+    return text_filter
 
 def preprocess_text(text):
-    # remove mulitple spaces into single space
-    text = re.sub('\s+',' ',text)
-    # check if there is any url or not
-    # check if text start with non-ASCII character
-    cond = len(find_url(text)) > 0 or text.strip() == '' \
-        or len(text.strip()) <= 5 or text.strip().lower() == '[deleted]' \
-        or text.strip().lower() == '[removed]' or ord(text[0]) > 128 \
-        or detect(text) != 'en'
-    if cond:
-        return False
-    if ' ' not in text and len(text) > 2040:
-        return False
-    return text
+    # collapse whitespace, then reject on the cheapest failing rule first:
+    # empty/short, deleted, non-ASCII start, long without spaces, url, language
+    return load_text_filter()(text)
+
+# what a malformed record raises while parsing, or unmark on odd markdown
+RECORD_ERRORS = (ValueError, KeyError, TypeError, AttributeError, IndexError, RecursionError)
+
+def parse_record(data):
+    # return the stripped (title, body), None for unsafe records
+    record = record_decoder.decode(data)
+    if record is None:
+        return None
+    return record[0].strip(), record[1].strip()
+
+def decode_record(data):
+    # return (title, body) converted to plain text, None for unsafe records
+    record = parse_record(data)
+    if record is None:
+        return None
+    # convert markdown to plain text
+    return unmark(record[0]), unmark(record[1])
+
+def join_texts(text_title, text_body):
+    if text_body and text_title:
+        return text_title + '\n' + text_body
+    elif text_body:
+        return text_body
+    elif text_title:
+        return text_title
+    return False
 
 def preprocess_data(data: str):
     try:
-        data = json.loads(data)
-        # check if sumbission is over 18 or not
-        if data['over_18']:
+        record = decode_record(data)
+        if record is None:
             return False
-        # convert markdown to plain text
-        text_body = preprocess_text(unmark(data['selftext'].strip()))
-        text_title = preprocess_text(unmark(data['title'].strip()))
-        if text_body and text_title:
-            return text_title + '\n' + text_body
-        elif text_body:
-            return text_body
-        elif text_title:
-            return text_title
-        return False
-    except:
+        text_title, text_body = record
+        return join_texts(preprocess_text(text_title), preprocess_text(text_body))
+    except RECORD_ERRORS:
         return False
-    
-
-def read_bz2_dataset(path):
-    new_path = ''.join(path.split('.')[:-1]) +'.txt'
-    with open(new_path, 'w') as fw:
-        with bz2.open(path) as fp:
-            text_stream = io.TextIOWrapper(fp, encoding='utf-8')
-            while True:
-                tmp = text_stream.readlines(10000000)
-                if not tmp:
-                    break
-                df = pd.DataFrame()
-                df['text'] = tmp
-                ddf = dd.from_pandas(df, npartitions=2*multiprocessing.cpu_count())
-                df['text'] =  ddf.map_partitions(lambda df:(df.apply(lambda x: preprocess_data(x['text']), axis=1))).compute(scheduler='processes')
-                df['text'].swifter.apply(lambda x: fw.write(x + '\n') if x else None)
-            text_stream.close()
-                    
-
-def read_lzma_dataset(path):
-    new_path = ''.join(path.split('.')[:-1]) +'.txt'
-    with open(new_path, 'w') as fw:
-        with lzma.open(path) as fp:
-            text_stream = io.TextIOWrapper(fp, encoding='utf-8')
-            while True:
-                tmp = text_stream.readlines(50000000)
-                if not tmp:
-                    break
-                df = pd.DataFrame()
-                df['text'] = tmp
-                ddf = dd.from_pandas(df, npartitions=2*multiprocessing.cpu_count())
-                df['text'] =  ddf.map_partitions(lambda df:(df.apply(lambda x: preprocess_data(x['text']), axis=1))).compute(scheduler='processes')
-                df['text'].swifter.apply(lambda x: fw.write(x + '\n') if x else None)
-            text_stream.close()
-
-def read_zstandered_data(path):
-    new_path = ''.join(path.split('.')[:-1]) +'.txt'
-    with open(new_path, 'w') as fw:
-        with open(path, 'rb') as fp:
-            dctx = zstd.ZstdDecompressor()
-            stream_reader = dctx.stream_reader(fp)
-            text_stream = io.TextIOWrapper(stream_reader, encoding='utf-8')
-            while True:
-                tmp = text_stream.readlines(50000000)
-                if not tmp:
-                    break
-                df = pd.DataFrame()
-                df['text'] = tmp
-                ddf = dd.from_pandas(df, npartitions=2*multiprocessing.cpu_count())
-                df['text'] =  ddf.map_partitions(lambda df:(df.apply(lambda x: preprocess_data(x['text']), axis=1))).compute(scheduler='processes')
-                df['text'].swifter.apply(lambda x: fw.write(x + '\n') if x else None)
-            text_stream.close()
-            stream_reader.close()
-            del dctx
-
-def download(url, path, fname, redownload=False, num_retries=5):
+
+
+def preprocess_batch(lines: list):
+    # run in the stream worker pool, keep only records which pass the filters.
+    # language identification runs once over all titles and once over all bodies.
+    # every stage and the reason of every rejected record go to the process metrics
+    stages = metrics.current()
+    records = []
+    with stages.stage('parse', len(lines)) as stage:
+        for line in lines:
+            try:
+                record = parse_record(line)
+            except RECORD_ERRORS as e:
+                stages.reject(f'parse_error:{type(e).__name__}')
+                continue
+            if record is None:
+                stages.reject('over_18')
+            else:
+                records.append(record)
+        stage.records_out = len(records)
+    with stages.stage('unmark', len(records)) as stage:
+        unmarked = []
+        for title, body in records:
+            try:
+                unmarked.append((unmark(title), unmark(body)))
+            except RECORD_ERRORS as e:
+                stages.reject(f'unmark_error:{type(e).__name__}')
+        records = unmarked
+        stage.records_out = len(records)
+    title_reasons, body_reasons = [], []
+    text_filter = load_text_filter()
+    titles = text_filter.filter_batch([title for title, _ in records], title_reasons)
+    bodies = text_filter.filter_batch([body for _, body in records], body_reasons)
+    texts = []
+    for text_title, text_body, title_reason, body_reason in zip(titles, bodies, title_reasons, body_reasons):
+        text = join_texts(text_title, text_body)
+        if text:
+            texts.append(text)
+        else:
+            # an empty title doesn't explain why the body was rejected
+            stages.reject(f"filter:{body_reason if body_reason != 'empty' else title_reason}")
+    if max_tokens is not None:
+        with stages.stage('tokens', len(texts)) as stage:
+            kept = limit_tokens(texts)
+            stages.reject('too_many_tokens', len(texts) - len(kept))
+            stage.records_out = len(kept)
+        texts = kept
+    return texts
+
+def limit_tokens(texts: list):
+    # keep the texts of at most max_tokens BPE tokens, counted in one batch
+    global tokenizer
+    if tokenizer is None:
+        tokenizer = tokens.BpeTokenizer.load(bpe_vocab)
+    return [text for text, count in zip(texts, tokenizer.count_batch(texts)) if count <= max_tokens]
+
+def dedup_batch(lines: list):
+    # the kept texts of preprocess_batch with their LSH band keys
+    texts = preprocess_batch(lines)
+    with metrics.current().stage('minhash', len(texts)):
+        keys = minhasher.band_keys(texts)
+    return texts, keys
+
+def download(url, path, fname, redownload=False, num_retries=5, hashcode=None):
     """
     Download file using `requests`.
 
     If ``redownload`` is set to false, then will not download tar file again if it is
-    present (default ``False``).
+    present (default ``False``). If ``hashcode`` is given the bytes are hashed while
+    they are written and the file is checked against it before being moved in place.
     """
     outfile = os.path.join(path, fname)
     if not os.path.isdir(os.path.dirname(outfile)):
@@ -196,6 +278,8 @@ def download(url, path, fname, redownload=False, num_retries=5):
     exp_backoff = [2 ** r for r in reversed(range(retry))]
 
     pbar = tqdm.tqdm(unit='B', unit_scale=True, desc='Downloading {}'.format(fname))
+    sha256_hash = hashlib.sha256() if hashcode else None
+    hashed = 0
 
     while download and retry > 0:
         resume_file = outfile + '.part'
@@ -223,6 +307,10 @@ def download(url, path, fname, redownload=False, num_retries=5):
                     mode = 'wb'
 
                 CHUNK_SIZE = 32768
+                if sha256_hash is not None and hashed != resume_pos:
+                    # hash states can't be saved, so hash what an earlier run left once
+                    sha256_hash, hashed = hash_file(resume_file) if mode == 'ab' else (hashlib.sha256(), 0)
+
                 total_size = int(response.headers.get('Content-Length', -1))
                 # server returns remaining size if resuming, so adjust total
                 total_size += resume_pos
@@ -233,6 +321,9 @@ def download(url, path, fname, redownload=False, num_retries=5):
                     for chunk in response.iter_content(CHUNK_SIZE):
                         if chunk:  # filter out keep-alive new chunks
                             f.write(chunk)
+                            if sha256_hash is not None:
+                                sha256_hash.update(chunk)
+                                hashed += len(chunk)
                         if total_size > 0:
                             done += len(chunk)
                             if total_size < done:
@@ -244,6 +335,7 @@ def download(url, path, fname, redownload=False, num_retries=5):
             except (
                 requests.exceptions.ConnectionError,
                 requests.exceptions.ReadTimeout,
+                requests.exceptions.ChunkedEncodingError,
             ):
                 retry -= 1
                 pbar.clear()
@@ -268,11 +360,86 @@ def download(url, path, fname, redownload=False, num_retries=5):
                 f'Received less data than specified in Content-Length header for '
                 f'{url}. There may be a download problem.'
             )
+        if sha256_hash is not None:
+            verify_hash(resume_file, sha256_hash, hashcode, url, fname)
         move(resume_file, outfile)
 
     pbar.close()
     return outfile
 
+def hash_file(path):
+    """
+    Return the sha256 of the file and the number of bytes hashed.
+    """
+    sha256_hash = hashlib.sha256()
+    size = 0
+    with open(path, "rb") as f:
+        for byte_block in iter(lambda: f.read(65536), b""):
+            sha256_hash.update(byte_block)
+            size += len(byte_block)
+    return sha256_hash, size
+
+def verify_hash(path, sha256_hash, hashcode, url, fname):
+    """
+    Remove the file and raise if its hash isn't ``hashcode``.
+    """
+    if sha256_hash.hexdigest() != hashcode:
+        os.remove(path)
+        raise AssertionError(
+            f"[ Checksum for {fname} from \n{url}\n"
+            "does not match the expected checksum. Please try again. ]"
+        )
+    logger.debug("Checksum Successful")
+
+def download_segmented(url, path, fname, segments=segmented.SEGMENTS, redownload=False, hashcode=None):
+    """
+    Download file over ``segments`` connections using byte ranges.
+
+    Returns ``None`` when the server doesn't accept ranges or the file is too
+    small for several connections, ``download`` is used then. If ``hashcode``
+    is given the file is hashed in order as its segments complete and checked
+    against it.
+    """
+    outfile = os.path.join(path, fname)
+    if os.path.isfile(outfile) and not redownload:
+        return outfile
+    with segmented.pooled_session(segments) as session:
+        try:
+            total_size, accepts_ranges = segmented.probe(session, url)
+        except requests.exceptions.RequestException as e:
+            logger.info(f"Could not probe {url} ({e}), downloading over a single connection")
+            return None
+        if not accepts_ranges or total_size < segmented.MIN_SIZE:
+            return None
+        os.makedirs(path, exist_ok=True)
+        logger.info(f"Downloading {url} to {outfile} over {segments} connections")
+        pbar = tqdm.tqdm(unit='B', unit_scale=True, total=total_size, desc='Downloading {}'.format(fname))
+        sha256_hash = hashlib.sha256() if hashcode else None
+        try:
+            segmented.download(url, outfile, total_size, segments, session=session,
+                               progress=pbar.update, hasher=sha256_hash)
+        except segmented.RangeError as e:
+            logger.info(f"{e}, downloading over a single connection")
+            for stale in (outfile + '.part', outfile + '.part.json'):
+                if os.path.isfile(stale):
+                    os.remove(stale)
+            return None
+        finally:
+            pbar.close()
+    if sha256_hash is not None:
+        verify_hash(outfile, sha256_hash, hashcode, url, fname)
+    return outfile
+
+def remote_size(url):
+    """
+    Size in bytes advertised for ``url``, 0 if unknown.
+    """
+    try:
+        response = requests.head(url, allow_redirects=True, timeout=5)
+        return int(response.headers.get('Content-Length', 0))
+    except (requests.exceptions.RequestException, ValueError):
+        return 0
+
 def move(path1, path2):
     """
     Rename the given file.
@@ -298,25 +465,24 @@ class DownloadableFile:
 
         :param dpath: path to the downloaded file.
         """
-        sha256_hash = hashlib.sha256()
-        with open(os.path.join(dpath, self.file_name), "rb") as f:
-            for byte_block in iter(lambda: f.read(65536), b""):
-                sha256_hash.update(byte_block)
-            if sha256_hash.hexdigest() != self.hashcode:
-                # remove_dir(dpath)
-                raise AssertionError(
-                    f"[ Checksum for {self.file_name} from \n{self.url}\n"
-                    "does not match the expected checksum. Please try again. ]"
-                )
-            else:
-                logger.debug("Checksum Successful")
-
-    def download_file(self, dpath):
-        out_file = download(self.url, dpath, self.file_name)
+        path = os.path.join(dpath, self.file_name)
+        sha256_hash, _ = hash_file(path)
+        verify_hash(path, sha256_hash, self.hashcode, self.url, self.file_name)
+
+    def download_file(self, dpath, segments=segmented.SEGMENTS):
+        out_file = os.path.join(dpath, self.file_name)
+        if os.path.isfile(out_file):
+            # left by an earlier run, the only case where the file is read again
+            if self.hashcode:
+                self.checksum(dpath)
+            return out_file
+        # downloads check the hash while writing the file
+        out_file = None
+        if segments > 1:
+            out_file = download_segmented(self.url, dpath, self.file_name, segments, hashcode=self.hashcode)
+        if out_file is None:
+            out_file = download(self.url, dpath, self.file_name, hashcode=self.hashcode)
 
-        if self.hashcode:
-            self.checksum(dpath)
-        
         return out_file
 
 def collect_hash():
@@ -343,30 +509,183 @@ def get_all_downloadable_links():
             datasets_link[_link]['link'] = os.path.join(reddit_link, _link)
 
 
+def target_name(file_name):
+    return ''.join(file_name.split('.')[:-1]) + '.txt' + compress.extension(args.compression)
+
+def preprocess_compressed(archive, raw):
+    # filter the archive into the binary stream raw, return the compressed bytes written
+    counter = compress.CountingWriter(raw)
+    with compress.open_writer(counter, args.compression, args.compression_level) as fw:
+        preprocess_handler(archive, args.workers, fw)
+    if os.path.basename(archive) in file_stats:
+        file_stats[os.path.basename(archive)]['metrics']['bytes']['compressed'] = counter.written
+    return counter.written
+
+def write_stats(file_name, outfile):
+    """
+    Write the stats of preprocessing the archive as a JSON sidecar next to ``outfile``.
+
+    Returns the path of the sidecar, ``None`` when the archive wasn't
+    preprocessed by this run.
+    """
+    stats = file_stats.pop(file_name, None)
+    if stats is None:
+        return None
+    report = dict(stats.pop('metrics'), archive=file_name, output=os.path.basename(outfile), **stats)
+    sidecar = metrics.write_sidecar(outfile, report)
+    rejections = ', '.join(f'{reason} {count}' for reason, count in
+                           sorted(report['rejections'].items(), key=lambda item: -item[1]))
+    logger.info(f"{file_name}: {report['written']} of {report['lines']} records kept in "
+                f"{report['seconds']:.0f}s, rejected {rejections or 'none'}")
+    return sidecar
+
+def upload_stats(outfile, target):
+    # upload the sidecar of outfile next to target, if this or an earlier run wrote one
+    sidecar = metrics.sidecar_path(outfile)
+    if os.path.isfile(sidecar):
+        gcp.upload_from_filename(sidecar, metrics.sidecar_path(target))
+        if args.cleanup:
+            os.remove(sidecar)
+
+def stream_to_bucket(file_name, archive):
+    """
+    Preprocess the archive straight into a compressed streaming upload.
+
+    The archive is removed once the uploaded object has the size written,
+    an object of another size is recorded as failed and deleted.
+    """
+    target = os.path.join(args.gcs_path, target_name(file_name))
+    with gcp.upload_stream(target) as raw:
+        written = preprocess_compressed(archive, raw)
+    uploaded = gcp.size(target)
+    if uploaded != written:
+        # recorded first, the manifest never trusts the object even if deleting it fails
+        manifest.update(file_name, failed_target=target)
+        gcp.delete(target)
+        raise RuntimeError(f"{target} has {uploaded} bytes in the bucket, {written} were sent")
+    # the output only exists in the bucket, its sidecar goes next to the archive
+    write_stats(file_name, os.path.join(os.path.dirname(archive), target_name(file_name)))
+    upload_stats(os.path.join(os.path.dirname(archive), target_name(file_name)), target)
+    manifest.update(file_name, status='done', target=target, output_size=0, uploaded_size=uploaded,
+                    failed_target=None)
+    os.remove(archive)
+
+def has_output(file_name, record):
+    # an earlier run preprocessed the archive into the output this run uploads
+    return (manifest.reached(file_name, 'preprocessed') and os.path.isfile(record.get('output', ''))
+            and record['output'].endswith(target_name(file_name)))
+
+def download_stage(file_name):
+    fd = DownloadableFile(
+        datasets_link[file_name]['link'], file_name, datasets_link[file_name].get('hash')
+    )
+    record = manifest.get(file_name)
+    if has_output(file_name, record):
+        # an earlier run stopped before uploading
+        return file_name
+    if (manifest.reached(file_name, 'downloaded') and record.get('hash') == fd.hashcode
+            and os.path.isfile(record['archive']) and os.path.getsize(record['archive']) == record['size']):
+        # verified by an earlier run, no need to hash it again
+        return file_name
+    archive = fd.download_file(args.dpath, args.segments)
+    manifest.update(file_name, status='downloaded', hash=fd.hashcode, archive=archive,
+                    size=os.path.getsize(archive))
+    return file_name
+
+def preprocess_stage(file_name):
+    record = manifest.get(file_name)
+    if args.compression and args.gcs_path and not has_output(file_name, record):
+        # no output on local disk, the upload stage has nothing left to do
+        stream_to_bucket(file_name, record['archive'])
+        return file_name
+    if not has_output(file_name, record):
+        if args.compression:
+            outfile = os.path.join(os.path.dirname(record['archive']), target_name(file_name))
+            with open(outfile, 'wb') as fw:
+                preprocess_compressed(record['archive'], fw)
+        else:
+            outfile = preprocess_handler(record['archive'], args.workers)
+        write_stats(file_name, outfile)
+        manifest.update(file_name, status='preprocessed', output=outfile,
+                        output_size=os.path.getsize(outfile))
+    if args.cleanup and os.path.isfile(record['archive']):
+        os.remove(record['archive'])
+    return file_name
+
+def upload_stage(file_name):
+    if manifest.reached(file_name, 'done'):
+        # streamed to the bucket while preprocessing
+        return file_name
+    outfile = manifest.get(file_name)['output']
+    target = None
+    if args.gcs_path:
+        target = os.path.join(args.gcs_path, target_name(file_name))
+        gcp.upload_from_filename(outfile, target)
+        upload_stats(outfile, target)
+    manifest.update(file_name, status='done', target=target, failed_target=None)
+    if args.cleanup and target is not None:
+        # without a bucket the local output is the only copy
+        os.remove(outfile)
+    return file_name
+
+def local_size(file_name):
+    # bytes the output still holds on disk after preprocessing, freed once uploaded
+    if args.cleanup and args.gcs_path:
+        return manifest.get(file_name).get('output_size', 0)
+    return 0
+
 def distributed_download(download_batch: dict):
-    for k in random.sample(list(download_batch.keys()), k=len(list(download_batch.keys()))):
-        v = download_batch[k]
-        if v.get('link', False):
-            fd = DownloadableFile(
-                v['link'], k, None
-            )
-            if args.gcs_path:
-                gcs_files = gcp.list_files(args.gcs_path)
-            target_gcs_file = os.path.join(args.gcs_path, ''.join(k.split('.')[:-1]) + '.txt')
-            if target_gcs_file in gcs_files:
-                logger.info(f'{k} file is already preprocessed !')
-                continue
-            outfile = fd.download_file(args.dpath)
-            outfile = preprocess_handler(outfile)
-            file_name = os.path.split(outfile)[-1]
-            if args.gcs_path:
-                gcs_path = os.path.join(args.gcs_path, file_name)
-                gcp.upload_from_filename(outfile, gcs_path)
+    # download, preprocess and upload different archives at the same time
+    if args.gcs_path:
+        # a single listing of the bucket, skip decisions then only look at the manifest
+        listing = set(gcp.list_files(args.gcs_path))
+        manifest.reconcile({k: os.path.join(args.gcs_path, target_name(k)) for k in download_batch}, listing)
+
+    def plan():
+        for k in random.sample(list(download_batch.keys()), k=len(list(download_batch.keys()))):
+            v = download_batch[k]
+            if v.get('link', False):
+                if manifest.reached(k, 'done'):
+                    logger.info(f'{k} file is already preprocessed !')
+                    continue
+                yield k, k
+
+    budget = None
+    if args.disk_budget:
+        budget = pipeline.DiskBudget(int(args.disk_budget * 1024 ** 3))
+    scheduler = pipeline.Pipeline(
+        [
+            pipeline.Stage('download', download_stage, args.parallel_downloads),
+            pipeline.Stage('preprocess', preprocess_stage, args.parallel_preprocess, local_size),
+            pipeline.Stage('upload', upload_stage, args.parallel_uploads),
+        ],
+        budget=budget,
+        size=lambda k: remote_size(download_batch[k]['link']) if budget else 0,
+    )
+    stats = scheduler.run(plan())
+    logger.info(f"{stats['done']} files preprocessed, {len(stats['failed'])} failed {stats['failed']}")
+    if band_index is not None:
+        logger.info(f"{sum(duplicates.values())} near duplicate submissions removed")
+    return stats
 
 if __name__ == "__main__":
+    args = parser.parse_args()
+    langid_backend = args.langid
+    record_decoder = records.RecordDecoder(('title', 'selftext'), reject='over_18', backend=args.json_backend)
     reddit_link = args.reddit_link
     hash_link = args.hash_link
-    gcp = GCP_Service()
+    gcp = LocalStorage_Service(args.local_bucket) if args.local_bucket else GCP_Service()
+    gcp.configure(chunk_size=args.upload_chunk_size * 1024 * 1024, slices=args.upload_slices)
+    os.makedirs(args.dpath, exist_ok=True)
+    manifest = ProcessingManifest(args.manifest or os.path.join(args.dpath, 'manifest.json'))
+    progress_interval = args.progress_interval
+    if args.max_tokens is not None:
+        if not args.bpe_vocab:
+            parser.error('--max-tokens needs --bpe-vocab')
+        max_tokens, bpe_vocab = args.max_tokens, args.bpe_vocab
+    if args.dedup_threshold is not None:
+        minhasher = dedup.MinHasher(args.dedup_threshold, args.dedup_num_perm)
+        band_index = dedup.BandIndex(args.dedup_index or os.path.join(args.dpath, 'dedup.sqlite'))
     collect_hash()
     download_path = args.dpath
     get_all_downloadable_links()
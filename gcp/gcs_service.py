@@ -1,13 +1,20 @@
 # Google Cloud Settings
 
 """Google Cloud Storage Configuration."""
+import io
 import zipfile
 import os
+import uuid
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from os import environ, listdir
 from os.path import isfile, join
 from io import BytesIO, StringIO
 
+import google.auth
+from google.auth.transport.requests import AuthorizedSession
 from google.cloud import storage
+from google.resumable_media.requests import ResumableUpload
 
 import logging
 FORMAT = '%(asctime)-15s %(name)s %(levelname)s %(message)s'
@@ -15,34 +22,203 @@ logging.basicConfig(format=FORMAT)
 logger = logging.getLogger("data.storage.gcp")
 logger.setLevel("INFO")
 
+# resumable uploads send chunks of this size, it must be a multiple of 256 KB
+CHUNK_SIZE = 32 * 1024 * 1024
+# larger files are uploaded as parallel slices composed into one object
+COMPOSITE_THRESHOLD = 256 * 1024 * 1024
+SLICES = 8
+# most source objects a single compose request accepts
+MAX_COMPOSE = 32
+WORKERS = 8
+# JSON API endpoint starting a resumable upload session
+UPLOAD_URL = 'https://storage.googleapis.com/upload/storage/v1/b/{bucket}/o?uploadType=resumable'
+READ_WRITE_SCOPE = 'https://www.googleapis.com/auth/devstorage.read_write'
 
-class GCP_Service(object):
-    _obj = None
 
-    def __new__(cls, *args, **kargs):
-        if cls._obj:
-            return cls._obj
-        else:
-            instance = super(GCP_Service, cls).__new__(cls, *args, **kargs)
-            cls._obj = instance
-            return instance
+class SlidingBuffer(object):
+    """
+    The bytes of a streaming upload not sent yet, read by ``ResumableUpload`` like a file.
 
+    Positions count from the start of the upload, :meth:`flush` drops the
+    bytes read so far.
+    """
 
-    def __init__(self, bucket_name:str = None):
-        # Google Cloud Storage
-        logger.info("Initializing GCP services..")
-        self.bucket_name = environ.get('GCP_BUCKET_NAME','kubeflow-blenderbot-fusemachineschat') if bucket_name == None else bucket_name
-        assert self.bucket_name, "Please provide BUCKET NAME."
+    def __init__(self):
+        self._buffer = bytearray()
+        # upload position of the first byte of the buffer, and of the next byte read
+        self._start = 0
+        self._cursor = 0
 
-        self.storage_client = storage.Client()
-        self.bucket = self.storage_client.get_bucket(self.bucket_name)
+    def write(self, data) -> int:
+        self._buffer += data
+        return len(data)
+
+    def read(self, size:int = -1) -> bytes:
+        position = self._cursor - self._start
+        end = len(self._buffer) if size is None or size < 0 else position + size
+        data = bytes(self._buffer[position:end])
+        self._cursor += len(data)
+        return data
+
+    def tell(self) -> int:
+        return self._cursor
+
+    def seek(self, position:int, whence:int = io.SEEK_SET) -> int:
+        if whence != io.SEEK_SET or not self._start <= position <= self._start + len(self._buffer):
+            raise ValueError(f'cannot seek to {position}, the buffer holds bytes {self._start} and later')
+        self._cursor = position
+        return position
+
+    def flush(self):
+        del self._buffer[:self._cursor - self._start]
+        self._start = self._cursor
+
+    def unread(self) -> int:
+        return self._start + len(self._buffer) - self._cursor
+
+
+class ResumableStreamWriter(io.RawIOBase):
+    """
+    Binary file object sending its bytes to a new object as a resumable upload.
+
+    Built on ``google.resumable_media.requests.ResumableUpload``, so it only
+    needs the google-resumable-media version the repo pins. Every
+    ``chunk_size`` bytes written are sent as one request, the last and
+    shorter chunk sent by :meth:`close` creates the object. :meth:`abort`
+    cancels the session instead, no object is created.
+    """
+
+    def __init__(self, transport, bucket_name:str, destpath:str, chunk_size:int):
+        self.transport = transport
+        self.buffer = SlidingBuffer()
+        self.upload = ResumableUpload(UPLOAD_URL.format(bucket=bucket_name), chunk_size)
+        self.upload.initiate(transport, self.buffer, {'name': destpath}, 'application/octet-stream',
+                             stream_final=False)
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self.buffer.write(data)
+        while self.buffer.unread() >= self.upload.chunk_size:
+            self.upload.transmit_next_chunk(self.transport)
+            self.buffer.flush()
+        return len(data)
+
+    def close(self):
+        if self.closed:
+            return
+        # less than chunk_size bytes are left, possibly none: this chunk is the last one
+        while not self.upload.finished:
+            self.upload.transmit_next_chunk(self.transport)
+            self.buffer.flush()
+        super().close()
+
+    def abort(self):
+        if self.closed:
+            return
+        # the last chunk is never sent, cancelling the session drops the chunks sent so far
+        try:
+            self.transport.request('DELETE', self.upload.resumable_url)
+        except Exception:
+            logger.warning(f'Could not cancel the upload session {self.upload.resumable_url}.')
+        super().close()
+
+
+class StorageService(object):
+    """
+    Uploads, downloads and listings of the objects of ``self.bucket``.
+
+    Subclasses set ``self.bucket`` to a ``google.cloud.storage.Bucket``, or
+    to an object with the same methods, and call :meth:`configure`.
+    """
+
+    def configure(self, chunk_size:int = CHUNK_SIZE, composite_threshold:int = COMPOSITE_THRESHOLD,
+                  slices:int = SLICES, workers:int = WORKERS):
+        assert chunk_size % (256 * 1024) == 0, "chunk_size must be a multiple of 256 KB."
+        self.chunk_size = chunk_size
+        self.composite_threshold = composite_threshold
+        self.slices = max(1, slices)
+        self.workers = max(1, workers)
 
     def upload_from_filename(self, filename:str, destpath:str):
-        # Upload local file to bucket
-        blob = self.bucket.blob(destpath)
-        blob.upload_from_filename(filename)
+        # Upload local file to bucket, as a resumable upload sent in chunks,
+        # or as parallel slices for large files
+        size = os.path.getsize(filename)
+        if size > self.composite_threshold and self.slices > 1:
+            self._upload_composite(filename, destpath, size)
+        else:
+            blob = self.bucket.blob(destpath, chunk_size=self.chunk_size)
+            blob.upload_from_filename(filename)
         logger.info(f'Uploaded {filename} to "{self.bucket}" bucket.')
 
+    @contextmanager
+    def upload_stream(self, destpath:str):
+        """
+        Yield a binary file object whose bytes are sent to destpath as a resumable upload.
+
+        Bytes go out in chunk_size pieces as they are written, the object is
+        complete once the block exits. If the block raises, the upload is
+        aborted before its last chunk, so no partial object is created.
+        """
+        writer = self._stream_writer(destpath)
+        try:
+            yield writer
+        except BaseException:
+            writer.abort()
+            raise
+        writer.close()
+        logger.info(f'Streamed {destpath} to "{self.bucket}" bucket.')
+
+    def _stream_writer(self, destpath:str):
+        # buckets whose blobs open for writing, like LocalBucket
+        return self.bucket.blob(destpath, chunk_size=self.chunk_size).open('wb')
+
+    def size(self, bucket_filename:str) -> int:
+        # Size of the object in bytes, None if it doesn't exist
+        blob = self.bucket.get_blob(bucket_filename)
+        return blob.size if blob is not None else None
+
+    def _upload_slice(self, filename:str, destpath:str, start:int, length:int):
+        blob = self.bucket.blob(destpath, chunk_size=self.chunk_size)
+        with open(filename, 'rb') as fp:
+            fp.seek(start)
+            blob.upload_from_file(fp, size=length)
+        return blob
+
+    def _upload_composite(self, filename:str, destpath:str, size:int):
+        """
+        Upload slices of the file in parallel and compose them into destpath.
+
+        Slices are temporary objects next to destpath, removed once composed.
+        """
+        step = -(-size // self.slices)
+        prefix = f'{destpath}.slices-{uuid.uuid4().hex[:8]}'
+        slices = [(f'{prefix}/{i:04d}', start, min(step, size - start))
+                  for i, start in enumerate(range(0, size, step))]
+        temporary = [name for name, _, _ in slices]
+        try:
+            with ThreadPoolExecutor(self.workers) as executor:
+                sources = list(executor.map(lambda s: self._upload_slice(filename, *s), slices))
+            # a compose request takes at most MAX_COMPOSE sources, merge in rounds
+            round_index = 0
+            while len(sources) > MAX_COMPOSE:
+                merged = []
+                for i in range(0, len(sources), MAX_COMPOSE):
+                    blob = self.bucket.blob(f'{prefix}/r{round_index}-{i:04d}')
+                    blob.compose(sources[i:i + MAX_COMPOSE])
+                    temporary.append(blob.name)
+                    merged.append(blob)
+                sources = merged
+                round_index += 1
+            self.bucket.blob(destpath).compose(sources)
+        finally:
+            for name in temporary:
+                try:
+                    self.bucket.delete_blob(name)
+                except Exception:
+                    logger.warning(f'Could not delete temporary object {name}.')
+
     def upload_from_file(self, file_obj, despath:str):
         """
         @file_obj: file object to upload to the bucket
@@ -55,11 +231,16 @@ class GCP_Service(object):
 
 
     def upload_all(self, local_dir:str, bucket_dir:str):
-        files = [f for f in listdir(local_dir) if isfile(join(local_dir, f))]
-        for file in files: # TODO recursive upload
-            local_file = os.path.join(local_dir,file)
-            blob = self.bucket.blob(os.path.join(bucket_dir,file))
-            blob.upload_from_filename(local_file)
+        # Upload every file below local_dir, keeping the directory structure
+        files = []
+        for dirpath, _, filenames in os.walk(local_dir):
+            for file in filenames:
+                files.append(os.path.relpath(os.path.join(dirpath, file), local_dir))
+        with ThreadPoolExecutor(self.workers) as executor:
+            list(executor.map(
+                lambda file: self.upload_from_filename(
+                    os.path.join(local_dir, file), os.path.join(bucket_dir, file.replace(os.sep, '/'))),
+                files))
         logger.info(f'Uploaded {files} to "{self.bucket}" bucket.')
 
     def list_files(self, bucket_dir:str) -> list:
@@ -68,21 +249,23 @@ class GCP_Service(object):
         file_list = [file.name for file in files]
         return file_list
 
+    def _download_blob(self, b_file:str, bucket_dir:str, local_dir:str):
+        try:
+            blob = self.bucket.blob(b_file)
+            file_name = blob.name.replace(bucket_dir,'')[1:]
+            dest_file = os.path.join(local_dir, file_name)
+            if not os.path.isdir(os.path.dirname(dest_file)):
+                os.makedirs(os.path.dirname(dest_file), exist_ok=True)
+            blob.download_to_filename(dest_file)
+            logger.info(f'{dest_file} downloaded from bucket.')
+        except Exception as e:
+            logger.error(f'Could not download {b_file}: {e}')
+
     def download_all(self, bucket_dir:str, local_dir:str):
-        print(bucket_dir, local_dir)
-        bucket_files = self.list_files(bucket_dir)
-        for b_file in bucket_files:
-            try:
-                blob = self.bucket.blob(b_file)
-                file_name = blob.name.replace(bucket_dir,'')[1:]
-                dest_file = os.path.join(local_dir, file_name)
-                if not os.path.isdir(os.path.dirname(dest_file)):
-                    os.makedirs(os.path.dirname(dest_file), exist_ok=True)
-                blob.download_to_filename(dest_file)
-                logger.info(f'{dest_file} downloaded from bucket.')
-            except:
-                print('raise exception')
-                continue
+        # Download every file below bucket_dir, keeping the directory structure
+        bucket_files = [f for f in self.list_files(bucket_dir) if not f.endswith('/')]
+        with ThreadPoolExecutor(self.workers) as executor:
+            list(executor.map(lambda b_file: self._download_blob(b_file, bucket_dir, local_dir), bucket_files))
 
     def download(self, bucket_filename:str, local_dir:str) -> str:
         blob = self.bucket.blob(bucket_filename)
@@ -120,4 +303,42 @@ class GCP_Service(object):
         zip = zipfile.ZipFile(downloaded_file)
         zip.extractall(destination)
         zip.close()
-        logger.info("Successfully prepared directory.")
\ No newline at end of file
+        logger.info("Successfully prepared directory.")
+
+
+class GCP_Service(StorageService):
+    _obj = None
+
+    def __new__(cls, *args, **kargs):
+        if cls._obj:
+            return cls._obj
+        else:
+            instance = super(GCP_Service, cls).__new__(cls)
+            cls._obj = instance
+            return instance
+
+
+    def __init__(self, bucket_name:str = None, chunk_size:int = CHUNK_SIZE,
+                 composite_threshold:int = COMPOSITE_THRESHOLD, slices:int = SLICES, workers:int = WORKERS):
+        """
+        @chunk_size: bytes sent per request of resumable uploads
+        @composite_threshold: files larger than this are uploaded as parallel slices
+        @slices: number of slices of composite uploads
+        @workers: number of threads of composite uploads, upload_all and download_all
+        """
+        # Google Cloud Storage
+        logger.info("Initializing GCP services..")
+        self.bucket_name = environ.get('GCP_BUCKET_NAME','kubeflow-blenderbot-fusemachineschat') if bucket_name == None else bucket_name
+        assert self.bucket_name, "Please provide BUCKET NAME."
+        self.configure(chunk_size, composite_threshold, slices, workers)
+
+        self.storage_client = storage.Client()
+        self.bucket = self.storage_client.get_bucket(self.bucket_name)
+        self.transport = None
+
+    def _stream_writer(self, destpath:str):
+        # Blob.open needs google-cloud-storage 1.38 or later, the pinned google-resumable-media has ResumableUpload
+        if self.transport is None:
+            credentials, _ = google.auth.default(scopes=[READ_WRITE_SCOPE])
+            self.transport = AuthorizedSession(credentials)
+        return ResumableStreamWriter(self.transport, self.bucket_name, destpath, self.chunk_size)
@@ -0,0 +1,204 @@
+"""
+Storage of the outputs in a local directory instead of a Google Cloud Storage bucket.
+
+Used by ``build.py --local-bucket <dir>``.
+"""
+import io
+import os
+import shutil
+import tempfile
+import threading
+
+from gcp.gcs_service import CHUNK_SIZE, COMPOSITE_THRESHOLD, SLICES, WORKERS, StorageService
+
+
+class LocalBlob(object):
+    """
+    A file of a :class:`LocalBucket`, with the methods of ``google.cloud.storage.Blob`` used by :class:`StorageService`.
+
+    Uploads are written to a temporary file in ``chunk_size`` pieces and
+    moved in place once complete, like a resumable upload only becomes
+    visible once its last chunk arrived.
+    """
+
+    def __init__(self, bucket, name:str, chunk_size:int = None):
+        self.bucket = bucket
+        self.name = name
+        self.chunk_size = chunk_size
+
+    @property
+    def path(self) -> str:
+        return os.path.join(self.bucket.root, self.name.lstrip('/'))
+
+    @property
+    def size(self) -> int:
+        return os.path.getsize(self.path) if os.path.isfile(self.path) else None
+
+    def upload_from_file(self, file_obj, rewind:bool = False, size:int = None, content_type:str = None):
+        if rewind:
+            file_obj.seek(0)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.path), prefix='.upload-')
+        chunk_size = self.chunk_size or CHUNK_SIZE
+        remaining = size
+        with os.fdopen(fd, 'wb') as fw:
+            while remaining is None or remaining > 0:
+                chunk = file_obj.read(chunk_size if remaining is None else min(chunk_size, remaining))
+                if not chunk:
+                    break
+                if isinstance(chunk, str):
+                    chunk = chunk.encode('utf-8')
+                fw.write(chunk)
+                self.bucket.request()
+                if remaining is not None:
+                    remaining -= len(chunk)
+        os.replace(tmp, self.path)
+
+    def open(self, mode:str = 'rb', chunk_size:int = None, ignore_flush:bool = False):
+        if mode == 'rb':
+            return open(self.path, 'rb')
+        if mode != 'wb':
+            raise ValueError(f'unsupported mode {mode}')
+        return LocalBlobWriter(self, chunk_size or self.chunk_size or CHUNK_SIZE)
+
+    def upload_from_filename(self, filename:str, content_type:str = None):
+        with open(filename, 'rb') as fp:
+            self.upload_from_file(fp)
+
+    def upload_from_string(self, data, content_type:str = None):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, 'wb') as fw:
+            fw.write(data)
+
+    def compose(self, sources:list):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.path), prefix='.compose-')
+        with os.fdopen(fd, 'wb') as fw:
+            for source in sources:
+                with open(source.path, 'rb') as fp:
+                    shutil.copyfileobj(fp, fw)
+        os.replace(tmp, self.path)
+        self.bucket.request()
+        with self.bucket.lock:
+            self.bucket.composed += 1
+
+    def download_to_filename(self, filename:str):
+        shutil.copyfile(self.path, filename)
+
+    def download_to_file(self, file_obj):
+        with open(self.path, 'rb') as fp:
+            shutil.copyfileobj(fp, file_obj)
+
+    def download_as_string(self) -> bytes:
+        with open(self.path, 'rb') as fp:
+            return fp.read()
+
+    download_as_bytes = download_as_string
+
+
+class LocalBlobWriter(io.RawIOBase):
+    """
+    Streaming upload to a :class:`LocalBlob`, like ``google.cloud.storage.fileio.BlobWriter``.
+
+    Every ``chunk_size`` bytes written count as one request, the blob appears
+    once the writer is closed and never if it is aborted.
+    """
+
+    def __init__(self, blob:LocalBlob, chunk_size:int):
+        self.blob = blob
+        self.chunk_size = chunk_size
+        self.buffered = 0
+        os.makedirs(os.path.dirname(blob.path), exist_ok=True)
+        fd, self.tmp = tempfile.mkstemp(dir=os.path.dirname(blob.path), prefix='.upload-')
+        self.fw = os.fdopen(fd, 'wb')
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self.fw.write(data)
+        self.buffered += len(data)
+        while self.buffered >= self.chunk_size:
+            self.buffered -= self.chunk_size
+            self.blob.bucket.request()
+        return len(data)
+
+    def close(self):
+        if self.closed:
+            return
+        self.fw.close()
+        self.blob.bucket.request()
+        os.replace(self.tmp, self.blob.path)
+        super().close()
+
+    def abort(self):
+        if self.closed:
+            return
+        self.fw.close()
+        os.remove(self.tmp)
+        super().close()
+
+
+class LocalBucket(object):
+    """
+    A directory with the methods of ``google.cloud.storage.Bucket`` used by :class:`StorageService`.
+
+    Objects are the files below ``root``, named by their path relative to it.
+    """
+
+    def __init__(self, root:str):
+        self.root = root
+        self.name = os.path.basename(os.path.abspath(root))
+        self.lock = threading.Lock()
+        # requests a bucket would have received, one per upload chunk and compose
+        self.requests = 0
+        self.composed = 0
+        os.makedirs(root, exist_ok=True)
+
+    def request(self):
+        with self.lock:
+            self.requests += 1
+
+    def __str__(self):
+        return self.name
+
+    def blob(self, blob_name:str, chunk_size:int = None) -> LocalBlob:
+        return LocalBlob(self, blob_name, chunk_size)
+
+    def get_blob(self, blob_name:str):
+        blob = LocalBlob(self, blob_name)
+        return blob if os.path.isfile(blob.path) else None
+
+    def list_blobs(self, prefix:str = None):
+        blobs = []
+        for dirpath, _, filenames in os.walk(self.root):
+            for file in filenames:
+                if file.startswith(('.upload-', '.compose-')):
+                    continue
+                name = os.path.relpath(os.path.join(dirpath, file), self.root).replace(os.sep, '/')
+                if name.startswith(prefix or ''):
+                    blobs.append(LocalBlob(self, name))
+        return sorted(blobs, key=lambda blob: blob.name)
+
+    def delete_blob(self, blob_name:str):
+        os.remove(os.path.join(self.root, blob_name.lstrip('/')))
+
+
+class LocalStorage_Service(StorageService):
+    """
+    :class:`StorageService` of a local directory, for runs without a bucket.
+
+    Blobs are files below ``root``, named by their bucket path, so uploads,
+    composite uploads and listings run the same code as with a real bucket.
+    An upload is written to a temporary file and only moved in place once
+    complete, so an interrupted upload never leaves a partial object.
+    """
+
+    def __init__(self, root:str, chunk_size:int = CHUNK_SIZE, composite_threshold:int = COMPOSITE_THRESHOLD,
+                 slices:int = SLICES, workers:int = WORKERS):
+        self.configure(chunk_size, composite_threshold, slices, workers)
+        self.root = root
+        self.bucket = LocalBucket(root)
+        self.bucket_name = self.bucket.name
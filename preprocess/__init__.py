@@ -0,0 +1 @@
+# Preprocessing engine for the pushshift dumps used by build.py
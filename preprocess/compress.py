@@ -0,0 +1,60 @@
+"""
+Compressed text outputs for build.py.
+
+Outputs are compressed on the fly into any binary stream, a local file or a
+streaming upload to the bucket, so an uncompressed output never has to be
+kept on disk.
+"""
+
+import gzip
+import io
+
+import zstandard as zstd
+
+# codec name -> extension appended to the output name
+CODECS = {'zst': '.zst', 'gz': '.gz'}
+LEVELS = {'zst': 10, 'gz': 6}
+
+
+class CountingWriter(io.RawIOBase):
+    """
+    Pass writes on to ``raw`` and count the bytes, without ever closing it.
+
+    :param raw: binary stream receiving the bytes.
+    """
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.written = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self.raw.write(data)
+        self.written += len(data)
+        return len(data)
+
+
+def extension(codec: str) -> str:
+    """Return the extension of outputs compressed with ``codec``, empty for none."""
+    return CODECS.get(codec, '') if codec else ''
+
+
+def open_writer(raw, codec: str, level: int = None) -> io.TextIOWrapper:
+    """
+    Open a text stream compressing what is written to it into ``raw``.
+
+    Closing the text stream ends the compressed stream, ``raw`` stays open.
+
+    :param codec: one of :data:`CODECS`.
+    :param level: compression level, defaults to :data:`LEVELS` of the codec.
+    """
+    if codec not in CODECS:
+        raise ValueError(f"unknown codec {codec}, choose from {sorted(CODECS)}")
+    level = LEVELS[codec] if level is None else level
+    if codec == 'zst':
+        binary = zstd.ZstdCompressor(level=level).stream_writer(raw, closefd=False)
+    else:
+        binary = gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=level)
+    return io.TextIOWrapper(binary, encoding='utf-8')
@@ -0,0 +1,284 @@
+"""
+Parallel decompression of bz2 and multi-frame zstd archives.
+
+bz2 streams are a sequence of independently compressed blocks, each starting
+with a bit aligned 48-bit magic. Every block is cut out of the archive,
+re-wrapped as a one block bz2 stream and decompressed on its own core. zstd
+archives written by pzstd or ``zstd -T`` hold several frames which can be
+decompressed independently as well. Pieces are decompressed by a process pool
+and handed back in archive order; archives which can't be split are read with
+the single threaded reader of :mod:`preprocess.stream`. The caller sizes the
+pool, :func:`split_workers` shares its cores between decompression and the
+parsing workers reading the chunks.
+"""
+
+import bz2
+import logging
+import multiprocessing
+import os
+import struct
+import threading
+
+import zstandard as zstd
+
+from preprocess import stream
+
+logger = logging.getLogger("preprocess.decompress")
+
+BZ2_BLOCK_MAGIC = 0x314159265359
+BZ2_EOS_MAGIC = 0x177245385090
+_BZ2_BLOCK_BYTES = BZ2_BLOCK_MAGIC.to_bytes(6, 'big')
+_BZ2_EOS_BYTES = BZ2_EOS_MAGIC.to_bytes(6, 'big')
+
+ZSTD_MAGIC = 0xFD2FB528
+ZSTD_SKIPPABLE_MASK = 0xFFFFFFF0
+ZSTD_SKIPPABLE_MAGIC = 0x184D2A50
+
+SCAN_BYTES = 32 * 1024 * 1024
+# frames bigger than this are not worth holding in a worker's memory at once
+MAX_FRAME_BYTES = 256 * 1024 * 1024
+# decompressed MB/s of one core, measured with benchmarks.bench_decompress
+DECOMPRESS_RATES = {'bz2': 19.0, 'zst': 500.0}
+# MB/s of submissions one core parses and filters, build.preprocess_batch
+PARSE_RATE = 8.0
+
+
+class SplitError(Exception):
+    """A piece of a split archive could not be decompressed on its own."""
+
+
+def _find_bits(window: bytes, base_bit: int, limit_bit: int):
+    """Yield ``(bit_position, kind)`` of the bz2 markers in ``window``."""
+    value = int.from_bytes(window, 'big')
+    for shift in range(8):
+        shifted = (value << shift).to_bytes(len(window) + 1, 'big')
+        for kind, magic in (('block', _BZ2_BLOCK_BYTES), ('eos', _BZ2_EOS_BYTES)):
+            k = shifted.find(magic)
+            while k != -1:
+                bit = base_bit + 8 * k - 8 + shift
+                if base_bit <= bit < limit_bit:
+                    yield bit, kind
+                k = shifted.find(magic, k + 1)
+
+
+def bz2_blocks(path: str, scan_bytes: int = SCAN_BYTES):
+    """
+    Yield the ``(start_bit, end_bit)`` span of every block of a bz2 archive.
+
+    The archive is scanned window by window, so blocks are found while the
+    previous ones are already being decompressed.
+    """
+    overlap = len(_BZ2_BLOCK_BYTES)
+    start = None
+    offset = 0
+    with open(path, 'rb') as fp:
+        while True:
+            fp.seek(offset)
+            window = fp.read(scan_bytes + overlap)
+            if not window:
+                break
+            limit = 8 * (offset + min(scan_bytes, len(window)))
+            for bit, kind in sorted(_find_bits(window, 8 * offset, limit)):
+                if start is not None:
+                    yield start, bit
+                start = bit if kind == 'block' else None
+            if len(window) <= scan_bytes:
+                break
+            offset += scan_bytes
+    if start is not None:
+        raise SplitError(f"{path} ends without a bz2 end of stream marker")
+
+
+def _decompress_bz2_block(args):
+    path, start_bit, end_bit = args
+    first, last = start_bit // 8, (end_bit + 7) // 8
+    with open(path, 'rb') as fp:
+        fp.seek(first)
+        chunk = fp.read(last - first)
+    nbits = end_bit - start_bit
+    value = int.from_bytes(chunk, 'big')
+    value = (value >> (8 * len(chunk) - (start_bit % 8) - nbits)) & ((1 << nbits) - 1)
+    # the combined crc of a one block stream is the crc of that block
+    block_crc = (value >> (nbits - 80)) & 0xFFFFFFFF
+    value = (value << 80) | (BZ2_EOS_MAGIC << 32) | block_crc
+    nbits += 80
+    pad = -nbits % 8
+    data = b'BZh9' + (value << pad).to_bytes((nbits + pad) // 8, 'big')
+    try:
+        return bz2.decompress(data)
+    except (OSError, ValueError):
+        return None
+
+
+def _read_exactly(fp, size: int, path: str, offset: int) -> bytes:
+    data = fp.read(size)
+    if len(data) < size:
+        raise SplitError(f"{path}: truncated zstd frame at byte {offset}")
+    return data
+
+
+def zstd_frames(path: str):
+    """
+    Return the ``(offset, length)`` of every zstd frame of ``path``.
+
+    Only the frame and block headers are read, skippable frames are left out.
+    A truncated or garbage tail raises :class:`SplitError`.
+    """
+    frames = []
+    size = os.path.getsize(path)
+    with open(path, 'rb') as fp:
+        offset = 0
+        while offset < size:
+            fp.seek(offset)
+            magic, = struct.unpack('<I', _read_exactly(fp, 4, path, offset))
+            if magic & ZSTD_SKIPPABLE_MASK == ZSTD_SKIPPABLE_MAGIC:
+                skip, = struct.unpack('<I', _read_exactly(fp, 4, path, offset))
+                offset += 8 + skip
+                continue
+            if magic != ZSTD_MAGIC:
+                raise SplitError(f"{path}: no zstd frame at byte {offset}")
+            descriptor = _read_exactly(fp, 1, path, offset)[0]
+            fcs_flag = descriptor >> 6
+            single_segment = (descriptor >> 5) & 1
+            has_checksum = (descriptor >> 2) & 1
+            dict_size = (0, 1, 2, 4)[descriptor & 3]
+            fcs_size = (single_segment, 2, 4, 8)[fcs_flag]
+            position = offset + 5 + (not single_segment) + dict_size + fcs_size
+            while True:
+                fp.seek(position)
+                header = int.from_bytes(_read_exactly(fp, 3, path, offset), 'little')
+                block_type = (header >> 1) & 3
+                if block_type == 3:
+                    raise SplitError(f"{path}: reserved zstd block type at byte {position}")
+                position += 3 + (1 if block_type == 1 else header >> 3)
+                if header & 1:
+                    break
+            position += 4 * has_checksum
+            if position > size:
+                raise SplitError(f"{path}: truncated zstd frame at byte {offset}")
+            frames.append((offset, position - offset))
+            offset = position
+    return frames
+
+
+def _decompress_zstd_frame(args):
+    path, offset, length = args
+    with open(path, 'rb') as fp:
+        fp.seek(offset)
+        frame = fp.read(length)
+    dctx = zstd.ZstdDecompressor(max_window_size=stream.ZSTD_MAX_WINDOW)
+    try:
+        return dctx.decompressobj().decompress(frame)
+    except zstd.ZstdError:
+        return None
+
+
+def _pieces(path: str):
+    """Return the worker function and the pieces of ``path``, or ``None``."""
+    name = stream.codec(path)
+    if name == 'bz2':
+        return _decompress_bz2_block, ((path, s, e) for s, e in bz2_blocks(path))
+    if name == 'zst':
+        frames = zstd_frames(path)
+        if len(frames) > 1 and max(length for _, length in frames) <= MAX_FRAME_BYTES:
+            return _decompress_zstd_frame, ((path, o, n) for o, n in frames)
+    return None
+
+
+def _serial_chunks(path: str, skip: int = 0, chunk_size: int = stream.READ_BUFFER):
+    with stream.open_compressed(path) as fp:
+        while skip > 0:
+            skipped = len(fp.read(min(skip, chunk_size)))
+            if not skipped:
+                return
+            skip -= skipped
+        for chunk in iter(lambda: fp.read(chunk_size), b''):
+            yield chunk
+
+
+def split_workers(path: str, workers: int, parse_rate: float = PARSE_RATE) -> tuple:
+    """
+    Return the ``(decompressing, parsing)`` processes sharing ``workers`` cores.
+
+    Cores are shared in proportion to the time a byte takes to decompress
+    and to parse, so neither stage waits on the other. When a single core
+    keeps up, the archive is read by the single threaded reader, which gets
+    ``1`` and leaves every worker to parsing.
+    """
+    rate = DECOMPRESS_RATES.get(stream.codec(path))
+    if rate is None:
+        return 1, workers
+    decompressing = round(workers * parse_rate / (parse_rate + rate))
+    if decompressing < 2:
+        return 1, workers
+    return decompressing, workers - decompressing
+
+
+def iter_chunks(path: str, processes: int, max_pending: int = None):
+    """
+    Yield the decompressed content of ``path`` as ``bytes`` chunks, in order.
+
+    bz2 blocks and zstd frames are decompressed on ``processes`` cores, the
+    caller's share of the machine (see :func:`split_workers`). The single
+    threaded reader is used when the archive can't be split or ``processes``
+    is 1, or takes over where a piece failed to decompress on its own, e.g.
+    when a bz2 marker turned out to be part of the compressed data.
+    """
+    try:
+        split = _pieces(path) if processes > 1 else None
+    except SplitError as e:
+        logger.info(f"{e}, decompressing on a single core")
+        split = None
+    if split is None:
+        yield from _serial_chunks(path)
+        return
+
+    fn, pieces = split
+    slots = threading.Semaphore(max_pending or 2 * processes)
+    emitted = 0
+
+    def feed():
+        for piece in pieces:
+            slots.acquire()
+            yield piece
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        for chunk in pool.imap(fn, feed()):
+            slots.release()
+            if chunk is None:
+                raise SplitError(f"{path}: piece after byte {emitted} failed to decompress")
+            emitted += len(chunk)
+            yield chunk
+        pool.close()
+    except SplitError as e:
+        pool.terminate()
+        logger.warning(f"{e}, decompressing the rest on a single core")
+        yield from _serial_chunks(path, skip=emitted)
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def iter_batches(path: str, processes: int, batch_bytes: int = stream.BATCH_BYTES):
+    """Yield lists of raw ``bytes`` lines of ``path`` decompressed on ``processes`` cores."""
+    tail = b''
+    batch = []
+    size = 0
+    for chunk in iter_chunks(path, processes):
+        lines = (tail + chunk).split(b'\n')
+        tail = lines.pop()
+        for line in lines:
+            if line:
+                batch.append(line)
+                size += len(line)
+        if size >= batch_bytes:
+            yield batch
+            batch = []
+            size = 0
+    if tail:
+        batch.append(tail)
+    if batch:
+        yield batch
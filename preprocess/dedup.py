@@ -0,0 +1,168 @@
+"""
+Near-duplicate detection of the texts of build.py with MinHash and LSH.
+
+Every text is cut into word shingles, hashed once with ``zlib.crc32`` and
+MinHash signatures of a whole batch are computed with a single NumPy
+product of the shingle hashes and the ``num_perm`` hash permutations. The
+signature is cut into ``bands`` bands of ``rows`` values, two texts sharing
+a band have a Jaccard similarity around the threshold or above. The bands
+of the kept texts are stored in an on-disk :class:`BandIndex`, so texts are
+deduplicated across archives and runs without holding every band in memory.
+"""
+
+import logging
+import sqlite3
+import threading
+import zlib
+
+import numpy as np
+
+logger = logging.getLogger("preprocess.dedup")
+
+NUM_PERM = 64
+SHINGLE_SIZE = 3
+# shorter texts are never duplicates, they are mostly generic replies
+MIN_WORDS = 8
+MERSENNE_PRIME = (1 << 61) - 1
+_MAX_HASH = np.uint64(0xFFFFFFFF)
+# sqlite limits the number of parameters of a statement
+_QUERY_KEYS = 500
+
+
+def lsh_params(threshold: float, num_perm: int = NUM_PERM) -> tuple:
+    """
+    Return the ``(bands, rows)`` whose S-curve threshold is closest to ``threshold``.
+
+    Texts sharing a band have a Jaccard similarity of about
+    ``(1 / bands) ** (1 / rows)`` or more.
+    """
+    if not 0 < threshold < 1:
+        raise ValueError(f"threshold must be in the range (0-1), got {threshold}")
+    return min(((num_perm // rows, rows) for rows in range(1, num_perm + 1)),
+               key=lambda params: abs((1 / params[0]) ** (1 / params[1]) - threshold))
+
+
+def shingle_hashes(text: str, size: int = SHINGLE_SIZE) -> list:
+    """Return the crc32 of every ``size`` word shingle of the lower cased text."""
+    words = text.lower().split()
+    if len(words) <= size:
+        return [zlib.crc32(' '.join(words).encode('utf-8'))]
+    return [zlib.crc32(' '.join(words[i:i + size]).encode('utf-8'))
+            for i in range(len(words) - size + 1)]
+
+
+class MinHasher:
+    """
+    MinHash signatures and LSH band keys of batches of texts.
+
+    :param threshold: Jaccard similarity from which texts are duplicates.
+    :param num_perm: number of hash permutations of a signature.
+    :param seed: seed of the permutations, texts only share bands with
+        texts hashed with the same seed.
+    """
+
+    def __init__(self, threshold: float, num_perm: int = NUM_PERM, seed: int = 0,
+                 shingle_size: int = SHINGLE_SIZE, min_words: int = MIN_WORDS):
+        self.threshold = threshold
+        self.bands, self.rows = lsh_params(threshold, num_perm)
+        self.shingle_size = shingle_size
+        self.min_words = min_words
+        rng = np.random.RandomState(seed)
+        self.a = rng.randint(1, MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+        self.b = rng.randint(0, MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+        # odd multipliers folding the rows of a band into one key
+        self.fold = rng.randint(1, 1 << 62, size=self.rows, dtype=np.uint64) * 2 + 1
+        self.band_ids = np.arange(self.bands, dtype=np.uint64) << np.uint64(56)
+
+    def signatures(self, texts: list) -> np.ndarray:
+        """Return the ``(len(texts), num_perm)`` MinHash signatures of ``texts``."""
+        hashes = []
+        starts = []
+        for text in texts:
+            starts.append(len(hashes))
+            hashes.extend(shingle_hashes(text, self.shingle_size))
+        if not texts:
+            return np.empty((0, len(self.a)), dtype=np.uint64)
+        shingles = np.array(hashes, dtype=np.uint64)
+        # products wrap around 64 bits, like the reference implementation of datasketch
+        with np.errstate(over='ignore'):
+            values = (np.outer(shingles, self.a) + self.b) % np.uint64(MERSENNE_PRIME)
+        return np.minimum.reduceat(values & _MAX_HASH, starts, axis=0)
+
+    def band_keys(self, texts: list) -> list:
+        """
+        Return the band keys of every text, 63 bit integers.
+
+        Texts shorter than ``min_words`` words get no keys, they are never duplicates.
+        """
+        keys = [()] * len(texts)
+        long = [i for i, text in enumerate(texts) if len(text.split()) >= self.min_words]
+        if not long:
+            return keys
+        signatures = self.signatures([texts[i] for i in long])
+        bands = signatures[:, :self.bands * self.rows].reshape(len(long), self.bands, self.rows)
+        with np.errstate(over='ignore'):
+            folded = (bands * self.fold).sum(axis=2, dtype=np.uint64)
+        folded = (folded >> np.uint64(8)) ^ self.band_ids
+        for i, row in zip(long, folded.tolist()):
+            keys[i] = tuple(row)
+        return keys
+
+
+class BandIndex:
+    """
+    Band keys of the texts kept so far, in the sqlite database ``path``.
+
+    Every key remembers the source it was first seen in. A source is
+    processed again from scratch after :meth:`forget`, so a run resumed
+    after a crash doesn't see the texts it already wrote as duplicates.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS bands (key INTEGER PRIMARY KEY, source TEXT)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS bands_source ON bands (source)')
+        self._db.commit()
+
+    def forget(self, source: str):
+        """Remove the keys first seen in ``source``."""
+        with self._lock:
+            self._db.execute('DELETE FROM bands WHERE source = ?', (source,))
+            self._db.commit()
+
+    def _existing(self, keys: list) -> set:
+        existing = set()
+        for start in range(0, len(keys), _QUERY_KEYS):
+            chunk = keys[start:start + _QUERY_KEYS]
+            query = f"SELECT key FROM bands WHERE key IN ({','.join('?' * len(chunk))})"
+            existing.update(key for key, in self._db.execute(query, chunk))
+        return existing
+
+    def filter(self, source: str, texts: list, keys: list) -> list:
+        """
+        Return the texts of ``source`` sharing no band with a text kept before.
+
+        The band keys of the returned texts are added to the index.
+        """
+        with self._lock:
+            seen = self._existing(list({key for text_keys in keys for key in text_keys}))
+            kept = []
+            added = []
+            for text, text_keys in zip(texts, keys):
+                if any(key in seen for key in text_keys):
+                    continue
+                seen.update(text_keys)
+                added.extend((key, source) for key in text_keys)
+                kept.append(text)
+            if added:
+                self._db.executemany('INSERT OR IGNORE INTO bands VALUES (?, ?)', added)
+                self._db.commit()
+            return kept
+
+    def close(self):
+        with self._lock:
+            self._db.close()
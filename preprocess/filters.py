@@ -0,0 +1,138 @@
+"""
+Fast-reject filter chain for the submission texts of build.py.
+
+Rules run cheapest first and the chain stops at the first rejection, so most
+texts are rejected by an O(1) check before any regex runs. Language
+identification runs last, over whole batches of the surviving texts. Every
+rejection is counted per rule in ``FilterChain.rejections`` and both passes
+are timed in the :mod:`preprocess.metrics` of the process.
+"""
+
+import re
+from collections import Counter
+
+from preprocess import metrics
+
+WHITESPACE = re.compile(r'\s+')
+URL = re.compile(
+    r"\b((?:https?://|www\d{0,3}[.]|[a-z0-9.\-]+[.][a-z]{2,4}/)(?:[^\s()<>]+|\(([^\s()<>]+|(\([^\s()<>]+\)))*\))+(?:\(([^\s()<>]+|(\([^\s()<>]+\)))*\)|[^\s`!()\[\]{};:'\".,<>?«»“”‘’]))",
+    re.IGNORECASE,
+)
+DELETED = {'[deleted]', '[removed]'}
+MIN_LENGTH = 5
+MAX_LENGTH_NO_SPACE = 2040
+
+
+def is_empty(text: str, stripped: str) -> bool:
+    return not stripped
+
+
+def is_too_short(text: str, stripped: str) -> bool:
+    return len(stripped) <= MIN_LENGTH
+
+
+def is_deleted(text: str, stripped: str) -> bool:
+    return len(stripped) == 9 and stripped.lower() in DELETED
+
+
+def starts_non_ascii(text: str, stripped: str) -> bool:
+    return ord(text[0]) > 128
+
+
+def is_long_without_space(text: str, stripped: str) -> bool:
+    return len(text) > MAX_LENGTH_NO_SPACE and ' ' not in text
+
+
+def has_url(text: str, stripped: str = None) -> bool:
+    # every alternative of the url pattern needs a '/' or a 'www'
+    if '/' not in text and 'www' not in text.lower():
+        return False
+    return URL.search(text) is not None
+
+
+# checks which hold on the raw text, before whitespace is collapsed
+RAW_RULES = [
+    ('empty', is_empty),
+    ('too_short', is_too_short),
+    ('deleted', is_deleted),
+]
+RULES = [
+    ('too_short', is_too_short),
+    ('non_ascii_start', starts_non_ascii),
+    ('long_without_space', is_long_without_space),
+    ('url', has_url),
+]
+
+
+class FilterChain:
+    """
+    Collapse whitespace of a text and reject it on the first failing rule.
+
+    A rule is a ``(name, fn)`` pair where ``fn(text, stripped)`` returns
+    ``True`` to reject the text. ``raw_rules`` see the text as given, they must
+    only reject texts which would also be rejected once whitespace is
+    collapsed. ``rules`` see the collapsed text. When ``language``, a
+    :class:`preprocess.langid.LanguageIdentifier`, is given the texts passing
+    every rule are rejected as ``'language'`` unless it detects one of
+    ``accept``.
+    """
+
+    def __init__(self, raw_rules: list = None, rules: list = None,
+                 language=None, accept: tuple = ('en',)):
+        self.raw_rules = RAW_RULES if raw_rules is None else raw_rules
+        self.rules = RULES if rules is None else rules
+        self.language = language
+        self.accept = set(accept)
+        self.rejections = Counter()
+
+    def reason(self, text: str):
+        """Return ``(name of the first failing rule or None, collapsed text)``."""
+        stripped = text.strip()
+        for name, rule in self.raw_rules:
+            if rule(text, stripped):
+                return name, text
+        text = WHITESPACE.sub(' ', text)
+        stripped = text.strip()
+        for name, rule in self.rules:
+            if rule(text, stripped):
+                return name, text
+        return None, text
+
+    def filter_batch(self, texts: list, reasons: list = None) -> list:
+        """
+        Return the collapsed text, or ``False`` if rejected, for every text.
+
+        :param reasons: if given, gets the name of the rule rejecting every
+            text appended, ``None`` for the texts kept.
+        """
+        results = []
+        pending = []
+        names = []
+        stages = metrics.current()
+        with stages.stage('filter', len(texts)) as stage:
+            for text in texts:
+                name, text = self.reason(text)
+                names.append(name)
+                if name is not None:
+                    self.rejections[name] += 1
+                    results.append(False)
+                else:
+                    pending.append(len(results))
+                    results.append(text)
+            stage.records_out = len(pending)
+        if self.language is not None and pending:
+            with stages.stage('language', len(pending)) as stage:
+                codes = self.language.detect_batch([results[i] for i in pending])
+                for i, code in zip(pending, codes):
+                    if code not in self.accept:
+                        self.rejections['language'] += 1
+                        names[i] = 'language'
+                        results[i] = False
+                stage.records_out = sum(name is None for name in names)
+        if reasons is not None:
+            reasons.extend(names)
+        return results
+
+    def __call__(self, text: str):
+        """Return the collapsed text, or ``False`` if a rule rejects it."""
+        return self.filter_batch([text])[0]
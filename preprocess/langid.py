@@ -0,0 +1,254 @@
+"""
+Batched language identification for the build.py filters.
+
+``NgramIdentifier`` scores whole batches of texts with a hashed character
+1-3-gram naive Bayes model vectorized with NumPy. The model in
+``data/langid.npz`` is derived from the language profiles shipped with
+langdetect, run ``python -m preprocess.langid`` to rebuild it. Obvious
+English (ASCII with enough stopwords) is accepted before the model runs.
+``LangdetectIdentifier`` keeps the previous per-text langdetect behaviour.
+"""
+
+import abc
+import argparse
+import json
+import os
+
+import numpy as np
+
+MODEL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'langid.npz')
+NUM_BUCKETS = 1 << 16
+# log probability of unseen buckets, shared by all languages so that
+# languages with larger corpora aren't penalised more for unseen n-grams
+FLOOR = -12.0
+UNKNOWN = 'unknown'
+
+_PRIME = 0x100000001B3
+_MASK = (1 << 64) - 1
+
+STOPWORDS = frozenset("""
+a about all also an and are as at be because been but by can could did do
+does for from had has have he her him his how i if in into is it its just me
+my no not of on or our she so than that the their them then there they this
+to was we were what when which who will with would you your
+""".split())
+
+
+def _mix(h):
+    # splitmix64 finalizer, works on python ints and uint64 arrays alike
+    h = (h ^ (h >> 30)) * 0xBF58476D1CE4E5B9 & _MASK
+    h = (h ^ (h >> 27)) * 0x94D049BB133111EB & _MASK
+    return h ^ (h >> 31)
+
+
+def ngram_bucket(gram: str, num_buckets: int = NUM_BUCKETS) -> int:
+    """Bucket of a single n-gram, as computed by ``_text_buckets``."""
+    h = len(gram)
+    for ch in gram:
+        h = (h * _PRIME + ord(ch)) & _MASK
+    return _mix(h) % num_buckets
+
+
+def _codepoints(texts: list):
+    """
+    Normalise ``texts`` into one array of code points separated by spaces.
+
+    Returns the code points and the index of the text every one belongs to.
+    ASCII non-letters and general punctuation become spaces, kana are
+    folded like langdetect does, and runs of spaces collapse into their last
+    space, which belongs to the next text.
+    """
+    texts = [text.lower() for text in texts]
+    joined = ''.join(' ' + text for text in texts) + ' '
+    cps = np.frombuffer(joined.encode('utf-32-le', 'surrogatepass'), dtype=np.uint32).astype(np.uint64)
+    lengths = np.fromiter((len(t) + 1 for t in texts), dtype=np.int64, count=len(texts))
+    owner = np.repeat(np.arange(len(texts) + 1), np.append(lengths, 1))
+    ascii_non_letter = (cps < 128) & ((cps < 97) | (cps > 122))
+    punctuation = (cps >= 0x2000) & (cps <= 0x206F)
+    cps[ascii_non_letter | punctuation] = 32
+    cps[(cps >= 0x3040) & (cps <= 0x309F)] = 0x3042
+    cps[(cps >= 0x30A0) & (cps <= 0x30FF)] = 0x30A2
+    space = cps == 32
+    keep = ~(space & np.append(space[1:], False))
+    return cps[keep], owner[keep]
+
+
+def _text_buckets(cps, num_buckets: int = NUM_BUCKETS):
+    """Return the buckets of every 1-3-gram of ``cps`` and their start index."""
+    space = cps == 32
+    buckets, starts = [], []
+    for n in (1, 2, 3):
+        count = len(cps) - n + 1
+        if count <= 0:
+            break
+        h = np.full(count, n, dtype=np.uint64)
+        for k in range(n):
+            h = h * np.uint64(_PRIME) + cps[k:k + count]
+        valid = np.ones(count, dtype=bool)
+        if n == 1:
+            valid &= ~space
+        if n == 3:
+            valid &= ~space[1:1 + count]
+        h = h[valid]
+        h = (h ^ (h >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        h = (h ^ (h >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        h ^= h >> np.uint64(31)
+        buckets.append((h % np.uint64(num_buckets)).astype(np.int64))
+        starts.append(np.nonzero(valid)[0])
+    if not buckets:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return np.concatenate(buckets), np.concatenate(starts)
+
+
+def looks_english(text: str, min_stopwords: int = 3, min_ratio: float = 0.25) -> bool:
+    """Cheap pre-check accepting ASCII texts with enough English stopwords."""
+    if not text.isascii():
+        return False
+    words = text.lower().split()
+    hits = sum(1 for word in words if word.strip('.,!?;:"\'()') in STOPWORDS)
+    return hits >= min_stopwords and hits >= min_ratio * len(words)
+
+
+class LanguageIdentifier(abc.ABC):
+    """Identify the language of batches of texts."""
+
+    @abc.abstractmethod
+    def detect_batch(self, texts: list) -> list:
+        """Return one language code per text, ``'unknown'`` if undecidable."""
+
+    def detect(self, text: str) -> str:
+        return self.detect_batch([text])[0]
+
+
+class NgramIdentifier(LanguageIdentifier):
+    """
+    Hashed character n-gram naive Bayes model scored with NumPy.
+
+    :param model_path: ``.npz`` written by :func:`build_model`.
+    :param precheck: accept obvious English without running the model.
+    """
+
+    def __init__(self, model_path: str = MODEL_PATH, precheck: bool = True):
+        model = np.load(model_path)
+        self.languages = [str(lang) for lang in model['languages']]
+        num_languages = len(self.languages)
+        self.num_buckets = int(model['num_buckets'])
+        # languages x buckets, unseen buckets get the floor
+        weights = np.repeat(model['floors'].astype(np.float32)[:, None], self.num_buckets, axis=1)
+        offsets = model['offsets']
+        for i in range(num_languages):
+            span = slice(offsets[i], offsets[i + 1])
+            weights[i, model['buckets'][span]] = model['logprobs'][span]
+        self.weights = weights
+        self.precheck = precheck
+
+    def detect_batch(self, texts: list) -> list:
+        codes = [None] * len(texts)
+        todo = []
+        for i, text in enumerate(texts):
+            if self.precheck and looks_english(text):
+                codes[i] = 'en'
+            else:
+                todo.append(i)
+        if todo:
+            for i, code in zip(todo, self._score([texts[i] for i in todo])):
+                codes[i] = code
+        return codes
+
+    def _score(self, texts: list) -> list:
+        cps, owner = _codepoints(texts)
+        buckets, starts = _text_buckets(cps, self.num_buckets)
+        segments = owner[starts]
+        scores = np.empty((len(self.languages), len(texts)), dtype=np.float64)
+        for i in range(len(self.languages)):
+            scores[i] = np.bincount(segments, weights=self.weights[i][buckets],
+                                    minlength=len(texts) + 1)[:len(texts)]
+        counts = np.bincount(segments, minlength=len(texts) + 1)[:len(texts)]
+        best = scores.argmax(axis=0)
+        return [self.languages[b] if c else UNKNOWN for b, c in zip(best, counts)]
+
+
+class LangdetectIdentifier(LanguageIdentifier):
+    """The previous per-text ``langdetect.detect``, seeded to be deterministic."""
+
+    def __init__(self, seed: int = 0):
+        from langdetect import DetectorFactory, detect
+        DetectorFactory.seed = seed
+        self._detect = detect
+
+    def detect_batch(self, texts: list) -> list:
+        codes = []
+        for text in texts:
+            try:
+                codes.append(self._detect(text))
+            except Exception:
+                codes.append(UNKNOWN)
+        return codes
+
+
+BACKENDS = {
+    'ngram': NgramIdentifier,
+    'langdetect': LangdetectIdentifier,
+}
+
+
+def get_identifier(name: str = 'ngram') -> LanguageIdentifier:
+    """Return the language identifier backend called ``name``."""
+    if name not in BACKENDS:
+        raise ValueError(f"unknown language identifier {name}, choose from {sorted(BACKENDS)}")
+    return BACKENDS[name]()
+
+
+def build_model(profiles_dir: str = None, out_path: str = MODEL_PATH,
+                num_buckets: int = NUM_BUCKETS, floor: float = FLOOR):
+    """
+    Build the n-gram model from langdetect's language profiles.
+
+    Every profile holds 1-3-gram counts and the total count per order. The
+    model keeps ``log((count + 1) / (total + vocabulary))`` per bucket, summed
+    over colliding lowercased n-grams, and ``floor`` for unseen buckets.
+    """
+    if profiles_dir is None:
+        import langdetect
+        profiles_dir = os.path.join(os.path.dirname(langdetect.__file__), 'profiles')
+    languages, floors, buckets, logprobs, offsets = [], [], [], [], [0]
+    for name in sorted(os.listdir(profiles_dir)):
+        with open(os.path.join(profiles_dir, name), encoding='utf-8') as fp:
+            profile = json.load(fp)
+        counts = [{}, {}, {}]
+        for gram, count in profile['freq'].items():
+            if len(gram.lower()) == len(gram):
+                gram = gram.lower()
+            counts[len(gram) - 1][gram] = counts[len(gram) - 1].get(gram, 0) + count
+        probs = np.zeros(num_buckets, dtype=np.float64)
+        for n, grams in enumerate(counts):
+            total = profile['n_words'][n] + len(grams)
+            for gram, count in grams.items():
+                probs[ngram_bucket(gram, num_buckets)] += (count + 1) / total
+        seen = np.nonzero(probs)[0]
+        languages.append(profile['name'])
+        floors.append(floor)
+        buckets.append(seen.astype(np.uint32))
+        logprobs.append(np.log(probs[seen]).astype(np.float16))
+        offsets.append(offsets[-1] + len(seen))
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+    np.savez_compressed(
+        out_path,
+        languages=np.array(languages),
+        num_buckets=np.array(num_buckets),
+        floors=np.array(floors, dtype=np.float32),
+        offsets=np.array(offsets, dtype=np.int64),
+        buckets=np.concatenate(buckets),
+        logprobs=np.concatenate(logprobs),
+    )
+    return out_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='build the n-gram language model')
+    parser.add_argument('--profiles', type=str, default=None,
+                        help='langdetect profiles directory, defaults to the installed one.')
+    parser.add_argument('--out', type=str, default=MODEL_PATH)
+    parser.add_argument('--buckets', type=int, default=NUM_BUCKETS)
+    args = parser.parse_args()
+    print(build_model(args.profiles, args.out, args.buckets))
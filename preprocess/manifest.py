@@ -0,0 +1,99 @@
+"""
+Persistent record of the archives build.py has processed.
+
+Every archive gets a record with its hash, local paths, sizes and the last
+stage it finished: ``downloaded``, ``preprocessed`` or ``done``. The record
+file is loaded once, reconciled with a single listing of the bucket and
+rewritten atomically after every stage, so skip decisions are dictionary
+lookups and a crashed run resumes each archive from its last finished stage.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger("preprocess.manifest")
+
+STATUSES = ('downloaded', 'preprocessed', 'done')
+
+
+class ProcessingManifest:
+    """
+    Records of processed archives, kept in the JSON file ``path``.
+
+    :param path: file the records are loaded from and saved to.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.records = {}
+        self._lock = threading.Lock()
+        if os.path.isfile(path):
+            with open(path) as fp:
+                self.records = json.load(fp)['files']
+            logger.info(f"Loaded {len(self.records)} records from {path}")
+
+    def _save(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as fw:
+            json.dump({'files': self.records}, fw, indent=1, sort_keys=True)
+        os.replace(tmp, self.path)
+
+    def get(self, name: str) -> dict:
+        """Return a copy of the record of ``name``, empty if there is none."""
+        with self._lock:
+            return dict(self.records.get(name, {}))
+
+    def reached(self, name: str, status: str) -> bool:
+        """Return whether ``name`` finished the stage ``status`` or a later one."""
+        current = self.get(name).get('status')
+        return current is not None and STATUSES.index(current) >= STATUSES.index(status)
+
+    def update(self, name: str, **fields):
+        """Update the record of ``name`` with ``fields`` and save every record."""
+        with self._lock:
+            self._update(name, fields)
+            self._save()
+
+    def _update(self, name: str, fields: dict):
+        if 'status' in fields and fields['status'] not in STATUSES:
+            raise ValueError(f"unknown status {fields['status']}, choose from {STATUSES}")
+        record = self.records.setdefault(name, {})
+        record.update(fields, updated=time.time())
+
+    def forget(self, name: str):
+        with self._lock:
+            if self.records.pop(name, None) is not None:
+                self._save()
+
+    def reconcile(self, targets: dict, listing: set):
+        """
+        Align the records with the files actually in the bucket.
+
+        Every record is updated in memory and the records are saved once. A
+        listed target recorded as ``failed_target`` is not trusted, the archive
+        is processed again.
+
+        :param targets: bucket path of the output of every archive name.
+        :param listing: every bucket path found by a single listing.
+        """
+        with self._lock:
+            changed = False
+            for name, target in targets.items():
+                record = self.records.get(name, {})
+                if target in listing and record.get('failed_target') != target:
+                    if record.get('status') != 'done':
+                        self._update(name, {'status': 'done', 'target': target})
+                        changed = True
+                elif record.get('status') == 'done':
+                    # the output was removed from the bucket, upload it again
+                    logger.info(f"{target} is missing from the bucket, processing {name} again")
+                    if os.path.isfile(record.get('output', '')):
+                        self._update(name, {'status': 'preprocessed'})
+                    else:
+                        del self.records[name]
+                    changed = True
+            if changed:
+                self._save()
@@ -0,0 +1,116 @@
+"""
+Per-stage timings, record counts, rejection reasons and byte counts.
+
+Every process keeps its own :class:`FileMetrics` in :func:`current`. The
+stream workers hand theirs back with every batch result through
+:func:`collect` and the parent merges them into the metrics of the file,
+which are written as a JSON sidecar next to every output.
+"""
+
+import json
+import os
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+STAGE_FIELDS = ('wall', 'cpu', 'records_in', 'records_out', 'calls')
+
+
+class Stage:
+    """Record counts of one running stage, the block may set both before it ends."""
+
+    def __init__(self, records_in: int = 0):
+        self.records_in = records_in
+        self.records_out = None
+
+
+class FileMetrics:
+    """
+    Metrics of the processing of one file, mergeable across processes.
+
+    :attr stages: ``{name: {wall, cpu, records_in, records_out, calls}}``,
+        wall and CPU times in seconds.
+    :attr rejections: number of records rejected by reason.
+    :attr bytes: number of bytes by kind, like ``read`` or ``written``.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.rejections = Counter()
+        self.bytes = Counter()
+
+    def add(self, name: str, wall: float = 0.0, cpu: float = 0.0, records_in: int = 0,
+            records_out: int = 0, calls: int = 1):
+        stage = self.stages.setdefault(name, dict.fromkeys(STAGE_FIELDS, 0))
+        for field, value in zip(STAGE_FIELDS, (wall, cpu, records_in, records_out, calls)):
+            stage[field] += value
+
+    @contextmanager
+    def stage(self, name: str, records_in: int = 0):
+        """
+        Time the block as a call of the stage ``name``.
+
+        CPU time is the time of the calling thread. ``records_out`` defaults
+        to ``records_in`` unless the block sets it on the yielded :class:`Stage`.
+        Calls nest, the time of a nested stage also counts in the outer one.
+        """
+        stage = Stage(records_in)
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            yield stage
+        finally:
+            self.add(name, time.perf_counter() - wall, time.thread_time() - cpu, stage.records_in,
+                     stage.records_in if stage.records_out is None else stage.records_out)
+
+    def reject(self, reason: str, count: int = 1):
+        if count:
+            self.rejections[reason] += count
+
+    def to_dict(self) -> dict:
+        return {'stages': self.stages, 'rejections': dict(self.rejections), 'bytes': dict(self.bytes)}
+
+    def merge(self, other):
+        """Add the metrics of ``other``, a :class:`FileMetrics` or its :meth:`to_dict`."""
+        if isinstance(other, FileMetrics):
+            other = other.to_dict()
+        for name, stage in other['stages'].items():
+            self.add(name, **stage)
+        self.rejections.update(other['rejections'])
+        self.bytes.update(other['bytes'])
+
+    def summary(self) -> str:
+        """One line of records per second and CPU share of every stage."""
+        parts = []
+        for name, stage in self.stages.items():
+            rate = stage['records_in'] / stage['wall'] if stage['wall'] else 0
+            parts.append(f"{name} {rate:.0f} rec/s {stage['cpu']:.1f}s cpu")
+        return ', '.join(parts)
+
+
+_current = FileMetrics()
+
+
+def current() -> FileMetrics:
+    """The metrics this process records into."""
+    return _current
+
+
+def collect() -> dict:
+    """Return the metrics recorded since the last call and start new ones."""
+    global _current
+    collected, _current = _current, FileMetrics()
+    return collected.to_dict()
+
+
+def sidecar_path(path: str) -> str:
+    return path + '.stats.json'
+
+
+def write_sidecar(path: str, report: dict) -> str:
+    """Write ``report`` as JSON next to the output ``path``, return the sidecar path."""
+    sidecar = sidecar_path(path)
+    tmp = sidecar + '.tmp'
+    with open(tmp, 'w') as fw:
+        json.dump(report, fw, indent=1, sort_keys=True)
+    os.replace(tmp, sidecar)
+    return sidecar
@@ -0,0 +1,163 @@
+"""
+Pipelined download -> preprocess -> upload scheduler for build.py.
+
+Every stage runs its own pool of threads and hands jobs to the next stage
+through a bounded queue, so the next archive downloads while the current one
+is preprocessed and the previous one uploads. Jobs only enter the pipeline
+once their estimated size fits in the disk budget, which bounds the bytes of
+archives and outputs on disk at once.
+"""
+
+import logging
+import queue
+import threading
+import traceback
+
+logger = logging.getLogger("preprocess.pipeline")
+
+_DONE = object()
+
+
+class DiskBudget:
+    """
+    Byte budget shared by the jobs in flight.
+
+    :param limit: maximum number of reserved bytes, ``None`` for no limit. A
+        job larger than the limit still runs, alone.
+    """
+
+    def __init__(self, limit: int = None):
+        self.limit = limit
+        self.used = 0
+        self._changed = threading.Condition()
+
+    def reserve(self, nbytes: int, block: bool = True):
+        with self._changed:
+            while (block and self.limit is not None and self.used
+                   and self.used + nbytes > self.limit):
+                self._changed.wait()
+            self.used += nbytes
+
+    def release(self, nbytes: int):
+        with self._changed:
+            self.used -= nbytes
+            self._changed.notify_all()
+
+
+class Stage:
+    """
+    One step of the pipeline.
+
+    :param name: name used in logs and stats.
+    :param fn: ``fn(value)`` returning the value passed to the next stage, or
+        ``None`` to drop the job.
+    :param workers: number of jobs the stage runs at once.
+    :param disk_usage: optional ``disk_usage(value)`` returning the bytes the
+        job holds on disk once the stage is done, its reservation is updated.
+    """
+
+    def __init__(self, name: str, fn, workers: int = 1, disk_usage=None):
+        self.name = name
+        self.fn = fn
+        self.workers = max(1, workers)
+        self.disk_usage = disk_usage
+
+
+class Job:
+    def __init__(self, name: str, value):
+        self.name = name
+        self.value = value
+        self.reserved = 0
+
+
+class Pipeline:
+    """
+    Run jobs through ``stages`` concurrently.
+
+    :param stages: list of :class:`Stage`, run in order.
+    :param budget: :class:`DiskBudget` jobs reserve their size from.
+    :param size: ``size(value)`` estimating the bytes a job needs on disk,
+        reserved before it enters the first stage.
+    :param queue_size: number of jobs waiting between two stages.
+    """
+
+    def __init__(self, stages: list, budget: DiskBudget = None, size=None, queue_size: int = 1):
+        self.stages = stages
+        self.budget = budget or DiskBudget()
+        self.size = size
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+        self.stats = {'done': 0, 'dropped': 0, 'failed': []}
+        self._lock = threading.Lock()
+
+    def _finish(self, job: Job, outcome: str):
+        self.budget.release(job.reserved)
+        job.reserved = 0
+        with self._lock:
+            if outcome == 'failed':
+                self.stats['failed'].append(job.name)
+            else:
+                self.stats[outcome] += 1
+
+    def _run_stage(self, index: int, remaining: list):
+        stage = self.stages[index]
+        inbox = self.queues[index]
+        outbox = self.queues[index + 1] if index + 1 < len(self.stages) else None
+        while True:
+            job = inbox.get()
+            if job is _DONE:
+                break
+            try:
+                job.value = stage.fn(job.value)
+                if job.value is not None and stage.disk_usage is not None:
+                    usage = stage.disk_usage(job.value)
+                    if usage > job.reserved:
+                        # growing jobs never wait, they may be what others wait for
+                        self.budget.reserve(usage - job.reserved, block=False)
+                    else:
+                        self.budget.release(job.reserved - usage)
+                    job.reserved = usage
+            except Exception:
+                logger.error(f"{job.name}: {stage.name} failed\n{traceback.format_exc()}")
+                self._finish(job, 'failed')
+                continue
+            if job.value is None:
+                logger.info(f"{job.name}: dropped by {stage.name}")
+                self._finish(job, 'dropped')
+            elif outbox is None:
+                self._finish(job, 'done')
+            else:
+                outbox.put(job)
+        with self._lock:
+            remaining[index] -= 1
+            last = remaining[index] == 0
+        if last and outbox is not None:
+            for _ in range(self.stages[index + 1].workers):
+                outbox.put(_DONE)
+
+    def run(self, items) -> dict:
+        """
+        Run every ``(name, value)`` of ``items`` through the stages.
+
+        Failing jobs are logged and counted, the others carry on. Returns the
+        number of jobs done and dropped and the names of the failed ones.
+        """
+        remaining = [stage.workers for stage in self.stages]
+        threads = []
+        for index, stage in enumerate(self.stages):
+            for i in range(stage.workers):
+                thread = threading.Thread(target=self._run_stage, args=(index, remaining),
+                                          name=f"{stage.name}-{i}", daemon=True)
+                thread.start()
+                threads.append(thread)
+        try:
+            for name, value in items:
+                job = Job(name, value)
+                job.reserved = self.size(value) if self.size else 0
+                self.budget.reserve(job.reserved)
+                self.queues[0].put(job)
+        finally:
+            for _ in range(self.stages[0].workers):
+                self.queues[0].put(_DONE)
+        for thread in threads:
+            thread.join()
+        return self.stats
@@ -0,0 +1,115 @@
+"""
+Projected decoding of the pushshift JSON lines read by build.py.
+
+A submission line holds dozens of fields (media, preview, awards, flairs...)
+of which build.py needs three. :class:`RecordDecoder` finds each needed key
+in the raw ``bytes`` of the line and decodes its value alone, so the other
+fields are never turned into Python objects, and a record is rejected on a
+flag like ``over_18`` before its text fields are decoded at all. Lines the
+projection can't handle safely, a key appearing more than once (in a nested
+object like ``media.oembed.title``), a value which isn't a string or a
+literal, or a line which isn't a whole object, are decoded in full by
+:data:`BACKEND`, ``orjson`` when installed and the standard library
+otherwise.
+"""
+
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+BACKEND = 'orjson' if orjson is not None else 'json'
+BACKENDS = {'json': json.loads}
+if orjson is not None:
+    BACKENDS['orjson'] = orjson.loads
+
+_BACKSLASH = ord('\\')
+_WHITESPACE = b' \t\r\n'
+_LITERALS = ((b'true', True), (b'false', False), (b'null', None))
+# returned by _value when the line must be decoded in full
+_FALLBACK = object()
+
+
+class RecordDecoder:
+    """
+    Decode the values of ``fields`` from JSON lines given as ``bytes`` or ``str``.
+
+    :param fields: names of the top level fields to return, in order.
+    :param reject: name of a top level flag, records where it is true are
+        rejected before any of ``fields`` is decoded.
+    :param backend: ``'orjson'`` or ``'json'``, decodes the lines the
+        projection can't, :data:`BACKEND` by default.
+    :param project: find ``fields`` in the raw line, decode every line in
+        full when ``False``. The ``reject`` flag is always found in the
+        raw line.
+
+    Malformed lines raise what a full decode raises: ``ValueError`` for
+    invalid JSON and ``KeyError`` for a missing field. Only the projected
+    values are checked, a whole object broken elsewhere still decodes.
+    """
+
+    def __init__(self, fields: tuple, reject: str = None, backend: str = None, project: bool = True):
+        if backend is not None and backend not in BACKENDS:
+            raise ValueError(f"unknown JSON backend {backend}, choose from {sorted(BACKENDS)}")
+        self.fields = tuple(fields)
+        self.reject = reject
+        self.backend = backend or BACKEND
+        self.project = project
+        self._loads = BACKENDS[self.backend]
+        self._keys = [f'"{field}":'.encode('utf-8') for field in self.fields]
+        self._reject_key = f'"{reject}":'.encode('utf-8') if reject else None
+
+    def _value(self, line: bytes, key: bytes):
+        """The value of the top level ``key``, or ``_FALLBACK``."""
+        start = line.find(key)
+        if start <= 0 or line[start - 1] == _BACKSLASH or line.find(key, start + len(key)) != -1:
+            return _FALLBACK
+        position = start + len(key)
+        while position < len(line) and line[position] in _WHITESPACE:
+            position += 1
+        if line[position:position + 1] == b'"':
+            end = line.find(b'"', position + 1)
+            while end != -1 and line[end - 1] == _BACKSLASH:
+                # a quote after an odd number of backslashes is escaped
+                slashes = len(line[position + 1:end]) - len(line[position + 1:end].rstrip(b'\\'))
+                if slashes % 2 == 0:
+                    break
+                end = line.find(b'"', end + 1)
+            if end == -1:
+                return _FALLBACK
+            raw = line[position + 1:end]
+            if _BACKSLASH not in raw:
+                return raw.decode('utf-8')
+            return self._loads(line[position:end + 1])
+        for literal, value in _LITERALS:
+            if line.startswith(literal, position):
+                return value
+        return _FALLBACK
+
+    def decode(self, line):
+        """Return the tuple of the values of ``fields``, ``None`` for rejected records."""
+        if isinstance(line, str):
+            line = line.encode('utf-8')
+        line = line.strip()
+        # only whole objects are projected, truncated lines are left to the full decode to raise
+        if line[:1] != b'{' or line[-1:] != b'}':
+            return self._decode(line)
+        if self._reject_key is not None:
+            flag = self._value(line, self._reject_key)
+            if flag is True:
+                return None
+            if flag is not False and flag is not None:
+                return self._decode(line)
+        if self.project:
+            values = tuple([self._value(line, key) for key in self._keys])
+            if _FALLBACK not in values:
+                return values
+        return self._decode(line)
+
+    def _decode(self, line: bytes):
+        data = self._loads(line)
+        if self.reject is not None and data[self.reject]:
+            return None
+        return tuple(data[field] for field in self.fields)
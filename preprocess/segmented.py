@@ -0,0 +1,310 @@
+"""
+Multi-connection ranged downloads with per-segment resume.
+
+The file is split into byte ranges of at most ``SEGMENT_BYTES``, fetched by
+parallel connections of a pooled ``requests`` session and written in place
+into ``<file>.part``. Connections left without segments split the second half
+off the busiest remaining one, so a slow connection doesn't hold back the end
+of the download. The progress of every segment is kept in
+``<file>.part.json``, so an interrupted download only fetches the bytes still
+missing.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger("preprocess.segmented")
+
+SEGMENTS = 8
+SEGMENT_BYTES = 64 * 1024 * 1024
+# idle connections split segments with at least twice this many bytes left
+STEAL_BYTES = 1024 * 1024
+CHUNK_SIZE = 1024 * 1024
+# progress is saved every this many bytes, and when a segment stops
+SAVE_BYTES = 64 * 1024 * 1024
+# smaller files aren't worth several connections
+MIN_SIZE = 16 * 1024 * 1024
+TIMEOUT = (5, 60)
+
+
+class RangeError(Exception):
+    """The server ignored a byte range request."""
+
+
+def pooled_session(connections: int = SEGMENTS) -> requests.Session:
+    """Session keeping up to ``connections`` connections alive per host."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=connections)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def probe(session: requests.Session, url: str):
+    """Return ``(size, accepts_ranges)`` advertised by the server for ``url``."""
+    response = session.head(url, allow_redirects=True, timeout=TIMEOUT)
+    response.raise_for_status()
+    size = int(response.headers.get('Content-Length', -1))
+    accepts = response.headers.get('Accept-Ranges', 'none').lower() == 'bytes'
+    return size, accepts
+
+
+def split(size: int, segments: int) -> list:
+    """Split ``size`` bytes into ``segments`` ``[start, end)`` ranges."""
+    step = max(1, -(-size // segments))
+    return [[start, min(start + step, size)] for start in range(0, size, step)]
+
+
+class Manifest:
+    """
+    Progress of the segments of one download, saved next to the ``.part`` file.
+
+    Every segment is a ``[start, end, done]`` list, bytes ``start`` to
+    ``start + done`` are on disk. Segments change under ``lock``.
+    """
+
+    def __init__(self, path: str, url: str, size: int, segments: list):
+        self.path = path
+        self.url = url
+        self.size = size
+        self.segments = segments
+        self.lock = threading.RLock()
+        # notified whenever a segment makes progress
+        self.changed = threading.Condition(self.lock)
+
+    @classmethod
+    def load(cls, path: str, url: str, size: int):
+        """Return the saved manifest of ``url`` if it matches ``size``, else ``None``."""
+        try:
+            with open(path) as fp:
+                saved = json.load(fp)
+        except (OSError, ValueError):
+            return None
+        if saved.get('url') != url or saved.get('size') != size:
+            return None
+        return cls(path, url, size, saved['segments'])
+
+    def save(self):
+        with self.lock:
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as fw:
+                json.dump({'url': self.url, 'size': self.size, 'segments': self.segments}, fw)
+            os.replace(tmp, self.path)
+
+    def frontier(self) -> int:
+        """Number of bytes at the start of the file which are all on disk."""
+        with self.lock:
+            position = 0
+            for start, end, done in sorted(self.segments):
+                if start > position:
+                    break
+                position = max(position, start + min(done, end - start))
+                if done < end - start:
+                    break
+            return position
+
+    def missing(self) -> int:
+        with self.lock:
+            return sum(_remaining(segment) for segment in self.segments)
+
+    def steal(self, active: list, min_bytes: int = STEAL_BYTES):
+        """
+        Split the second half off the active segment with most bytes left.
+
+        Returns the new segment, or ``None`` if no segment is worth splitting.
+        """
+        with self.lock:
+            segment = max(active, key=_remaining, default=None)
+            if segment is None or _remaining(segment) < 2 * min_bytes:
+                return None
+            middle = segment[0] + segment[2] + _remaining(segment) // 2
+            stolen = [middle, segment[1], 0]
+            segment[1] = middle
+            self.segments.append(stolen)
+            return stolen
+
+
+def _remaining(segment) -> int:
+    return max(0, segment[1] - segment[0] - segment[2])
+
+
+def _fetch_segment(session, url, part_file, manifest, segment, num_retries, progress):
+    """
+    Fetch the missing bytes of ``segment``.
+
+    The end of the segment may move down while it is fetched, when another
+    connection steals its second half. Bytes written past the new end are
+    the same ones the other connection writes, so they do no harm.
+    """
+    retry = num_retries
+    while True:
+        with manifest.lock:
+            if not _remaining(segment):
+                break
+            offset, end = segment[0] + segment[2], segment[1]
+        try:
+            response = session.get(url, stream=True, timeout=TIMEOUT, headers={
+                'Range': f'bytes={offset}-{end - 1}', 'Accept-Encoding': 'identity'})
+            try:
+                if response.status_code != 206:
+                    raise RangeError(f"{url} answered {response.status_code} to a range request")
+                unsaved = 0
+                with open(part_file, 'r+b') as fw:
+                    fw.seek(offset)
+                    for chunk in response.iter_content(CHUNK_SIZE):
+                        chunk = chunk[:_remaining(segment)]
+                        if not chunk:
+                            break
+                        fw.write(chunk)
+                        # bytes counted as done must be readable by the hashing thread
+                        fw.flush()
+                        with manifest.lock:
+                            segment[2] += len(chunk)
+                            manifest.changed.notify_all()
+                        unsaved += len(chunk)
+                        progress(len(chunk))
+                        if unsaved >= SAVE_BYTES:
+                            manifest.save()
+                            unsaved = 0
+            finally:
+                response.close()
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                requests.exceptions.ChunkedEncodingError) as e:
+            retry -= 1
+            if retry <= 0:
+                raise RuntimeError(f'Connection broken too many times for bytes {offset}-{end} of {url}') from e
+            logger.debug(f'{url} bytes {offset}-{end}: {e}, retrying ({retry} left)')
+            time.sleep(2 ** (num_retries - retry - 1))
+            continue
+        if _remaining(segment):
+            # the server closed the response early, carry on from there
+            retry -= 1
+            if retry <= 0:
+                raise RuntimeError(f'Received less data than requested for bytes {offset}-{end} of {url}')
+
+
+def _hash_in_order(part_file: str, manifest: Manifest, hasher, stopped: threading.Event):
+    """
+    Feed ``hasher`` the bytes of ``part_file`` in order as the file fills up.
+
+    Bytes are read back right after they were written, while they are still
+    in the page cache. Hash states can't be saved, so a resumed download
+    hashes the bytes an earlier run left once.
+    """
+    position = 0
+    # unbuffered, a read ahead buffer would keep bytes from before they were written
+    with open(part_file, 'rb', buffering=0) as fp:
+        while position < manifest.size:
+            with manifest.changed:
+                while manifest.frontier() <= position and not stopped.is_set():
+                    manifest.changed.wait()
+                frontier = manifest.frontier()
+            if frontier <= position:
+                return
+            fp.seek(position)
+            while position < frontier:
+                block = fp.read(min(CHUNK_SIZE, frontier - position))
+                if not block:
+                    return
+                hasher.update(block)
+                position += len(block)
+
+
+def download(url: str, outfile: str, size: int, segments: int = SEGMENTS,
+             session: requests.Session = None, num_retries: int = 5, progress=None,
+             hasher=None) -> str:
+    """
+    Download ``url`` of ``size`` bytes to ``outfile`` over ``segments`` connections.
+
+    The file is split into at least ``segments`` segments of at most
+    ``SEGMENT_BYTES`` each.
+
+    :param session: session to reuse, a pooled one is made otherwise.
+    :param progress: optional ``progress(nbytes)`` called from the segment threads.
+    :param hasher: optional ``hashlib`` object updated with the file's bytes, in order.
+    """
+    part_file = outfile + '.part'
+    manifest_file = part_file + '.json'
+    manifest = None
+    if os.path.isfile(part_file):
+        manifest = Manifest.load(manifest_file, url, size)
+    if manifest is None:
+        # a .part without manifest is the prefix left by a single connection download,
+        # one with a stale manifest is preallocated and can't be trusted
+        done = 0
+        if os.path.isfile(part_file) and not os.path.isfile(manifest_file):
+            done = os.path.getsize(part_file)
+            if done > size:
+                done = 0
+        ranges = [[0, done, done]] if done else []
+        count = max(segments, -(-(size - done) // SEGMENT_BYTES))
+        ranges += [[done + start, done + end, 0] for start, end in split(size - done, count)]
+        manifest = Manifest(manifest_file, url, size, ranges)
+        with open(part_file, 'r+b' if done else 'wb') as fw:
+            fw.truncate(size)
+        manifest.save()
+    if manifest.missing() < size:
+        logger.info(f"Resuming {url}, {manifest.missing()} of {size} bytes missing")
+
+    lock = threading.Lock()
+
+    def report(nbytes):
+        if progress is not None:
+            with lock:
+                progress(nbytes)
+
+    own_session = session is None
+    session = session or pooled_session(segments)
+    errors = []
+
+    todo = [segment for segment in manifest.segments if _remaining(segment)]
+    todo.reverse()
+    active = []
+
+    def run():
+        while not errors:
+            with manifest.lock:
+                segment = todo.pop() if todo else manifest.steal(active)
+                if segment is None:
+                    break
+                active.append(segment)
+            try:
+                _fetch_segment(session, url, part_file, manifest, segment, num_retries, report)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                with manifest.lock:
+                    active.remove(segment)
+                manifest.save()
+
+    stopped = threading.Event()
+    hashing = None
+    if hasher is not None:
+        hashing = threading.Thread(target=_hash_in_order, args=(part_file, manifest, hasher, stopped),
+                                   daemon=True)
+        hashing.start()
+    try:
+        threads = [threading.Thread(target=run, daemon=True) for _ in range(segments)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        if own_session:
+            session.close()
+        if hashing is not None:
+            with manifest.changed:
+                stopped.set()
+                manifest.changed.notify_all()
+            hashing.join()
+    if errors:
+        raise errors[0]
+    os.replace(part_file, outfile)
+    os.remove(manifest_file)
+    return outfile
@@ -0,0 +1,216 @@
+"""
+Streaming decompress -> filter -> write engine for pushshift dumps.
+
+The archive is decompressed in a feeder thread, line batches are fanned out
+to a long lived process pool and the filtered results are written in input
+order by a writer thread. Feeder, workers and writer are connected through
+bounded buffers, so memory stays flat however large the monthly dump is.
+"""
+
+import bz2
+import contextlib
+import io
+import logging
+import lzma
+import multiprocessing
+import os
+import queue
+import threading
+import time
+
+import zstandard as zstd
+
+from preprocess import metrics
+
+logger = logging.getLogger("preprocess.stream")
+
+BATCH_BYTES = 8 * 1024 * 1024
+READ_BUFFER = 1024 * 1024
+# pushshift compresses with --long=31
+ZSTD_MAX_WINDOW = 2 ** 31
+
+_worker_fn = None
+
+
+def codec(path: str) -> str:
+    """Return the codec of ``path`` picked from its extension."""
+    ext = os.path.splitext(path)[1].lower()
+    if ext in ('.bz2', '.xz', '.zst'):
+        return ext[1:]
+    return 'raw'
+
+
+def open_compressed(path: str):
+    """
+    Open ``path`` as a binary stream of decompressed bytes.
+
+    The codec is picked from the extension, anything else is read as is.
+    """
+    name = codec(path)
+    if name == 'bz2':
+        return bz2.open(path, 'rb')
+    if name == 'xz':
+        return lzma.open(path, 'rb')
+    if name == 'zst':
+        dctx = zstd.ZstdDecompressor(max_window_size=ZSTD_MAX_WINDOW)
+        reader = dctx.stream_reader(open(path, 'rb'), closefd=True)
+        return io.BufferedReader(reader, buffer_size=READ_BUFFER)
+    return open(path, 'rb')
+
+
+def iter_batches(fp, batch_bytes: int = BATCH_BYTES):
+    """Yield lists of raw ``bytes`` lines of roughly ``batch_bytes`` each."""
+    while True:
+        lines = fp.readlines(batch_bytes)
+        if not lines:
+            break
+        yield lines
+
+
+def _init_worker(fn, initializer):
+    global _worker_fn
+    _worker_fn = fn
+    # forked workers start with what the parent recorded so far
+    metrics.collect()
+    if initializer is not None:
+        initializer()
+
+
+def _process_batch(lines):
+    # the metrics the batch function recorded go back with its result
+    with metrics.current().stage('worker', len(lines)) as stage:
+        result = _worker_fn(lines)
+        stage.records_out = len(result[0] if isinstance(result, tuple) else result)
+    return result, metrics.collect()
+
+
+def _write_results(fw, results: queue.Queue, slots: threading.Semaphore, errors: list,
+                   file_metrics: metrics.FileMetrics):
+    while True:
+        texts = results.get()
+        if texts is None:
+            break
+        try:
+            if texts and not errors:
+                with file_metrics.stage('write', len(texts)):
+                    fw.write('\n'.join(texts) + '\n')
+        except Exception as e:
+            errors.append(e)
+        finally:
+            slots.release()
+
+
+def process_file(path: str, out_path: str, batch_fn, processes: int = None,
+                 batch_bytes: int = BATCH_BYTES, max_pending: int = None,
+                 batches=None, dedup=None, progress_interval: float = None,
+                 initializer=None) -> dict:
+    """
+    Decompress ``path``, filter it with ``batch_fn`` and write ``out_path``.
+
+    :param out_path: path of the output file, or a text file object the
+        results are written to, which is left open.
+
+    :param batch_fn: picklable function taking a list of raw ``bytes`` lines
+        and returning the list of texts to keep, run in the worker pool.
+    :param processes: number of worker processes, defaults to all cores.
+    :param batch_bytes: approximate size of the line batches sent to workers.
+    :param max_pending: maximum number of batches decompressed but not yet
+        written, this bounds the memory used by the engine.
+    :param batches: optional iterable of line batches replacing the reader
+        picked from the extension of ``path``.
+    :param dedup: optional ``dedup(texts, keys)`` returning the texts to
+        write, called on every batch in input order. ``batch_fn`` then
+        returns a ``(texts, keys)`` pair, with the band keys of every text.
+    :param progress_interval: log the records per second of every stage
+        this often, in seconds.
+    :param initializer: optional picklable function called once in every
+        worker process before its first batch, to load what ``batch_fn``
+        needs.
+
+    Returns the number of batches, lines and texts written and under
+    ``metrics`` the :class:`preprocess.metrics.FileMetrics` of the file,
+    merged from every worker.
+    """
+    processes = processes or multiprocessing.cpu_count()
+    max_pending = max_pending or 2 * processes
+    slots = threading.Semaphore(max_pending)
+    results = queue.Queue(maxsize=max_pending)
+    errors = []
+    stats = {'batches': 0, 'lines': 0, 'written': 0, 'duplicates': 0}
+    # one per thread, merged at the end
+    file_metrics = metrics.FileMetrics()
+    read_metrics = metrics.FileMetrics()
+    write_metrics = metrics.FileMetrics()
+
+    def feed(source):
+        source = iter(source)
+        while True:
+            with read_metrics.stage('read') as stage:
+                lines = next(source, None)
+                stage.records_in = stage.records_out = len(lines or ())
+            if lines is None:
+                break
+            read_metrics.bytes['decompressed'] += sum(len(line) for line in lines)
+            slots.acquire()
+            if errors:
+                slots.release()
+                break
+            stats['batches'] += 1
+            stats['lines'] += len(lines)
+            yield lines
+
+    if isinstance(out_path, str):
+        output = open(out_path, 'w')
+    else:
+        output = contextlib.nullcontext(out_path)
+    with output as fw:
+        writer = threading.Thread(
+            target=_write_results, args=(fw, results, slots, errors, write_metrics), daemon=True)
+        writer.start()
+        pool = multiprocessing.Pool(processes, initializer=_init_worker,
+                                    initargs=(batch_fn, initializer))
+        fp = None
+        try:
+            if batches is None:
+                fp = open_compressed(path)
+                batches = iter_batches(fp, batch_bytes)
+            last_progress = time.monotonic()
+            for texts, worker_metrics in pool.imap(_process_batch, feed(batches)):
+                file_metrics.merge(worker_metrics)
+                if dedup is not None:
+                    texts, keys = texts
+                    with file_metrics.stage('dedup', len(texts)) as stage:
+                        kept = dedup(texts, keys)
+                        stage.records_out = len(kept)
+                    stats['duplicates'] += len(texts) - len(kept)
+                    file_metrics.reject('near_duplicate', len(texts) - len(kept))
+                    texts = kept
+                stats['written'] += len(texts)
+                results.put(texts)
+                if progress_interval and time.monotonic() - last_progress >= progress_interval:
+                    last_progress = time.monotonic()
+                    logger.info(f"{path}: {stats['lines']} records read, {stats['written']} kept; "
+                                f"{file_metrics.summary()}")
+            pool.close()
+        except BaseException as e:
+            errors.append(e)
+            pool.terminate()
+            raise
+        finally:
+            results.put(None)
+            writer.join()
+            pool.join()
+            if fp is not None:
+                fp.close()
+    if errors:
+        raise errors[0]
+    file_metrics.merge(read_metrics)
+    file_metrics.merge(write_metrics)
+    if os.path.isfile(path):
+        file_metrics.bytes['read'] = os.path.getsize(path)
+    if isinstance(out_path, str):
+        file_metrics.bytes['written'] = os.path.getsize(out_path)
+    stats['metrics'] = file_metrics.to_dict()
+    logger.info(f"{path}: kept {stats['written']} of {stats['lines']} records"
+                + (f", {stats['duplicates']} near duplicates removed" if dedup is not None else ''))
+    return stats
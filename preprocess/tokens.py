@@ -0,0 +1,122 @@
+"""
+Byte level BPE token counts, like GPT-2's tokenizer, without dependencies.
+
+Used by the ``--max-tokens`` filter of build.py and by the token limits of
+``reddit/create_data.py`` and the local runner. Only token counts are
+computed: every distinct word of a batch is merged once, merged words and
+short texts are kept in LRU caches.
+"""
+
+import json
+import re
+from functools import lru_cache
+
+# GPT-2's pre-tokenizer, with \p{L} and \p{N} approximated by `re` classes
+PRE_TOKENIZER = re.compile(
+    r"""'s|'t|'re|'ve|'m|'ll|'d| ?[^\W\d_]+| ?\d+| ?[^\s\w]+|\s+(?!\S)|\s+""")
+# texts this short are counted once, they repeat a lot
+SHORT_TEXT = 64
+
+
+def _byte_characters() -> list:
+    """The characters GPT-2's byte level BPE uses for the 256 byte values."""
+    printable = (list(range(ord('!'), ord('~') + 1))
+                 + list(range(ord('\xa1'), ord('\xac') + 1))
+                 + list(range(ord('\xae'), ord('\xff') + 1)))
+    characters = {}
+    extra = 0
+    for byte in range(256):
+        if byte in printable:
+            characters[byte] = chr(byte)
+        else:
+            characters[byte] = chr(256 + extra)
+            extra += 1
+    return [characters[byte] for byte in range(256)]
+
+
+BYTE_CHARACTERS = _byte_characters()
+
+
+def _open_binary(path: str):
+    return open(path, 'rb')
+
+
+def read_bpe_merges(path: str, opener=_open_binary) -> list:
+    """
+    Return the merges of a BPE vocabulary as ``(first, second)`` pairs, in order of priority.
+
+    :param path: a GPT-2 ``merges.txt`` or a ``tokenizer.json`` of the
+        tokenizers library.
+    :param opener: ``opener(path)`` opens the file as a binary stream, for
+        example ``FileSystems.open`` of Beam to read from cloud storage.
+    """
+    with opener(path) as fp:
+        data = fp.read().decode('utf-8')
+    if path.endswith('.json'):
+        merges = json.loads(data)['model']['merges']
+        return [tuple(merge.split(' ', 1)) if isinstance(merge, str) else tuple(merge)
+                for merge in merges]
+    return [tuple(line.split(' ', 1)) for line in data.splitlines()
+            if line and not line.startswith('#version')]
+
+
+class BpeTokenizer:
+    """
+    Count the byte level BPE tokens of texts.
+
+    :param merges: the merges of the vocabulary, in order of priority.
+    :param cache_size: number of merged words and of short texts cached.
+    """
+
+    def __init__(self, merges: list, cache_size: int = 100000):
+        self._ranks = {tuple(merge): rank for rank, merge in enumerate(merges)}
+        self.word_tokens = lru_cache(maxsize=cache_size)(self._word_tokens)
+        self.short_text_tokens = lru_cache(maxsize=cache_size)(self._text_tokens)
+
+    @classmethod
+    def load(cls, path: str, cache_size: int = 100000, opener=_open_binary):
+        return cls(read_bpe_merges(path, opener), cache_size)
+
+    def _word_tokens(self, word: str) -> int:
+        """The number of tokens of a pre-tokenized word."""
+        parts = tuple(BYTE_CHARACTERS[byte] for byte in word.encode('utf-8'))
+        ranks = self._ranks
+        while len(parts) > 1:
+            pairs = set(zip(parts, parts[1:]))
+            best = min(pairs, key=lambda pair: ranks.get(pair, float('inf')))
+            if best not in ranks:
+                break
+            first, second = best
+            merged = []
+            i = 0
+            while i < len(parts):
+                if i < len(parts) - 1 and parts[i] == first and parts[i + 1] == second:
+                    merged.append(first + second)
+                    i += 2
+                else:
+                    merged.append(parts[i])
+                    i += 1
+            parts = tuple(merged)
+        return len(parts)
+
+    def _text_tokens(self, text: str) -> int:
+        return sum(self.word_tokens(word) for word in PRE_TOKENIZER.findall(text))
+
+    def count_batch(self, texts: list) -> list:
+        """Return the number of tokens of every text."""
+        counts = [None] * len(texts)
+        words = {}
+        pending = []
+        for i, text in enumerate(texts):
+            if len(text) <= SHORT_TEXT:
+                counts[i] = self.short_text_tokens(text)
+                continue
+            text_words = PRE_TOKENIZER.findall(text)
+            pending.append((i, text_words))
+            for word in text_words:
+                words[word] = None
+        for word in words:
+            words[word] = self.word_tokens(word)
+        for i, text_words in pending:
+            counts[i] = sum(words[word] for word in text_words)
+        return counts
@@ -9,32 +9,49 @@ import hashlib
 import json
 import logging
 import os
-import re
-import uuid
 import random
+import re
+import sys
+import time
+import typing
 from collections import defaultdict, namedtuple
 from functools import partial
 
 import apache_beam as beam
+import numpy as np
 from apache_beam import pvalue
+from apache_beam.metrics import Metrics
+from apache_beam.metrics.metric import MetricsFilter
 from apache_beam.io import BigQuerySource, Read
+from apache_beam.io.filesystem import CompressionTypes
+from apache_beam.io.filesystems import FileSystems
+from apache_beam.io.parquetio import WriteToParquet
 from apache_beam.io.textio import WriteToText
 from apache_beam.io.tfrecordio import WriteToTFRecord
 from apache_beam.options.pipeline_options import PipelineOptions, SetupOptions
+from apache_beam.transforms.window import GlobalWindow
+from apache_beam.utils.windowed_value import WindowedValue
+
+from preprocess import dedup
+from preprocess.tokens import BpeTokenizer
 
 _JSON_FORMAT = "JSON"
+_TF_FORMAT = "TF"
+_PARQUET_FORMAT = "PARQUET"
+# Most examples of a shuffle bucket held in memory at once.
+SHUFFLE_BUFFER = 10000
 
-def _parse_args(argv=None):
-    """Parse command line arguments."""
+def _positive_int(value):
+    """Define a positive integer ArgumentParser type."""
+    value = int(value)
+    if value <= 0:
+        raise argparse.ArgumentTypeError(
+            "Value must be positive, {} was passed.".format(value))
+    return value
 
-    def _positive_int(value):
-        """Define a positive integer ArgumentParser type."""
-        value = int(value)
-        if value <= 0:
-            raise argparse.ArgumentTypeError(
-                "Value must be positive, {} was passed.".format(value))
-        return value
 
+def _parse_args(argv=None):
+    """Parse command line arguments."""
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "--reddit_table",
@@ -42,6 +59,42 @@ def _parse_args(argv=None):
         help="The BigQuery table to read comments from, in "
              "project:table format.",
     )
+    add_dataset_arguments(parser)
+    parser.add_argument(
+        "--dedup_threshold",
+        default=None, type=float,
+        help="Drop the examples whose response has a MinHash Jaccard "
+             "similarity of at least this much to the response of another "
+             "example. Examples aren't deduplicated by default.",
+    )
+    parser.add_argument(
+        "--dedup_num_perm",
+        default=64, type=_positive_int,
+        help="Number of MinHash permutations used by --dedup_threshold.",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Log the id, size and time of the threads taking longer than "
+             "--slow_thread_ms to create their examples.",
+    )
+    parser.add_argument(
+        "--slow_thread_ms",
+        default=1000, type=_positive_int,
+        help="Threads slower than this many milliseconds are logged by "
+             "--profile.",
+    )
+    parser.add_argument(
+        "--run_report",
+        default=None,
+        help="Write the pipeline metrics to this JSON file once the "
+             "pipeline finished.",
+    )
+    return parser.parse_known_args(argv)
+
+
+def add_dataset_arguments(parser):
+    """Add the arguments describing the dataset to `parser`."""
     parser.add_argument(
         "--output_dir",
         required=True,
@@ -49,11 +102,12 @@ def _parse_args(argv=None):
     )
     parser.add_argument(
         "--dataset_format",
-        choices={'TF', _JSON_FORMAT},
-        default="TF",
+        choices={_TF_FORMAT, _JSON_FORMAT, _PARQUET_FORMAT},
+        default=_TF_FORMAT,
         help="The dataset format to write. 'TF' for serialized tensorflow "
              "examples in TFRecords. 'JSON' for text files with one JSON "
-             "object per line."
+             "object per line. 'PARQUET' for Parquet files with one column "
+             "per field and the extra contexts in a list column."
     )
     parser.add_argument(
         "--parent_depth",
@@ -73,11 +127,42 @@ def _parse_args(argv=None):
         default=9,
         help="Minimum length of comments to include.",
     )
+    parser.add_argument(
+        "--bpe_vocab",
+        default=None,
+        help="BPE vocabulary counting the tokens of --max_tokens and "
+             "--context_tokens: a GPT-2 merges.txt file or a tokenizer.json "
+             "of the tokenizers library, local or on cloud storage.",
+    )
+    parser.add_argument(
+        "--max_tokens",
+        default=None, type=_positive_int,
+        help="Drop the examples whose context or response has more BPE "
+             "tokens than this.",
+    )
+    parser.add_argument(
+        "--context_tokens",
+        default=None, type=_positive_int,
+        help="BPE token budget of the context and the extra contexts. Extra "
+             "contexts are kept, nearest first, while they fit.",
+    )
     parser.add_argument(
         "--train_split",
         default=0.9, type=float,
         help="The proportion of data to put in the training set.",
     )
+    parser.add_argument(
+        "--seed",
+        default=0, type=int,
+        help="Seed of the shuffle and of the train/valid split, runs with "
+             "the same seed give the same datasets.",
+    )
+    parser.add_argument(
+        "--shuffle_buckets",
+        default=1000,
+        type=_positive_int,
+        help="Number of groups examples are shuffled into.",
+    )
     parser.add_argument(
         "--num_shards_test",
         default=100,
@@ -90,7 +175,20 @@ def _parse_args(argv=None):
         type=_positive_int,
         help="The number of shards for the train set.",
     )
-    return parser.parse_known_args(argv)
+    parser.add_argument(
+        "--hot_thread_size",
+        default=None,
+        type=_positive_int,
+        help="Threads with more comments than this are split into "
+             "sub-trees which are processed in parallel. Threads are never "
+             "split by default.",
+    )
+    parser.add_argument(
+        "--shuffle_metrics",
+        action="store_true",
+        help="Count the bytes of the comments grouped by thread in the "
+             "pipeline metrics. Every comment is encoded once more.",
+    )
 
 
 # Represent a reddit comment.
@@ -104,9 +202,14 @@ Comment = namedtuple(
         "body_is_trimmed",
         "author",
         "subreddit",
-    ]
+        # Set for comments which are never a context or a response.
+        "skip",
+    ],
+    defaults=(False,),
 )
 
+_ID_PREFIX = re.compile("^t[0-9]_")
+
 
 def normalise_comment(comment, max_length):
     """Create a _Comment object from a row in the BigQuery table."""
@@ -116,15 +219,130 @@ def normalise_comment(comment, max_length):
         parent_id=_normalise_id(comment['parent_id']),
         body=trim(comment['body'], max_length),
         body_is_trimmed=len(comment['body']) > max_length,
-        author=comment['author'],
-        subreddit=comment['subreddit'],
+        author=_intern(comment['author']),
+        subreddit=_intern(comment['subreddit']),
     )
 
 
+def _intern(text):
+    return sys.intern(text) if isinstance(text, str) else text
+
+
 def _normalise_id(raw_id):
-    import re
     """Reddit IDs start with t1_, t2_, etc. which need to be stripped."""
-    return re.sub("^t[0-9]_", "", raw_id)
+    return _ID_PREFIX.sub("", raw_id, count=1)
+
+
+def prefilter_comment(comment, min_length, parent_depth):
+    """Shrinks a comment which can't be a context or a response.
+
+    It stays in its thread as a skeleton, to keep the tree intact. Its body
+    is only kept if it can be an extra context, which isn't checked.
+    """
+    if comment.skip or not _should_skip(comment, min_length):
+        return comment
+    return comment._replace(
+        body=comment.body if parent_depth > 1 else "",
+        author="", subreddit="", skip=True)
+
+
+class PrefilterCommentFn(beam.DoFn):
+    """Applies :func:`prefilter_comment`, counting the skip reasons."""
+
+    def __init__(self, min_length, parent_depth):
+        self._min_length = min_length
+        self._parent_depth = parent_depth
+        self._reasons = {
+            reason: Metrics.counter("create_data", "skipped_" + reason)
+            for reason in ("trimmed", "deleted", "too_short")}
+
+    def process(self, comment):
+        reason = _skip_reason(comment, self._min_length)
+        if reason in self._reasons:
+            self._reasons[reason].inc()
+        yield prefilter_comment(comment, self._min_length, self._parent_depth)
+
+
+def _read_varint(encoded, position):
+    """Reads a protocol buffer varint, returns it and the next position."""
+    value = shift = 0
+    while True:
+        byte = encoded[position]
+        position += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, position
+        shift += 7
+
+
+class CommentCoder(beam.coders.Coder):
+    """Encodes a comment as a few flags and its length prefixed strings.
+
+    Comments are otherwise pickled, with their class name in every element.
+    """
+
+    _FIELDS = ("id", "thread_id", "parent_id", "body", "author", "subreddit")
+
+    def encode(self, comment):
+        flags = int(bool(comment.body_is_trimmed)) | int(comment.skip) << 1
+        nulls = 0
+        parts = []
+        for i, field in enumerate(self._FIELDS):
+            value = getattr(comment, field)
+            if value is None:
+                nulls |= 1 << i
+                value = ""
+            value = value.encode("utf-8")
+            parts.append(_varint(len(value)))
+            parts.append(value)
+        return bytes((flags, nulls)) + b"".join(parts)
+
+    def decode(self, encoded):
+        flags, nulls = encoded[0], encoded[1]
+        position = 2
+        values = {}
+        for i, field in enumerate(self._FIELDS):
+            length, position = _read_varint(encoded, position)
+            values[field] = None if nulls >> i & 1 else (
+                encoded[position:position + length].decode("utf-8"))
+            position += length
+        return Comment(
+            body_is_trimmed=bool(flags & 1), skip=bool(flags & 2), **values)
+
+    def is_deterministic(self):
+        return True
+
+    def to_type_hint(self):
+        return Comment
+
+
+beam.coders.registry.register_coder(Comment, CommentCoder)
+
+
+class KeyByThreadFn(beam.DoFn):
+    """Keys comments by thread id, counting them and their skeletons.
+
+    If `count_bytes` is set, the encoded size of the comments is counted
+    too, that is the size of the thread shuffle.
+    """
+
+    def __init__(self, count_bytes=False):
+        self._count_bytes = count_bytes
+        self._comments = Metrics.counter("create_data", "comments")
+        self._skeletons = Metrics.counter("create_data", "skeleton_comments")
+        self._bytes = Metrics.counter("create_data", "thread_shuffle_bytes")
+
+    def setup(self):
+        self._coder = CommentCoder()
+
+    def process(self, comment):
+        self._comments.inc()
+        if comment.skip:
+            self._skeletons.inc()
+        if self._count_bytes:
+            self._bytes.inc(len(comment.thread_id.encode("utf-8"))
+                            + len(self._coder.encode(comment)))
+        yield comment.thread_id, comment
 
 
 def trim(text, max_length):
@@ -142,27 +360,54 @@ def trim(text, max_length):
     return text[:-1]
 
 
-def _should_skip(comment, min_length):
+def _skip_reason(comment, min_length):
+    """Why a comment is never a context or a response, `None` if it can be."""
+    if comment.skip:
+        return "prefiltered"
     if comment.body_is_trimmed:
-        return True
+        return "trimmed"
     if comment.body in {"[deleted]", "[removed]"}:
-        return True
+        return "deleted"
     if len(comment.body) < min_length:
-        return True
-    return False
+        return "too_short"
+    return None
 
 
-def create_examples(thread, parent_depth, min_length, format):
-    """Creates serialized tensorflow examples from a reddit thread."""
-    id_to_comment = {comment.id: comment for comment in list(thread)}
+def _should_skip(comment, min_length):
+    return _skip_reason(comment, min_length) is not None
 
-    for linear_path in linear_paths(id_to_comment, parent_depth):
-        response = id_to_comment[linear_path[-1]]
-        context = id_to_comment[linear_path[-2]]  # guaranteed to exist.
 
-        if (_should_skip(response, min_length)
-                or _should_skip(context, min_length)):
-            continue
+def create_examples(thread, parent_depth, min_length, format,
+                    responses=None):
+    """Creates serialized tensorflow examples from a reddit thread.
+
+    If `responses` is given, only comments with these ids are responses.
+    """
+    for _, example in create_keyed_examples(
+            thread, parent_depth, min_length, responses):
+        yield example
+
+
+def create_keyed_examples(thread, parent_depth, min_length, responses=None):
+    """Creates the examples of a thread, keyed by the id of their response.
+
+    Every comment is the response of at most one example, so incremental
+    builds keep the ids of the responses they emitted.
+    """
+    index = ThreadIndex(thread)
+    comments = index.comments
+    keep = np.fromiter(
+        (not _should_skip(comment, min_length) for comment in comments),
+        dtype=bool, count=len(comments))
+    if responses is not None:
+        responses = np.fromiter(
+            (comment.id in responses for comment in comments),
+            dtype=bool, count=len(comments))
+
+    for response_idx, ancestors in index.linear_paths(
+            parent_depth, keep, responses):
+        response = comments[response_idx]
+        context = comments[ancestors[0]]  # guaranteed to exist.
 
         example = {}
         example['subreddit'] = response.subreddit
@@ -172,23 +417,282 @@ def create_examples(thread, parent_depth, min_length, format):
         example['context'] = context.body
         example['response'] = response.body
 
-        for i in range(parent_depth - 1):
-            # Extra contexts start at index -3.
-            index = -3 - i
-            try:
-                context_i = linear_path[index]
-            except IndexError:
-                break
+        # Extra contexts are the ancestors above the context.
+        for i, context_i in enumerate(ancestors[1:parent_depth].tolist()):
+            example['context/{}'.format(i)] = comments[context_i].body
 
-            example['context/{}'.format(i)] = id_to_comment[context_i].body
+        yield response.id, example
 
-        yield example
+
+class ThreadIndex(object):
+    """Comments of a thread indexed by dense integers.
+
+    Parent pointers are kept in an array and comments are visited breadth
+    first, one depth level at a time. The ancestors of a level are gathered
+    from the ancestors of the level above with array operations, so only a
+    single level is held in memory and no list is built per path.
+    """
+
+    def __init__(self, thread):
+        id_to_comment = {comment.id: comment for comment in thread}
+        self.comments = list(id_to_comment.values())
+        index = {comment_id: i for i, comment_id in enumerate(id_to_comment)}
+        size = len(self.comments)
+        # -1 for comments whose parent isn't in the thread.
+        self.parents = np.fromiter(
+            (index.get(comment.parent_id, -1) for comment in self.comments),
+            dtype=np.int64, count=size)
+        # Children grouped by parent, in comment order.
+        order = np.argsort(self.parents, kind="stable")
+        self.roots = np.sort(order[:np.count_nonzero(self.parents < 0)])
+        self.children = order[len(self.roots):]
+        self.child_counts = np.bincount(
+            self.parents[self.parents >= 0], minlength=size)
+        self.child_starts = np.cumsum(self.child_counts) - self.child_counts
+
+    def levels(self, parent_depth):
+        """Yields `(nodes, ancestors)` for every depth level below the roots.
+
+        `ancestors[i]` holds the indices of the parent, grandparent, ... of
+        `nodes[i]`, up to `parent_depth` of them.
+        """
+        nodes = self.roots
+        ancestors = np.empty((len(nodes), 0), dtype=np.int64)
+        while len(nodes):
+            counts = self.child_counts[nodes]
+            # Row of the parent of every child, in the order they are visited.
+            rows = np.repeat(np.arange(len(nodes)), counts)
+            offsets = np.arange(len(rows)) - np.repeat(
+                np.cumsum(counts) - counts, counts)
+            children = self.children[self.child_starts[nodes][rows] + offsets]
+            ancestors = np.concatenate(
+                [nodes[rows, None], ancestors[rows, :parent_depth - 1]], axis=1)
+            nodes = children
+            if len(nodes):
+                yield nodes, ancestors
+
+    def linear_paths(self, parent_depth, keep=None, responses=None):
+        """Yields `(response_idx, ancestors)` for every reply in the thread.
+
+        Paths come in the order of :func:`linear_paths`, `ancestors` is a
+        view of the parent first chain of the response. If `keep` is given,
+        only paths where it is set for both the response and its parent are
+        yielded, if `responses` is given only paths where it is set for the
+        response.
+        """
+        for nodes, ancestors in self.levels(parent_depth):
+            mask = np.ones(len(nodes), dtype=bool)
+            if keep is not None:
+                mask &= keep[nodes] & keep[ancestors[:, 0]]
+            if responses is not None:
+                mask &= responses[nodes]
+            nodes, ancestors = nodes[mask], ancestors[mask]
+            for response_idx, row in zip(nodes.tolist(), ancestors):
+                yield response_idx, row
+
+
+# The part of a comment needed to split a thread.
+ThreadNode = namedtuple("ThreadNode", ["id", "parent_id"])
+
+
+def assign_shards(thread, max_size, parent_depth):
+    """Splits an oversized thread into shards of about `max_size` comments.
+
+    Top-level comments with their replies are packed into shards in
+    breadth first order. A sub-tree larger than `max_size` is split further
+    into its root and the sub-trees of its children. Every shard also gets a
+    copy of the `parent_depth` ancestors of the sub-trees it holds, so the
+    examples of its comments can be created from the shard alone.
+
+    Args:
+        thread: a `(thread_id, nodes)` pair, `nodes` are the `ThreadNode`s
+            of the thread.
+
+    Yields:
+        `((thread_id, comment_id), (shard, owned))` for every shard a
+        comment goes to. Comments are owned by exactly one shard, and are
+        responses only there. Comments which can't be reached from a
+        top-level comment are left out, they have no examples.
+    """
+    thread_id, nodes = thread
+    index = ThreadIndex(nodes)
+    levels = [(index.roots, np.empty((len(index.roots), 0), dtype=np.int64))]
+    levels.extend(index.levels(parent_depth))
+
+    subtree_sizes = np.ones(len(index.comments), dtype=np.int64)
+    for level_nodes, _ in reversed(levels[1:]):
+        np.add.at(subtree_sizes, index.parents[level_nodes],
+                  subtree_sizes[level_nodes])
+    fits = subtree_sizes <= max_size
+
+    # The root of the sub-tree every comment belongs to.
+    unit = np.full(len(index.comments), -1, dtype=np.int64)
+    in_subtree = np.zeros(len(index.comments), dtype=bool)
+    unit[index.roots] = index.roots
+    in_subtree[index.roots] = fits[index.roots]
+    for level_nodes, _ in levels[1:]:
+        parents = index.parents[level_nodes]
+        inherit = in_subtree[parents]
+        unit[level_nodes] = np.where(inherit, unit[parents], level_nodes)
+        in_subtree[level_nodes] = inherit | fits[level_nodes]
+
+    unit_sizes = np.bincount(unit[unit >= 0], minlength=len(index.comments))
+    unit_shard = np.full(len(index.comments), -1, dtype=np.int64)
+    shard, filled = 0, 0
+    for level_nodes, _ in levels:
+        for root in level_nodes[unit[level_nodes] == level_nodes].tolist():
+            if filled and filled + unit_sizes[root] > max_size:
+                shard, filled = shard + 1, 0
+            unit_shard[root] = shard
+            filled += unit_sizes[root]
+
+    copies = set()
+    for level_nodes, ancestors in levels[1:]:
+        roots = unit[level_nodes] == level_nodes
+        for root, chain in zip(level_nodes[roots].tolist(), ancestors[roots]):
+            for ancestor in chain.tolist():
+                if unit_shard[unit[ancestor]] != unit_shard[root]:
+                    copies.add((ancestor, int(unit_shard[root])))
+
+    for level_nodes, _ in levels:
+        shards = unit_shard[unit[level_nodes]]
+        for comment_idx, owner in zip(level_nodes.tolist(), shards.tolist()):
+            yield ((thread_id, index.comments[comment_idx].id), (owner, True))
+    for comment_idx, copy_shard in sorted(copies):
+        yield ((thread_id, index.comments[comment_idx].id), (copy_shard, False))
+
+
+def _comment_to_shards(joined):
+    """Keys a comment by every `(thread_id, shard)` it was assigned to."""
+    (thread_id, _), grouped = joined
+    if not grouped['comment']:
+        return
+    # Like a thread, keep one comment per id.
+    comment = list(grouped['comment'])[-1]
+    for shard, owned in grouped['shards']:
+        yield (thread_id, shard), (comment, owned)
+
+
+def create_shard_examples(shard, parent_depth, min_length, format):
+    """Creates the examples responding to the comments a shard owns."""
+    comments = [comment for comment, _ in shard]
+    owned = {comment.id for comment, is_owned in shard if is_owned}
+    return create_examples(comments, parent_depth, min_length, format,
+                           responses=owned)
+
+
+class CreateExamplesFn(beam.DoFn):
+    """Creates the examples of threads, or of thread shards if `shards`.
+
+    Counts the examples and records the distributions of the thread sizes,
+    the examples per thread, the context depths and the microseconds spent
+    per thread. With `slow_thread_ms`, threads taking longer are logged.
+    """
+
+    def __init__(self, parent_depth, min_length, shards=False,
+                 slow_thread_ms=None):
+        self._parent_depth = parent_depth
+        self._min_length = min_length
+        self._shards = shards
+        self._slow_thread_ms = slow_thread_ms
+        self._examples = Metrics.counter("create_data", "examples")
+        self._slow_threads = Metrics.counter("create_data", "slow_threads")
+        self._thread_size = Metrics.distribution("create_data", "thread_size")
+        self._thread_examples = Metrics.distribution(
+            "create_data", "examples_per_thread")
+        self._context_depth = Metrics.distribution(
+            "create_data", "context_depth")
+        self._thread_usecs = Metrics.distribution(
+            "create_data", "create_examples_usecs")
+
+    def process(self, thread):
+        responses = None
+        if self._shards:
+            responses = {comment.id for comment, owned in thread if owned}
+            thread = [comment for comment, _ in thread]
+        else:
+            thread = list(thread)
+        start = time.perf_counter()
+        examples = list(create_examples(
+            thread, self._parent_depth, self._min_length, None, responses))
+        elapsed = time.perf_counter() - start
+
+        self._thread_size.update(len(thread))
+        self._thread_examples.update(len(examples))
+        self._thread_usecs.update(int(elapsed * 1e6))
+        self._examples.inc(len(examples))
+        if (self._slow_thread_ms is not None and thread
+                and elapsed * 1000 > self._slow_thread_ms):
+            self._slow_threads.inc()
+            logging.warning(
+                "Slow thread {}: {} comments, {} examples in {:.0f} ms".format(
+                    thread[0].thread_id, len(thread), len(examples),
+                    elapsed * 1000))
+        for example in examples:
+            depth = 1
+            while "context/{}".format(depth - 1) in example:
+                depth += 1
+            self._context_depth.update(depth)
+            yield example
+
+
+def _create_examples_split(thread_id_to_comments, args):
+    """Creates the examples of all threads, splitting the hot ones.
+
+    A counting pre-pass finds the threads with more than
+    `args.hot_thread_size` comments. Only the ids and parent ids of their
+    comments are grouped by thread, to assign the comments to shards, and
+    the shards are then grouped and processed in parallel.
+    """
+    hot_threads = beam.pvalue.AsDict(
+        thread_id_to_comments
+        | "Count thread sizes" >> beam.combiners.Count.PerKey()
+        | "Find hot threads" >> beam.Filter(
+            lambda size, limit: size[1] > limit, args.hot_thread_size))
+    cold, hot = thread_id_to_comments | "Split off hot threads" >> (
+        beam.Partition(lambda t, _, hot_threads: int(t[0] in hot_threads),
+                       2, hot_threads=hot_threads))
+    slow_thread_ms = args.slow_thread_ms if args.profile else None
+
+    cold_examples = (
+        cold
+        | "Group comments by thread ID" >> beam.GroupByKey()
+        | "Get threads" >> beam.Map(lambda t: t[1])
+        | "Create {} examples".format(args.dataset_format)
+        >> beam.ParDo(CreateExamplesFn(
+            args.parent_depth, args.min_length,
+            slow_thread_ms=slow_thread_ms)))
+
+    assignments = (
+        hot
+        | "Get thread nodes" >> beam.Map(
+            lambda t: (t[0], ThreadNode(t[1].id, t[1].parent_id)))
+        | "Group thread nodes" >> beam.GroupByKey()
+        | "Assign shards" >> beam.FlatMap(
+            assign_shards, max_size=args.hot_thread_size,
+            parent_depth=args.parent_depth))
+    keyed_comments = hot | "Key by comment id" >> beam.Map(
+        lambda t: ((t[0], t[1].id), t[1]))
+    hot_examples = (
+        {'comment': keyed_comments, 'shards': assignments}
+        | "Join comments and shards" >> beam.CoGroupByKey()
+        | "Key by shard" >> beam.FlatMap(_comment_to_shards)
+        | "Group comments by shard" >> beam.GroupByKey()
+        | "Get shards" >> beam.Map(lambda t: list(t[1]))
+        | "Create {} shard examples".format(args.dataset_format)
+        >> beam.ParDo(CreateExamplesFn(
+            args.parent_depth, args.min_length, shards=True,
+            slow_thread_ms=slow_thread_ms)))
+
+    return ((cold_examples, hot_examples)
+            | "Merge examples" >> beam.Flatten())
 
 
 def linear_paths(id_to_comment, parent_depth):
     """Gets all linear paths of comments and replies from the thread.
 
     Each linear path is guaranteed to have at least two comments in it.
+    :class:`ThreadIndex` visits the same paths without building lists.
     """
     paths = []
     seen_ids = set()
@@ -214,14 +718,427 @@ def linear_paths(id_to_comment, parent_depth):
         paths = new_paths
 
 
-def _shuffle(pcollection):
-    """Shuffles the input pcollection."""
-    pcollection |= "add random key" >> beam.Map(
-        lambda value: (uuid.uuid4(), value))
-    pcollection |= "group by key" >> beam.GroupByKey()
-    pcollection |= "get shuffled values" >> beam.FlatMap(lambda t: t[1])
+def limit_tokens(examples, tokenizer, max_tokens=None, context_tokens=None):
+    """Applies the token limits to a batch of examples.
+
+    Examples whose context or response has more than `max_tokens` tokens
+    are dropped. The extra contexts are kept, nearest first, while the
+    context and the extra contexts fit in `context_tokens`, examples whose
+    context alone doesn't fit are dropped.
+
+    Returns:
+        the examples, trimmed, with `None` for the dropped ones.
+    """
+    texts = []
+    for example in examples:
+        texts.append(example["context"])
+        texts.append(example["response"])
+        if context_tokens is not None:
+            i = 0
+            while "context/{}".format(i) in example:
+                texts.append(example["context/{}".format(i)])
+                i += 1
+    counts = iter(tokenizer.count_batch(texts))
+
+    limited = []
+    for example in examples:
+        context, response = next(counts), next(counts)
+        extra = []
+        if context_tokens is not None:
+            while "context/{}".format(len(extra)) in example:
+                extra.append(next(counts))
+        if max_tokens is not None and max(context, response) > max_tokens:
+            limited.append(None)
+            continue
+        if context_tokens is None:
+            limited.append(example)
+            continue
+        if context > context_tokens:
+            limited.append(None)
+            continue
+        budget = context_tokens - context
+        keep = 0
+        while keep < len(extra) and extra[keep] <= budget:
+            budget -= extra[keep]
+            keep += 1
+        if keep < len(extra):
+            example = dict(example)
+            for i in range(keep, len(extra)):
+                del example["context/{}".format(i)]
+        limited.append(example)
+    return limited
+
+
+class LimitTokensFn(beam.DoFn):
+    """Applies :func:`limit_tokens` to batches of the examples of a bundle.
+
+    The vocabulary is loaded once per worker, examples are buffered and
+    tokenized `batch_size` at a time.
+    """
+
+    def __init__(self, vocab, max_tokens, context_tokens, batch_size=1000):
+        self._vocab = vocab
+        self._max_tokens = max_tokens
+        self._context_tokens = context_tokens
+        self._batch_size = batch_size
+        self._dropped = Metrics.counter("create_data", "too_many_tokens")
+        self._trimmed = Metrics.counter("create_data", "trimmed_contexts")
+
+    def setup(self):
+        self._tokenizer = BpeTokenizer.load(self._vocab, opener=FileSystems.open)
+
+    def start_bundle(self):
+        self._batch = []
+
+    def _flush(self):
+        batch, self._batch = self._batch, []
+        for example, limited in zip(batch, limit_tokens(
+                batch, self._tokenizer, self._max_tokens,
+                self._context_tokens)):
+            if limited is None:
+                self._dropped.inc()
+                continue
+            if len(limited) < len(example):
+                self._trimmed.inc()
+            yield limited
+
+    def process(self, example):
+        self._batch.append(example)
+        if len(self._batch) >= self._batch_size:
+            for limited in self._flush():
+                yield limited
+
+    def finish_bundle(self):
+        for limited in self._flush():
+            yield WindowedValue(limited, GlobalWindow().max_timestamp(),
+                                [GlobalWindow()])
+
+
+def _varint(value):
+    """Encodes `value` as a protocol buffer varint."""
+    if value < len(_VARINTS):
+        return _VARINTS[value]
+    encoded = bytearray()
+    while value > 0x7f:
+        encoded.append((value & 0x7f) | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+
+_VARINTS = []
+_VARINTS.extend(bytes([value]) for value in range(0x80))
+_VARINTS.extend(bytes([(value & 0x7f) | 0x80, value >> 7])
+                for value in range(0x80, 0x4000))
+
+
+def serialize_example(example):
+    """Serializes a dict of strings as a `tf.train.Example` proto.
+
+    Every value becomes a `bytes_list` feature with a single value. The
+    proto bytes are built directly, so TensorFlow isn't needed. Features are
+    written in key order. Every length is known before the bytes it
+    prefixes, so the parts are only appended and joined once.
+
+    Args:
+        example: dict mapping feature names to strings.
+
+    Returns:
+        the serialized bytes.
+    """
+    parts = [b"\n", b""]
+    size = 0
+    # Features, one map entry per feature.
+    for key in sorted(example):
+        value = example[key]
+        if not isinstance(value, bytes):
+            value = str(value).encode("utf-8")
+        key = key.encode("utf-8")
+        key_size = _varint(len(key))
+        # BytesList.value
+        value_size = _varint(len(value))
+        # Feature.bytes_list
+        bytes_list_size = _varint(1 + len(value_size) + len(value))
+        feature_size = 2 + len(bytes_list_size) + len(value_size) + len(value)
+        feature_size_bytes = _varint(feature_size)
+        # Features.feature entry key and value
+        entry_size = 2 + len(key_size) + len(key) + len(
+            feature_size_bytes) + feature_size
+        entry_size_bytes = _varint(entry_size)
+        parts += (b"\n", entry_size_bytes, b"\n", key_size, key, b"\x12",
+                  feature_size_bytes, b"\n", bytes_list_size, b"\n",
+                  value_size, value)
+        size += 1 + len(entry_size_bytes) + entry_size
+    # Example.features
+    parts[1] = _varint(size)
+    return b"".join(parts)
+
+
+class SerializeExampleFn(beam.DoFn):
+    """Serializes examples as `tf.train.Example` protos."""
+
+    def process(self, example):
+        yield serialize_example(example)
+
+
+def parquet_schema():
+    """The Arrow schema of Parquet datasets.
+
+    Subreddits and authors repeat a lot, they are dictionary encoded. The
+    `context/N` fields of an example are the list `extra_contexts`.
+    """
+    import pyarrow as pa
+
+    repeated = pa.dictionary(pa.int32(), pa.string())
+    return pa.schema([
+        ("subreddit", repeated),
+        ("thread_id", pa.string()),
+        ("context_author", repeated),
+        ("response_author", repeated),
+        ("context", pa.string()),
+        ("response", pa.string()),
+        ("extra_contexts", pa.list_(pa.string())),
+    ])
+
+
+def to_parquet_row(example):
+    """Converts an example to a row of :func:`parquet_schema`."""
+    row = {
+        key: example[key] for key in (
+            "subreddit", "thread_id", "context_author", "response_author",
+            "context", "response")
+    }
+    extra_contexts = []
+    while "context/{}".format(len(extra_contexts)) in example:
+        extra_contexts.append(
+            example["context/{}".format(len(extra_contexts))])
+    row["extra_contexts"] = extra_contexts
+    return row
+
+
+def _seeded_hash(seed, *parts):
+    """A 64 bit hash of strings, which only depends on their value and `seed`."""
+    key = "\0".join((str(seed),) + parts).encode("utf-8")
+    return int.from_bytes(hashlib.sha1(key).digest()[:8], "little")
+
+
+def _bucket_example(example, seed, num_buckets):
+    """Keys an example by its shuffle bucket."""
+    return _seeded_hash(
+        seed, example["thread_id"], example["context"],
+        example["response"]) % num_buckets, example
+
+
+def _shuffled_bucket(bucket, seed, buffer_size=SHUFFLE_BUFFER):
+    """Yields the examples of a bucket in a random order.
+
+    The random generator is seeded by the bucket and `seed`. At most
+    `buffer_size` examples are held at once: every new example takes the
+    place of a random one of the buffer, which is emitted.
+    """
+    key, examples = bucket
+    rng = random.Random(_seeded_hash(seed, "shuffle", str(key)))
+    buffer = []
+    for example in examples:
+        if len(buffer) < buffer_size:
+            buffer.append(example)
+            continue
+        position = rng.randrange(buffer_size)
+        yield buffer[position]
+        buffer[position] = example
+    rng.shuffle(buffer)
+    for example in buffer:
+        yield example
+
+
+def _shuffle(pcollection, seed=0, num_buckets=1000):
+    """Shuffles the input pcollection.
+
+    Examples are grouped into `num_buckets` buckets by a seeded hash, and
+    every bucket is shuffled locally by a generator seeded from the bucket
+    and `seed`, without sorting it.
+    """
+    pcollection |= "add bucket key" >> beam.Map(
+        _bucket_example, seed=seed, num_buckets=num_buckets)
+    pcollection |= "group by bucket" >> beam.GroupByKey()
+    pcollection |= "get shuffled values" >> beam.FlatMap(
+        _shuffled_bucket, seed=seed)
     return pcollection
 
+
+def _is_eval(example, seed, train_split):
+    """Whether the thread of the example goes to the eval set.
+
+    The split only depends on the thread id, so the examples of a thread
+    all go to the same set.
+    """
+    split_hash = _seeded_hash(seed, "split", example["thread_id"])
+    return split_hash >= train_split * 2 ** 64
+
+
+class ResponseBandsFn(beam.DoFn):
+    """Keys batches of examples by their hash and response band keys."""
+
+    def __init__(self, threshold, num_perm, seed):
+        self._threshold = threshold
+        self._num_perm = num_perm
+        self._seed = seed
+        self._examples = Metrics.counter("create_data", "dedup_examples")
+
+    def setup(self):
+        self._hasher = dedup.MinHasher(
+            self._threshold, self._num_perm, seed=self._seed)
+
+    def process(self, examples):
+        keys = self._hasher.band_keys(
+            [example["response"] for example in examples])
+        self._examples.inc(len(examples))
+        for example, example_keys in zip(examples, keys):
+            example_hash = _seeded_hash(
+                self._seed, example["thread_id"], example["context"],
+                example["response"])
+            yield example_hash, example_keys, example
+
+
+class _BandRepresentativeFn(beam.CombineFn):
+    """Finds the smallest example hash of a band, and the band size."""
+
+    def create_accumulator(self):
+        return None, 0
+
+    def add_input(self, accumulator, example_hash):
+        smallest, count = accumulator
+        if smallest is None or example_hash < smallest:
+            smallest = example_hash
+        return smallest, count + 1
+
+    def merge_accumulators(self, accumulators):
+        smallest, count = None, 0
+        for other, other_count in accumulators:
+            if other is not None and (smallest is None or other < smallest):
+                smallest = other
+            count += other_count
+        return smallest, count
+
+    def extract_output(self, accumulator):
+        return accumulator
+
+
+def _duplicate_hashes(joined):
+    """Yields the hashes of the examples of a shared band but its smallest."""
+    _, grouped = joined
+    for smallest in grouped["representative"]:
+        for example_hash in grouped["hashes"]:
+            if example_hash != smallest:
+                yield example_hash, None
+
+
+class DropNearDuplicatesFn(beam.DoFn):
+    """Drops the examples joined with a duplicate marker of their hash."""
+
+    def __init__(self):
+        self._duplicates = Metrics.counter(
+            "create_data", "near_duplicate_responses")
+
+    def process(self, joined):
+        _, grouped = joined
+        examples = list(grouped["examples"])
+        for _ in grouped["duplicates"]:
+            self._duplicates.inc(len(examples))
+            return
+        for example in examples:
+            yield example
+
+
+def _drop_near_duplicates(examples, args):
+    """Drops the examples whose response is a near duplicate of another one.
+
+    The band keys of every response are combined per key into the smallest
+    example hash and the band size. The bands shared by several examples
+    are joined back with the hashes of their examples, every hash but the
+    smallest is marked as a duplicate, and the examples are joined with the
+    marks of their hash. Nothing is broadcast to the workers, the largest
+    group is the hashes of the examples of one band. Responses too short
+    to have bands skip the joins.
+    """
+    assert 0 < args.dedup_threshold < 1, (
+        "dedup_threshold must be in the range (0-1)")
+    keyed = (
+        examples
+        | "Batch examples for MinHash" >> beam.BatchElements(
+            min_batch_size=64, max_batch_size=1024)
+        | "Compute response bands" >> beam.ParDo(ResponseBandsFn(
+            args.dedup_threshold, args.dedup_num_perm, args.seed)))
+    banded, unbanded = keyed | "Split examples without bands" >> (
+        beam.Partition(lambda t, _: 0 if t[1] else 1, 2))
+    band_hashes = banded | "Key by band" >> beam.FlatMap(
+        lambda t: ((key, t[0]) for key in t[1]))
+    representatives = (
+        band_hashes
+        | "Find band representatives" >> beam.CombinePerKey(
+            _BandRepresentativeFn())
+        | "Keep shared bands" >> beam.FlatMap(
+            lambda t: [(t[0], t[1][0])] if t[1][1] > 1 else []))
+    duplicates = (
+        {"hashes": band_hashes, "representative": representatives}
+        | "Join bands with their representative" >> beam.CoGroupByKey()
+        | "Mark duplicate hashes" >> beam.FlatMap(_duplicate_hashes))
+    kept = (
+        {"examples": banded | "Key by hash" >> beam.Map(
+            lambda t: (t[0], t[2])),
+         "duplicates": duplicates}
+        | "Join examples with duplicate marks" >> beam.CoGroupByKey()
+        | "Drop near duplicates" >> beam.ParDo(DropNearDuplicatesFn()))
+    return (
+        (kept, unbanded | "Unkey examples without bands" >> beam.Map(
+            lambda t: t[2]))
+        | "Merge deduplicated examples" >> beam.Flatten())
+
+
+def _metric_value(result):
+    # Runners without committed metrics, like the DirectRunner in some
+    # modes, only have the attempted ones.
+    return result.committed if result.committed is not None else (
+        result.attempted)
+
+
+def metrics_report(result):
+    """Collects the `create_data` metrics of a finished pipeline.
+
+    Metrics of the same name reported by several steps are merged.
+
+    Returns:
+        a dict with the `counters` by name, and the `distributions` by name
+        as dicts of their `count`, `sum`, `min`, `max` and `mean`.
+    """
+    metrics = result.metrics().query(
+        MetricsFilter().with_namespace("create_data"))
+    counters = defaultdict(int)
+    for counter in metrics["counters"]:
+        counters[counter.key.metric.name] += _metric_value(counter) or 0
+    distributions = {}
+    for distribution in metrics["distributions"]:
+        value = _metric_value(distribution)
+        if value is None or not value.count:
+            continue
+        name = distribution.key.metric.name
+        merged = distributions.setdefault(
+            name, {"count": 0, "sum": 0, "min": value.min, "max": value.max})
+        merged["count"] += value.count
+        merged["sum"] += value.sum
+        merged["min"] = min(merged["min"], value.min)
+        merged["max"] = max(merged["max"], value.max)
+    for merged in distributions.values():
+        merged["mean"] = merged["sum"] / merged["count"]
+    return {"counters": dict(counters), "distributions": distributions}
+
+
+def write_run_report(path, report):
+    """Writes a report as JSON, to any file system Beam can write."""
+    with FileSystems.create(path, mime_type="application/json") as fw:
+        fw.write(json.dumps(report, indent=2, sort_keys=True).encode("utf-8"))
+
+
 def run(argv=None, comments=None):
     """Run the beam pipeline.
 
@@ -229,8 +1146,12 @@ def run(argv=None, comments=None):
         argv: (optional) the command line flags to parse.
         comments_collection: (optional) a list of comment JSON objects to
             process. Used in unit-tests to avoid requiring a BigQuery source.
+
+    Returns:
+        the finished `PipelineResult`, with the pipeline metrics.
     """
     args, pipeline_args = _parse_args(argv)
+    start = time.time()
 
     pipeline_options = PipelineOptions(pipeline_args)
     pipeline_options.view_as(SetupOptions).save_main_session = True
@@ -245,40 +1166,63 @@ def run(argv=None, comments=None):
     comments |= (
         "Normalise comments" >> beam.Map(
             partial(normalise_comment, max_length=args.max_length)))
+    comments |= (
+        "Prefilter comments" >> beam.ParDo(
+            PrefilterCommentFn(args.min_length, args.parent_depth)
+        ).with_output_types(Comment))
 
     thread_id_to_comments = comments | (
-        "Key by thread id" >> beam.Map(
-            lambda comment: (comment.thread_id, comment)))
-    threads = thread_id_to_comments | (
-        "Group comments by thread ID" >> beam.GroupByKey())
-    threads = threads | ("Get threads" >> beam.Map(lambda t: t[1]))
-
-    examples = threads | (
-        "Create {} examples".format(args.dataset_format) >> beam.FlatMap(
-            partial(create_examples,
-                    parent_depth=args.parent_depth,
-                    min_length=args.min_length,
-                    format=args.dataset_format,
-                    )))
-    examples = _shuffle(examples)
+        "Key by thread id" >> beam.ParDo(
+            KeyByThreadFn(args.shuffle_metrics)
+        ).with_output_types(typing.Tuple[str, Comment]))
+    if args.hot_thread_size is None:
+        threads = thread_id_to_comments | (
+            "Group comments by thread ID" >> beam.GroupByKey())
+        threads = threads | ("Get threads" >> beam.Map(lambda t: t[1]))
+
+        examples = threads | (
+            "Create {} examples".format(args.dataset_format) >> beam.ParDo(
+                CreateExamplesFn(
+                    args.parent_depth, args.min_length,
+                    slow_thread_ms=(
+                        args.slow_thread_ms if args.profile else None))))
+    else:
+        examples = _create_examples_split(thread_id_to_comments, args)
+    if args.max_tokens is not None or args.context_tokens is not None:
+        assert args.bpe_vocab, "--bpe_vocab is needed to count tokens"
+        examples |= "Limit BPE tokens" >> beam.ParDo(LimitTokensFn(
+            args.bpe_vocab, args.max_tokens, args.context_tokens))
+    if args.dedup_threshold is not None:
+        examples = _drop_near_duplicates(examples, args)
+    examples = _shuffle(examples, args.seed, args.shuffle_buckets)
 
     # [START dataflow_molecules_split_to_train_and_eval_datasets]
     # Split the dataset into a training set and an evaluation set
     assert 0 < (100 - args.train_split*100) < 100, 'eval_percent must in the range (0-100)'
-    eval_percent = 100 - args.train_split*100
     train_dataset, eval_dataset = (
         examples
         | 'Split dataset' >> beam.Partition(
-            lambda elem, _: int(random.uniform(0, 100) < eval_percent), 2))
+            lambda elem, _: int(_is_eval(elem, args.seed, args.train_split)),
+            2))
     # [END dataflow_molecules_split_to_train_and_eval_datasets]
 
     if args.dataset_format == _JSON_FORMAT:
         write_sink = WriteToText
         file_name_suffix = ".json"
-        serialize_fn = json.dumps
+        serialize_fn = beam.Map(json.dumps)
+    elif args.dataset_format == _PARQUET_FORMAT:
+        write_sink = partial(
+            WriteToParquet, schema=parquet_schema(), codec="snappy")
+        file_name_suffix = ".parquet"
+        serialize_fn = beam.Map(to_parquet_row)
+    else:
+        write_sink = partial(
+            WriteToTFRecord, compression_type=CompressionTypes.GZIP)
+        file_name_suffix = ".tfrecord.gz"
+        serialize_fn = beam.ParDo(SerializeExampleFn())
 
     serialized_train_examples = train_dataset | (
-        "serialize {} examples".format('train') >> beam.Map(serialize_fn))
+        "serialize {} examples".format('train') >> serialize_fn)
     (
         serialized_train_examples | ("write " + 'train')
         >> write_sink(
@@ -289,18 +1233,33 @@ def run(argv=None, comments=None):
     )
 
     serialized_test_examples = eval_dataset | (
-        "serialize {} examples".format('valid') >> beam.Map(serialize_fn))
+        "serialize {} examples".format('valid') >> serialize_fn)
     (
         serialized_test_examples | ("write " + 'valid')
         >> write_sink(
             os.path.join(args.output_dir, 'valid'),
             file_name_suffix=file_name_suffix,
-            num_shards=args.num_shards_train,
+            num_shards=args.num_shards_test,
         )
     )
 
     result = p.run()
     result.wait_until_finish()
+    report = None
+    if args.dedup_threshold is not None or args.run_report:
+        report = metrics_report(result)
+    if args.dedup_threshold is not None:
+        logging.info("Dropped {} examples with a near duplicate response".format(
+            report["counters"].get("near_duplicate_responses", 0)))
+    if args.run_report:
+        report.update(
+            state=str(result.state),
+            seconds=time.time() - start,
+            arguments=vars(args),
+        )
+        write_run_report(args.run_report, report)
+        logging.info("Wrote the run report to {}".format(args.run_report))
+    return result
 
 
 if __name__ == "__main__":
@@ -0,0 +1,644 @@
+"""Create the reddit datasets on a single machine, without Beam.
+
+Comments are read from JSON lines files, JSON arrays or pushshift comment
+archives, normalised and prefiltered by the functions of create_data.py in
+a process pool, and hash partitioned by thread id into files on disk. Every
+partition is then grouped by thread in a worker process and its examples
+are spilled by output shard. Finally every shard is ordered by the seeded
+example hash and written in the layout of the Beam pipeline, for example
+`train-00000-of-01000.json`.
+
+The number of partitions is picked so that the partitions processed at
+once fit in `--memory_budget`. Spill files larger than the share of the
+budget of a process are sorted in runs of that size on disk and merged.
+
+With `--incremental` every run is a build adding to the dataset in
+`--output_dir`, for example one per monthly dump. The comments of every
+build are kept in a state store under `state/`, partitioned by thread like
+the input, together with the ids of the responses each thread already has
+examples for. Every record of the store starts with its thread id, so the
+threads a build doesn't touch are skipped without decoding their comments.
+A build only regroups the threads its comments touch, creates
+the examples of responses not emitted before and writes them to new shards
+in `<build_name>/`. `manifest.json` lists the shards of every build, which
+together are the same examples a full run over all the comments creates,
+as long as no comment is added in an earlier build than its parent: the
+examples already emitted depend on their ancestors only.
+
+    python -m reddit.local_runner --input 'dumps/RC_2019-*.zst' \\
+        --output_dir out --dataset_format JSON
+
+    python -m reddit.local_runner --input dumps/RC_2020-01.zst \\
+        --output_dir out --dataset_format JSON --incremental
+"""
+
+import argparse
+import glob
+import gzip
+import heapq
+import itertools
+import json
+import logging
+import math
+import multiprocessing
+import os
+import shutil
+import struct
+import tempfile
+import zlib
+from collections import defaultdict
+
+from reddit import create_data
+from preprocess import stream, tokens
+
+try:
+    from crcmod.predefined import mkPredefinedCrcFun
+    _crc32c = mkPredefinedCrcFun("crc-32c")
+except ImportError:
+    try:
+        import google_crc32c
+        _crc32c = google_crc32c.value
+    except ImportError:
+        _crc32c = None
+
+logger = logging.getLogger("reddit.local_runner")
+
+BATCH_BYTES = 8 * 1024 * 1024
+# Compressed archives are assumed to hold this many times their size.
+COMPRESSION_RATIO = 8
+# Most spill files open at once, for each split.
+MAX_SPILL_GROUPS = 128
+# Shard, example hash and length of a spilled example.
+_SPILL_HEADER = struct.Struct("<IQI")
+# Bytes a sorted spill entry takes in memory besides its record.
+_SPILL_ENTRY_OVERHEAD = 150
+# Rows of a Parquet row group written at once.
+PARQUET_ROW_GROUP = 10000
+MANIFEST = "manifest.json"
+# Arguments every build of an incremental dataset has to share.
+_DATASET_ARGUMENTS = ("parent_depth", "min_length", "max_length", "seed",
+                      "train_split", "dataset_format", "max_tokens",
+                      "context_tokens")
+# Examples tokenized at once by --max_tokens and --context_tokens.
+TOKEN_BATCH = 1000
+
+_SUFFIXES = {
+    create_data._JSON_FORMAT: ".json",
+    create_data._TF_FORMAT: ".tfrecord.gz",
+    create_data._PARQUET_FORMAT: ".parquet",
+}
+
+_args = None
+_tokenizer = None
+
+
+def _parse_args(argv=None):
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(
+        description="Create the reddit datasets on a single machine.")
+    parser.add_argument(
+        "--input",
+        required=True, nargs="+",
+        help="Comment files or glob patterns: JSON lines, JSON arrays or "
+             "pushshift archives compressed with zstd, bz2 or xz.",
+    )
+    parser.add_argument(
+        "--processes",
+        default=multiprocessing.cpu_count(),
+        type=create_data._positive_int,
+        help="Number of worker processes, defaults to all cores.",
+    )
+    parser.add_argument(
+        "--memory_budget",
+        default=2048,
+        type=create_data._positive_int,
+        help="MB of comments the workers hold in memory at once.",
+    )
+    parser.add_argument(
+        "--work_dir",
+        default=None,
+        help="Directory for the partition and spill files, a temporary "
+             "directory by default.",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Add the examples of new comments to the dataset in "
+             "--output_dir, keeping a state store and manifest there.",
+    )
+    parser.add_argument(
+        "--build_name",
+        default=None,
+        help="Directory of the shards of an incremental build, "
+             "build-<number> by default.",
+    )
+    create_data.add_dataset_arguments(parser)
+    return parser.parse_args(argv)
+
+
+def _init_worker(args):
+    global _args
+    _args = args
+
+
+def _num_shards(split, args=None):
+    args = args or _args
+    if split == "train":
+        return args.num_shards_train
+    return args.num_shards_test
+
+
+def _append_record(buffer, data):
+    buffer += create_data._varint(len(data))
+    buffer += data
+
+
+def _iter_records(data):
+    position = 0
+    while position < len(data):
+        length, position = create_data._read_varint(data, position)
+        yield data[position:position + length]
+        position += length
+
+
+def _read_file(path):
+    with open(path, "rb") as fp:
+        return fp.read()
+
+
+def _iter_batches(path):
+    """Yields batches of raw JSON comments from a file."""
+    with stream.open_compressed(path) as fp:
+        if fp.peek(64).lstrip()[:1] == b"[":
+            # A JSON array, like the test threads.
+            rows = json.load(fp)
+            for start in range(0, len(rows), 10000):
+                yield [json.dumps(row) for row in rows[start:start + 10000]]
+            return
+        for lines in stream.iter_batches(fp, BATCH_BYTES):
+            yield lines
+
+
+def _partition_batch(lines):
+    """Normalises and prefilters comments, encoded by thread partition."""
+    coder = create_data.CommentCoder()
+    partitions = defaultdict(bytearray)
+    comments = invalid = 0
+    for line in lines:
+        try:
+            row = json.loads(line)
+            comment = create_data.prefilter_comment(
+                create_data.normalise_comment(row, _args.max_length),
+                _args.min_length, _args.parent_depth)
+        except (ValueError, KeyError, TypeError):
+            invalid += 1
+            continue
+        comments += 1
+        partition = zlib.crc32(
+            comment.thread_id.encode("utf-8")) % _args.partitions
+        _append_record(partitions[partition], coder.encode(comment))
+    partitions = {key: bytes(value) for key, value in partitions.items()}
+    return partitions, comments, invalid
+
+
+def _serialize(example):
+    if _args.dataset_format == create_data._JSON_FORMAT:
+        return json.dumps(example).encode("utf-8")
+    if _args.dataset_format == create_data._PARQUET_FORMAT:
+        return json.dumps(create_data.to_parquet_row(example)).encode("utf-8")
+    return create_data.serialize_example(example)
+
+
+def _state_path(build_name, kind, partition):
+    return os.path.join(_args.output_dir, "state", build_name,
+                        "{}-{:05d}".format(kind, partition))
+
+
+def _load_state(partition, threads):
+    """Adds the stored comments of the `threads` a partition touches.
+
+    Comments the store already holds are removed from `threads`. Returns
+    the encoded new comments and the ids of the responses emitted before.
+
+    A `comments` record is the thread id followed by the encoded comments
+    of the thread, an `emitted` record the thread id and the response ids
+    on separate lines. Only the records of `threads` are decoded.
+    """
+    coder = create_data.CommentCoder()
+    wanted = {thread_id.encode("utf-8") for thread_id in threads}
+    known = defaultdict(list)
+    emitted = set()
+    for build_name in _args.builds:
+        path = _state_path(build_name, "comments", partition)
+        if os.path.isfile(path):
+            for data in _iter_records(memoryview(_read_file(path))):
+                length, position = create_data._read_varint(data, 0)
+                thread_id = data[position:position + length].tobytes()
+                if thread_id in wanted:
+                    known[thread_id.decode("utf-8")].extend(
+                        coder.decode(comment) for comment in _iter_records(
+                            data[position + length:].tobytes()))
+        path = _state_path(build_name, "emitted", partition)
+        if os.path.isfile(path):
+            for data in _iter_records(_read_file(path)):
+                if data.split(b"\n", 1)[0] in wanted:
+                    emitted.update(data.decode("utf-8").split("\n")[1:])
+
+    new_comments = bytearray()
+    for thread_id, thread in threads.items():
+        ids = {comment.id for comment in known[thread_id]}
+        thread[:] = [comment for comment in thread if comment.id not in ids]
+        if thread:
+            record = bytearray()
+            _append_record(record, thread_id.encode("utf-8"))
+            for comment in thread:
+                _append_record(record, coder.encode(comment))
+            _append_record(new_comments, record)
+        thread.extend(known[thread_id])
+    return new_comments, emitted
+
+
+def _limit_tokens(keyed):
+    """Applies the token limits to `(response_id, example)` pairs."""
+    global _tokenizer
+    if _tokenizer is None:
+        _tokenizer = tokens.BpeTokenizer.load(_args.bpe_vocab)
+    limited = []
+    for start in range(0, len(keyed), TOKEN_BATCH):
+        batch = keyed[start:start + TOKEN_BATCH]
+        limited.extend(
+            (response_id, example) for (response_id, _), example in zip(
+                batch, create_data.limit_tokens(
+                    [example for _, example in batch], _tokenizer,
+                    _args.max_tokens, _args.context_tokens))
+            if example is not None)
+    return limited
+
+
+def _process_partition(task):
+    """Creates the examples of the threads of a partition.
+
+    Returns the serialized examples by `(split, spill group)`, each after
+    its hash and output shard.
+    """
+    partition, path = task
+    coder = create_data.CommentCoder()
+    threads = defaultdict(list)
+    for data in _iter_records(_read_file(path)):
+        comment = coder.decode(data)
+        threads[comment.thread_id].append(comment)
+    os.remove(path)
+    emitted = None
+    if _args.incremental:
+        new_comments, emitted = _load_state(partition, threads)
+        new_emitted = bytearray()
+
+    keyed = []
+    response_ids = defaultdict(list)
+    for thread_id, thread in threads.items():
+        responses = None
+        if emitted is not None:
+            responses = {comment.id for comment in thread} - emitted
+        for response_id, example in create_data.create_keyed_examples(
+                thread, _args.parent_depth, _args.min_length, responses):
+            # Dropped by the token limits or not, the response is done.
+            response_ids[thread_id].append(response_id)
+            keyed.append((response_id, example))
+    if _args.max_tokens is not None or _args.context_tokens is not None:
+        keyed = _limit_tokens(keyed)
+
+    spills = defaultdict(bytearray)
+    for _, example in keyed:
+        split = "valid" if create_data._is_eval(
+            example, _args.seed, _args.train_split) else "train"
+        example_hash = create_data._seeded_hash(
+            _args.seed, example["thread_id"], example["context"],
+            example["response"])
+        shard = example_hash % _num_shards(split)
+        record = _serialize(example)
+        spill = spills[split, shard % _args.spill_groups]
+        spill += _SPILL_HEADER.pack(shard, example_hash, len(record))
+        spill += record
+    if emitted is not None:
+        for thread_id, ids in response_ids.items():
+            _append_record(
+                new_emitted, "\n".join([thread_id] + ids).encode("utf-8"))
+
+    if emitted is not None:
+        # Written by the only worker of the partition, and only part of
+        # the store once the manifest lists the build.
+        for kind, data in (("comments", new_comments),
+                           ("emitted", new_emitted)):
+            if data:
+                with open(_state_path(
+                        _args.build_name, kind, partition), "wb") as fw:
+                    fw.write(data)
+    return {key: bytes(value) for key, value in spills.items()}, len(threads)
+
+
+def _crc32c_table():
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0x82F63B78 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+_CRC32C_TABLE = _crc32c_table()
+
+
+def _masked_crc32c(data):
+    """The CRC-32C of `data`, masked like TFRecord checksums are."""
+    if _crc32c is not None:
+        crc = _crc32c(data)
+    else:
+        crc = 0xFFFFFFFF
+        for byte in data:
+            crc = _CRC32C_TABLE[(crc ^ byte) & 0xFF] ^ (crc >> 8)
+        crc ^= 0xFFFFFFFF
+    return (((crc >> 15) | (crc << 17)) + 0xA282EAD8) & 0xFFFFFFFF
+
+
+def _write_tfrecord(fw, record):
+    """Writes the length, its checksum, the record and its checksum."""
+    length = struct.pack("<Q", len(record))
+    fw.write(length)
+    fw.write(struct.pack("<I", _masked_crc32c(length)))
+    fw.write(record)
+    fw.write(struct.pack("<I", _masked_crc32c(record)))
+
+
+def _parquet_table(rows, schema):
+    """Builds a table of :func:`create_data.parquet_schema` rows."""
+    import pyarrow as pa
+
+    arrays = []
+    for field in schema:
+        values = [row[field.name] for row in rows]
+        if pa.types.is_dictionary(field.type):
+            arrays.append(pa.array(
+                values, type=field.type.value_type).dictionary_encode())
+        else:
+            arrays.append(pa.array(values, type=field.type))
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+def _write_shard(path, records):
+    """Writes the serialized examples of a shard, returns their number."""
+    written = 0
+    if _args.dataset_format == create_data._JSON_FORMAT:
+        with open(path, "wb") as fw:
+            for record in records:
+                fw.write(record)
+                fw.write(b"\n")
+                written += 1
+    elif _args.dataset_format == create_data._PARQUET_FORMAT:
+        import pyarrow.parquet as pq
+
+        schema = create_data.parquet_schema()
+        writer = pq.ParquetWriter(path, schema, compression="snappy")
+        try:
+            records = iter(records)
+            while True:
+                rows = [json.loads(record) for record in itertools.islice(
+                    records, PARQUET_ROW_GROUP)]
+                if rows or not written:
+                    writer.write_table(_parquet_table(rows, schema))
+                written += len(rows)
+                if len(rows) < PARQUET_ROW_GROUP:
+                    break
+        finally:
+            writer.close()
+    else:
+        with gzip.open(path, "wb") as fw:
+            for record in records:
+                _write_tfrecord(fw, record)
+                written += 1
+    return written
+
+
+def _shard_name(split, shard, args=None):
+    args = args or _args
+    return "{}-{:05d}-of-{:05d}{}".format(
+        split, shard, _num_shards(split, args),
+        _SUFFIXES[args.dataset_format])
+
+
+def _iter_spill(fp):
+    """Yields the `(shard, example_hash, record)` entries of a spill file."""
+    while True:
+        header = fp.read(_SPILL_HEADER.size)
+        if not header:
+            return
+        shard, example_hash, length = _SPILL_HEADER.unpack(header)
+        yield shard, example_hash, fp.read(length)
+
+
+def _write_run(path, entries):
+    entries.sort()
+    with open(path, "wb") as fw:
+        for shard, example_hash, record in entries:
+            fw.write(_SPILL_HEADER.pack(shard, example_hash, len(record)))
+            fw.write(record)
+
+
+def _sorted_spill(path):
+    """Yields the entries of a spill file ordered by shard and example hash.
+
+    At most the share of `--memory_budget` of a process is sorted in
+    memory, larger spill files are sorted in runs written next to them
+    and merged.
+    """
+    budget = _args.memory_budget * 1024 * 1024 // _args.processes
+    run_paths = []
+    entries = []
+    size = 0
+    with open(path, "rb") as fp:
+        for entry in _iter_spill(fp):
+            entries.append(entry)
+            size += len(entry[2]) + _SPILL_ENTRY_OVERHEAD
+            if size >= budget:
+                run_paths.append("{}.run-{:05d}".format(path, len(run_paths)))
+                _write_run(run_paths[-1], entries)
+                entries = []
+                size = 0
+    os.remove(path)
+    entries.sort()
+    runs = [open(run_path, "rb") for run_path in run_paths]
+    try:
+        for entry in heapq.merge(entries, *map(_iter_spill, runs)):
+            yield entry
+    finally:
+        for fp in runs:
+            fp.close()
+        for run_path in run_paths:
+            os.remove(run_path)
+
+
+def _write_group(group):
+    """Writes the shards of a spill group, each ordered by example hash."""
+    split, index, path = group
+    entries = _sorted_spill(path) if os.path.isfile(path) else iter(())
+    shards = itertools.groupby(entries, key=lambda entry: entry[0])
+    pending = next(shards, None)
+    written = 0
+    for shard in range(index, _num_shards(split), _args.spill_groups):
+        shard_path = os.path.join(_args.shard_dir, _shard_name(split, shard))
+        if pending is not None and pending[0] == shard:
+            written += _write_shard(
+                shard_path, (record for _, _, record in pending[1]))
+            pending = next(shards, None)
+        else:
+            written += _write_shard(shard_path, ())
+    return written
+
+
+def _load_manifest(args, partitions):
+    """Prepares `args` for the next build of an incremental dataset.
+
+    Sets the builds already in the store and their number of partitions.
+    Returns the manifest, a new one for the first build.
+    """
+    path = os.path.join(args.output_dir, MANIFEST)
+    dataset = {name: getattr(args, name) for name in _DATASET_ARGUMENTS}
+    if os.path.isfile(path):
+        with open(path) as fp:
+            manifest = json.load(fp)
+    else:
+        manifest = {"dataset": dataset, "partitions": partitions,
+                    "builds": [], "files": {"train": [], "valid": []}}
+    for name, value in manifest["dataset"].items():
+        if dataset[name] != value:
+            raise ValueError(
+                "--{} is {} but the dataset in {} was built with {}".format(
+                    name, dataset[name], args.output_dir, value))
+    if partitions > manifest["partitions"]:
+        logger.warning(
+            "The state store has {} partitions, {} would fit in "
+            "--memory_budget".format(manifest["partitions"], partitions))
+
+    args.builds = [build["name"] for build in manifest["builds"]]
+    if args.build_name is None:
+        args.build_name = "build-{:05d}".format(len(args.builds))
+    if args.build_name in args.builds or args.build_name in ("state", MANIFEST):
+        raise ValueError("{} already names a build in {}".format(
+            args.build_name, args.output_dir))
+    # Left by a failed attempt at this build.
+    shutil.rmtree(os.path.join(args.output_dir, args.build_name),
+                  ignore_errors=True)
+    shutil.rmtree(os.path.join(args.output_dir, "state", args.build_name),
+                  ignore_errors=True)
+    os.makedirs(os.path.join(args.output_dir, args.build_name))
+    os.makedirs(os.path.join(args.output_dir, "state", args.build_name))
+    args.partitions = manifest["partitions"]
+    args.shard_dir = os.path.join(args.output_dir, args.build_name)
+    return manifest
+
+
+def _save_manifest(args, manifest, paths, stats):
+    """Adds the build to the manifest, which makes it part of the dataset."""
+    files = {split: [os.path.join(args.build_name,
+                                  _shard_name(split, shard, args))
+                     for shard in range(_num_shards(split, args))]
+             for split in ("train", "valid")}
+    manifest["builds"].append({
+        "name": args.build_name,
+        "inputs": paths,
+        "stats": stats,
+        "files": files,
+    })
+    for split, names in files.items():
+        manifest["files"][split].extend(names)
+    path = os.path.join(args.output_dir, MANIFEST)
+    with open(path + ".tmp", "w") as fw:
+        json.dump(manifest, fw, indent=1)
+    os.replace(path + ".tmp", path)
+
+
+def run(argv=None):
+    """Create the datasets, returns the number of comments, threads and examples.
+
+    In an incremental build `threads` counts the threads the new comments
+    touch and `examples` the new examples.
+    """
+    args = _parse_args(argv)
+    assert 0 < args.train_split < 1, "train_split must be in the range (0-1)"
+    if args.max_tokens is not None or args.context_tokens is not None:
+        assert args.bpe_vocab, "--bpe_vocab is needed to count tokens"
+    paths = sorted({path for pattern in args.input
+                    for path in glob.glob(pattern)})
+    if not paths:
+        raise ValueError("No input files match {}".format(args.input))
+
+    estimate = sum(os.path.getsize(path) * (
+        COMPRESSION_RATIO if stream.codec(path) != "raw" else 1)
+        for path in paths)
+    per_process = args.memory_budget * 1024 * 1024 / args.processes
+    args.partitions = max(args.processes, math.ceil(estimate / per_process))
+    args.shard_dir = args.output_dir
+    os.makedirs(args.output_dir, exist_ok=True)
+    if args.incremental:
+        manifest = _load_manifest(args, args.partitions)
+    args.spill_groups = min(MAX_SPILL_GROUPS, args.partitions)
+    work_dir = tempfile.mkdtemp(prefix="create_data-", dir=args.work_dir)
+    stats = {"comments": 0, "invalid": 0, "threads": 0, "examples": 0}
+    logger.info("Partitioning {} files into {} partitions in {}".format(
+        len(paths), args.partitions, work_dir))
+
+    pool = multiprocessing.Pool(
+        args.processes, initializer=_init_worker, initargs=(args,))
+    try:
+        partition_paths = [os.path.join(work_dir, "partition-{:05d}".format(i))
+                           for i in range(args.partitions)]
+        partition_files = [open(path, "wb") for path in partition_paths]
+        try:
+            for path in paths:
+                for partitions, comments, invalid in pool.imap(
+                        _partition_batch, _iter_batches(path)):
+                    stats["comments"] += comments
+                    stats["invalid"] += invalid
+                    for partition, data in partitions.items():
+                        partition_files[partition].write(data)
+        finally:
+            for fw in partition_files:
+                fw.close()
+
+        spill_paths = {}
+        spill_files = {}
+        try:
+            for spills, threads in pool.imap_unordered(
+                    _process_partition, enumerate(partition_paths)):
+                stats["threads"] += threads
+                for key, data in spills.items():
+                    if key not in spill_files:
+                        spill_paths[key] = os.path.join(
+                            work_dir, "{}-{:05d}".format(*key))
+                        spill_files[key] = open(spill_paths[key], "wb")
+                    spill_files[key].write(data)
+        finally:
+            for fw in spill_files.values():
+                fw.close()
+
+        groups = [(split, index, spill_paths.get(
+            (split, index), os.path.join(work_dir, "{}-{:05d}".format(split, index))))
+            for split in ("train", "valid") for index in range(args.spill_groups)]
+        stats["examples"] = sum(pool.imap_unordered(_write_group, groups))
+        pool.close()
+        if args.incremental:
+            _save_manifest(args, manifest, paths, stats)
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        shutil.rmtree(work_dir, ignore_errors=True)
+    logger.info("Wrote {examples} examples of {threads} threads, {invalid} "
+                "invalid comments skipped".format(**stats))
+    return stats
+
+
+if __name__ == "__main__":
+    logging.getLogger().setLevel(logging.INFO)
+    run()
@@ -0,0 +1,14 @@
+"""
+Ships the shared ``preprocess`` package to the Dataflow workers of
+``reddit/create_data.py``, pass ``--setup_file ./setup.py``.
+"""
+
+import setuptools
+
+setuptools.setup(
+    name='reddit-preprocess',
+    version='0.1',
+    packages=['preprocess'],
+    package_data={'preprocess': ['data/*']},
+    install_requires=['numpy'],
+)
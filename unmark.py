@@ -1,6 +1,19 @@
-from markdown import Markdown
+"""
+Strip markdown from reddit texts, keeping only their plain text.
+
+Texts without any markdown syntax are returned as they are. The syntax reddit
+mostly uses (paragraphs, headers, block quotes, simple lists, links, emphasis,
+code spans and escapes) is stripped by a small compiled tokenizer which
+mirrors what Python-Markdown renders for it. Anything else is handed to the
+full Markdown engine, one instance per thread, reset after every text.
+"""
+
+import re
+import threading
 from io import StringIO
 
+from markdown import Markdown
+
 
 def unmark_element(element, stream=None):
     if stream is None:
@@ -16,9 +29,193 @@ def unmark_element(element, stream=None):
 
 # patching Markdown
 Markdown.output_formats["plain"] = unmark_element
-__md = Markdown(output_format="plain")
-__md.stripTopLevelTags = False
+_local = threading.local()
+
+# STX and ETX are stripped from the input by Markdown, so they are free to
+# delimit placeholders of already rendered inline spans
+STX = '\x02'
+ETX = '\x03'
+ESCAPED_CHARS = frozenset('\\`*_{}[]()>#+-.!')
+
+# anything which may be markdown, text without a match is plain text
+SYNTAX = re.compile(r'[\n\\`*_\[<\t\r\x02\x03]|^[ ]{0,3}(?:[#>=]|[*+-](?:[ ]|$)|\d+\.[ ]|--)|^[ ]{4}')
+
+# block level syntax, following the order of Markdown's block processors
+INDENTED = re.compile(r'^(?:[ ]{0,3}>[ ]?)*[ ]{4}', re.M)
+# setext underlines and horizontal rules, also inside quotes and list items
+RULE_LINE = re.compile(r'^(?:[ ]*(?:>|\d+\.|[*+-](?=[ ])))*[ ]*[-=*_][-=*_ ]*$', re.M)
+HEADER = re.compile(r'(?:^|\n)(?P<level>#{1,6})(?P<header>(?:\\.|[^\\])*?)#*(?:\n|$)')
+LIST_ITEM = re.compile(r'^[ ]{0,3}(?:\d+\.|[*+-])[ ]+(.*)')
+QUOTE = re.compile(r'(^|\n)[ ]{0,3}>[ ]?(.*)')
+# text of list items which Markdown would parse as a nested block
+ITEM_BLOCK = re.compile(r'[ ]{0,3}(?:[#>]|\d+\.[ ]|[*+-][ ])')
+
+# inline syntax, following the order of Markdown's inline patterns
+CODE_SPAN = re.compile(r'(?<!`)(`+)(.+?)(?<!`)\1(?!`)', re.S)
+ESCAPE = re.compile(r'\\(.)', re.S)
+LINK = re.compile(r'(?<!!)\[([^\[\]\\`*_<\n\x02\x03]*)\]\(([^\s()<>"\'\x02\x03]*)\)')
+NOT_STRONG = re.compile(r'((?:^|(?<=\s))(?:\*{1,3}|_{1,3})(?=\s|$))')
+STRONG = re.compile(r'(?<!\*)\*\*([^*\s](?:[^*]*?[^*\s])?)\*\*(?!\*)', re.S)
+EMPHASIS = re.compile(r'(?<!\*)\*([^*\s](?:[^*]*?[^*\s])?)\*(?!\*)', re.S)
+LINE_BREAK = re.compile(r'  \n')
+LINE_BREAK_SPACE = re.compile(r'  \n\s')
+# leftovers which Markdown could still render differently
+UNSUPPORTED = re.compile(r'[`*\[<]|(?<!\w)_')
+PLACEHOLDER = re.compile(STX + r'(\d+)' + ETX)
+
+
+class _Unsupported(Exception):
+    """The text uses markdown the fast path doesn't render."""
+
+
+def _engine():
+    md = getattr(_local, 'md', None)
+    if md is None:
+        md = Markdown(output_format="plain")
+        md.stripTopLevelTags = False
+        _local.md = md
+    return md
+
+
+def has_markdown(text: str) -> bool:
+    """Return whether ``text`` may contain markdown syntax."""
+    return SYNTAX.search(text) is not None
+
+
+def _inline(text: str) -> str:
+    """Render the inline markdown of a paragraph, header or list item."""
+    spans = []
+
+    def hold(value):
+        spans.append(value)
+        return f'{STX}{len(spans) - 1}{ETX}'
+
+    if '`' in text:
+        if '\\' in text:
+            raise _Unsupported
+        text = CODE_SPAN.sub(lambda m: hold(
+            m.group(2).strip().replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')), text)
+    if '\\' in text:
+        text = ESCAPE.sub(lambda m: hold(m.group(1)) if m.group(1) in ESCAPED_CHARS else m.group(0), text)
+    if '[' in text:
+        if '![' in text:
+            raise _Unsupported
+        text = LINK.sub(lambda m: hold(m.group(1)), text)
+    if '  \n' in text:
+        # whitespace after a line break may be dropped, depending on what follows
+        if LINE_BREAK_SPACE.search(text):
+            raise _Unsupported
+        text = LINE_BREAK.sub(lambda m: hold('\n'), text)
+    if '*' in text or '_' in text:
+        text = NOT_STRONG.sub(lambda m: hold(m.group(1)), text)
+        text = STRONG.sub(lambda m: m.group(1), text)
+        text = EMPHASIS.sub(lambda m: m.group(1), text)
+    if UNSUPPORTED.search(text):
+        raise _Unsupported
+    while spans and STX in text:
+        text = PLACEHOLDER.sub(lambda m: spans[int(m.group(1))], text)
+    return text
+
+
+def _parse_blocks(blocks: list, nodes: list):
+    """Parse ``blocks`` into ``(kind, value)`` nodes like Markdown's block parser."""
+    while blocks:
+        block = blocks.pop(0)
+        if not block.strip('\n'):
+            continue
+        if block.startswith('\n'):
+            blocks.insert(0, block[1:])
+            continue
+        m = HEADER.search(block)
+        if m:
+            before, after = block[:m.start()], block[m.end():]
+            if before:
+                _parse_blocks([before], nodes)
+            nodes.append(('p', m.group('header').strip()))
+            if after:
+                blocks.insert(0, after)
+            continue
+        if LIST_ITEM.match(block):
+            if nodes and nodes[-1][0] == 'list':
+                # loose lists keep paragraphs inside their items
+                raise _Unsupported
+            items = []
+            for line in block.split('\n'):
+                item = LIST_ITEM.match(line)
+                if item is None or ITEM_BLOCK.match(item.group(1)):
+                    raise _Unsupported
+                items.append(item.group(1).lstrip())
+            nodes.append(('list', items))
+            continue
+        m = QUOTE.search(block)
+        if m:
+            if m.start():
+                _parse_blocks([block[:m.start()]], nodes)
+            lines = []
+            for line in block[m.start():].split('\n'):
+                quoted = QUOTE.match(line)
+                if line.strip() == '>':
+                    lines.append('')
+                else:
+                    lines.append(quoted.group(2) if quoted else line)
+            if nodes and nodes[-1][0] == 'quote':
+                children = nodes[-1][1]
+            else:
+                children = []
+                nodes.append(('quote', children))
+            _parse_blocks('\n'.join(lines).split('\n\n'), children)
+            continue
+        if block.strip():
+            nodes.append(('p', block.lstrip()))
+
+
+def _render(nodes: list, out: list):
+    for kind, value in nodes:
+        if kind == 'p':
+            out.append(_inline(value))
+        elif kind == 'list':
+            out.append('\n')
+            for item in value:
+                out.append(_inline(item))
+                out.append('\n')
+        elif value:
+            out.append('\n')
+            _render(value, out)
+        out.append('\n')
+
+
+def _fast_unmark(text: str) -> str:
+    """Render ``text`` without the Markdown engine, raise ``_Unsupported`` if unsure."""
+    if '<' in text:
+        raise _Unsupported
+    # the whitespace normalisation of Markdown
+    text = text.replace(STX, '').replace(ETX, '')
+    text = text.replace('\r\n', '\n').replace('\r', '\n') + '\n\n'
+    text = re.sub(r'(?<=\n) +\n', '\n', text.expandtabs(4))
+    if INDENTED.search(text) or RULE_LINE.search(text):
+        raise _Unsupported
+    nodes = []
+    _parse_blocks(text.split('\n\n'), nodes)
+    out = []
+    _render(nodes, out)
+    return ''.join(out).strip()
 
 
 def unmark(text):
-    return __md.convert(text)
\ No newline at end of file
+    """Return the plain text of the markdown ``text``."""
+    if not has_markdown(text):
+        return text.strip()
+    try:
+        return _fast_unmark(text)
+    except _Unsupported:
+        pass
+    md = _engine()
+    try:
+        return md.convert(text)
+    finally:
+        md.reset()
+
+
+def unmark_batch(texts):
+    """Return the plain text of every markdown text of ``texts``."""
+    return [unmark(text) for text in texts]